@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# Load test for the decision_trees inference app, run locally without Docker or SageMaker.
+#
+# For every combination of worker count, client concurrency and rows per request, this starts the app
+# under gunicorn (see local_server.py), drives /invocations with CSV payloads from a pool of client
+# threads for a fixed time, and reports requests/sec, rows/sec, latency percentiles and the memory of
+# each worker. Payload rows are either synthetic or sampled from a recorded headerless CSV file. The
+# results are written as JSON, together with a hash of the model file, so runs against different model
+# versions can be compared.
+#
+#     python benchmarks/load_test.py --model-dir /opt/ml/model --payload payload.csv \
+#         --workers 1 4 --concurrency 1 8 32 --batch-size 1 100 --json results.json
+#
+# Server options are passed through as environment variables, e.g. --env MODEL_SERVER_PRELOAD=true.
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import platform
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from local_server import LocalServer, process_memory, train_model
+
+
+def model_fingerprint(model_dir):
+    digest = hashlib.sha256()
+    with open(os.path.join(model_dir, "decision-tree-model.pkl"), "rb") as inp:
+        for block in iter(lambda: inp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_rows(payload, n_features, seed=0):
+    """Lines of CSV to build request bodies from: the recorded file if given, else random rows."""
+    if payload:
+        with open(payload) as inp:
+            rows = [line.rstrip("\n") for line in inp if line.strip()]
+        if not rows:
+            raise ValueError("{} has no rows".format(payload))
+        return rows
+    rng = np.random.default_rng(seed)
+    return [",".join("{:.4f}".format(v) for v in row) for row in rng.normal(size=(10000, n_features))]
+
+
+def make_bodies(rows, batch_size, count=64, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        ("\n".join(rows[i] for i in rng.integers(0, len(rows), size=batch_size)) + "\n").encode("utf-8")
+        for _ in range(count)
+    ]
+
+
+def drive(server, bodies, concurrency, duration, headers):
+    """Send requests from concurrency threads for duration seconds.
+
+    Returns:
+        The latency of every successful request, the number of failed ones and the elapsed time.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        local = []
+        failed = 0
+        i = index
+        while time.perf_counter() < deadline:
+            body = bodies[i % len(bodies)]
+            i += concurrency
+            start = time.perf_counter()
+            try:
+                status, _ = server.request("POST", "/invocations", body, headers)
+            except Exception:
+                status = None
+            if status == 200:
+                local.append(time.perf_counter() - start)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def run_case(model_dir, env, workers, concurrency, batch_size, rows, duration, warmup):
+    bodies = make_bodies(rows, batch_size)
+    headers = {"Content-Type": "text/csv"}
+    with LocalServer(model_dir, workers=workers, env=env) as server:
+        server.wait_until_ready()
+        # Reach every worker once before measuring, so lazy model loads are not counted.
+        drive(server, bodies, max(concurrency, workers), warmup, headers)
+        latencies, errors, elapsed = drive(server, bodies, concurrency, duration, headers)
+        memory = [process_memory(pid) for pid in server.worker_pids()]
+
+    latencies = np.array(latencies)
+    requests = len(latencies)
+    percentiles = np.percentile(latencies, [50, 95, 99]) * 1000 if requests else [float("nan")] * 3
+    return {
+        "workers": workers,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "requests": requests,
+        "errors": errors,
+        "duration_seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "rows_per_second": requests * batch_size / elapsed,
+        "latency_ms": {
+            "p50": float(percentiles[0]),
+            "p95": float(percentiles[1]),
+            "p99": float(percentiles[2]),
+            "max": float(latencies.max() * 1000) if requests else float("nan"),
+        },
+        "worker_rss_kb": [m.get("rss_kb") for m in memory],
+        "worker_pss_kb": [m.get("pss_kb") for m in memory],
+    }
+
+
+def parse_env(pairs):
+    env = {}
+    for pair in pairs:
+        key, sep, value = pair.partition("=")
+        if not sep:
+            raise ValueError("--env takes KEY=VALUE, got {}".format(pair))
+        env[key] = value
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model-dir", help="directory with decision-tree-model.pkl; a synthetic model is trained if omitted")
+    parser.add_argument("--payload", help="headerless CSV of feature rows to sample requests from")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to measure each case")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds of traffic before measuring")
+    parser.add_argument("--env", nargs="*", default=[], help="KEY=VALUE settings for the server")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    if model_dir is None:
+        model_dir = tempfile.mkdtemp(prefix="load-test-")
+        n_features = train_model(model_dir)
+    else:
+        with open(os.path.join(model_dir, "decision-tree-model.pkl"), "rb") as inp:
+            n_features = pickle.load(inp).n_features_in_
+    rows = load_rows(args.payload, n_features)
+    env = parse_env(args.env)
+
+    results = []
+    print("{:>7} {:>11} {:>6} {:>9} {:>10} {:>8} {:>8} {:>8} {:>7} {:>12}".format(
+        "workers", "concurrency", "batch", "req/s", "rows/s", "p50 ms", "p95 ms", "p99 ms", "errors", "RSS/worker MB"))
+    for workers in args.workers:
+        for concurrency in args.concurrency:
+            for batch_size in args.batch_size:
+                row = run_case(model_dir, env, workers, concurrency, batch_size, rows, args.duration, args.warmup)
+                results.append(row)
+                print("{:>7} {:>11} {:>6} {:>9.1f} {:>10.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>7} {:>12.1f}".format(
+                    workers, concurrency, batch_size,
+                    row["requests_per_second"], row["rows_per_second"],
+                    row["latency_ms"]["p50"], row["latency_ms"]["p95"], row["latency_ms"]["p99"],
+                    row["errors"], np.mean(row["worker_rss_kb"]) / 1024,
+                ))
+
+    if args.json:
+        report = {
+            "model_sha256": model_fingerprint(model_dir),
+            "payload": args.payload,
+            "server_env": env,
+            "duration_seconds": args.duration,
+            "host": {"platform": platform.platform(), "cpus": os.cpu_count()},
+            "results": results,
+        }
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Helpers for running the decision_trees inference app on the local machine.
+#
+# LocalServer starts gunicorn the way serve does, but on a local TCP port and without nginx, Docker
+# or SageMaker, so the app can be measured on a laptop. The model directory is passed to the app
+# through SM_MODEL_DIR and the MODEL_SERVER_* variables have the same meaning as in the container.
+
+from __future__ import print_function
+
+import http.client
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+from sklearn import tree
+
+DECISION_TREES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decision_trees")
+
+sys.path.insert(0, DECISION_TREES)
+
+from compiled_tree import CompiledTree  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def train_model(model_dir, n_rows=100000, n_features=20, max_leaf_nodes=None, seed=0):
+    """Fit a tree on synthetic data and save it the way the train program does.
+
+    Returns:
+        The number of features the model expects.
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features))
+    y = np.where(X[:, 0] + X[:, 1] * X[:, 2] + rng.normal(scale=0.5, size=n_rows) > 0, "yes", "no")
+    clf = tree.DecisionTreeClassifier(max_leaf_nodes=max_leaf_nodes, random_state=seed).fit(X, y)
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    with open(os.path.join(model_dir, "decision-tree-model.pkl"), "wb") as out:
+        pickle.dump(clf, out)
+    CompiledTree.from_sklearn(clf).save(os.path.join(model_dir, "decision-tree-model"))
+    return n_features
+
+
+def process_memory(pid):
+    """Resident and proportional set size of a process in kB. PSS splits shared pages between the
+    processes that map them, so it is the fairer measure of what each worker costs."""
+    memory = {}
+    with open("/proc/{}/status".format(pid)) as inp:
+        for line in inp:
+            if line.startswith("VmRSS:"):
+                memory["rss_kb"] = int(line.split()[1])
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as inp:
+            for line in inp:
+                if line.startswith("Pss:"):
+                    memory["pss_kb"] = int(line.split()[1])
+    except IOError:
+        pass
+    return memory
+
+
+class LocalServer(object):
+    """gunicorn serving wsgi:app on 127.0.0.1.
+
+    Args:
+        model_dir (str): The directory holding decision-tree-model.pkl.
+        workers (int): MODEL_SERVER_WORKERS.
+        env (dict): Extra environment variables for the app, e.g. {"MODEL_SERVER_PRELOAD": "true"}.
+    """
+
+    def __init__(self, model_dir, workers=1, env=None, timeout=60):
+        self.model_dir = model_dir
+        self.workers = workers
+        self.env = dict(env or {})
+        self.timeout = timeout
+        self.port = free_port()
+        self.process = None
+        self.started_at = None
+
+    def gunicorn_args(self):
+        # Mirrors the worker options that serve derives from the same variables.
+        args = ["--timeout", str(self.timeout)]
+        if float(self.env.get("MODEL_SERVER_BATCH_MAX_DELAY_MS", 0)) > 0:
+            args += ["-k", "gthread", "--threads", str(self.env.get("MODEL_SERVER_THREADS", 32))]
+        else:
+            args += ["-k", "sync"]
+        if self.env.get("MODEL_SERVER_PRELOAD", "false").lower() == "true":
+            args.append("--preload")
+        return args + ["-b", "127.0.0.1:{}".format(self.port), "-w", str(self.workers), "wsgi:app"]
+
+    def start(self):
+        env = dict(os.environ, SM_MODEL_DIR=self.model_dir, MODEL_SERVER_WORKERS=str(self.workers), **self.env)
+        self.started_at = time.perf_counter()
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn"] + self.gunicorn_args(),
+            cwd=DECISION_TREES,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return self
+
+    def wait_until_listening(self, limit=60):
+        deadline = time.monotonic() + limit
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("gunicorn exited with code {}".format(self.process.returncode))
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("gunicorn did not start listening within {} seconds".format(limit))
+
+    def wait_until_ready(self, limit=60):
+        """Block until /ping succeeds."""
+        self.wait_until_listening(limit)
+        deadline = time.monotonic() + limit
+        while time.monotonic() < deadline:
+            status, _ = self.request("GET", "/ping")
+            if status == 200:
+                return
+            time.sleep(0.05)
+        raise RuntimeError("/ping did not succeed within {} seconds".format(limit))
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def worker_pids(self):
+        pids = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/{}/stat".format(entry)) as inp:
+                    # The parent pid is the second field after the parenthesised command name.
+                    ppid = int(inp.read().rsplit(")", 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            if ppid == self.process.pid:
+                pids.append(int(entry))
+        return sorted(pids)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
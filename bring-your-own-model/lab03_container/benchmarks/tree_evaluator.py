@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of the two tree evaluators that ScoringService can use.
+#
+# For each batch size this times sklearn's clf.predict on a data frame (what the CSV path hands it),
+# clf.predict on a numpy array, and CompiledTree.predict on the same array, checks that all three
+# agree and prints the per-call latency and rows/sec. By default a tree is fitted on synthetic data;
+# pass --model to benchmark a decision-tree-model.pkl produced by the train program instead.
+#
+#     python benchmarks/tree_evaluator.py --model /opt/ml/model/decision-tree-model.pkl
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn import tree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decision_trees"))
+
+from compiled_tree import CompiledTree  # noqa: E402
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000, 100000]
+
+
+def synthetic_model(n_features, max_leaf_nodes, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(50000, n_features))
+    y = (X[:, 0] + X[:, 1] * X[:, 2] + rng.normal(scale=0.5, size=len(X)) > 0).astype(int)
+    return tree.DecisionTreeClassifier(max_leaf_nodes=max_leaf_nodes, random_state=seed).fit(X, y)
+
+
+def time_call(fn, arg, min_seconds):
+    """Median seconds per call over enough calls to fill min_seconds."""
+    fn(arg)  # warm up
+    timings = []
+    deadline = time.perf_counter() + min_seconds
+    while len(timings) < 5 or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        fn(arg)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def run(clf, batch_sizes, min_seconds, seed=0):
+    compiled = CompiledTree.from_sklearn(clf)
+    rng = np.random.default_rng(seed)
+    results = []
+    for batch_size in batch_sizes:
+        X = rng.normal(size=(batch_size, clf.n_features_in_))
+        frame = pd.DataFrame(X)
+        if not np.array_equal(clf.predict(X), compiled.predict(X)):
+            raise AssertionError("CompiledTree disagrees with sklearn at batch size {}".format(batch_size))
+        row = {"batch_size": batch_size}
+        for name, fn, arg in [
+            ("sklearn_dataframe", clf.predict, frame),
+            ("sklearn_ndarray", clf.predict, X),
+            ("compiled", compiled.predict, X),
+        ]:
+            seconds = time_call(fn, arg, min_seconds)
+            row[name] = {"seconds_per_call": seconds, "rows_per_second": batch_size / seconds}
+        results.append(row)
+    return results
+
+
+def print_table(results):
+    print("{:>10} {:>18} {:>18} {:>18} {:>9}".format(
+        "batch", "sklearn df (us)", "sklearn np (us)", "compiled (us)", "speedup"))
+    for row in results:
+        print("{:>10} {:>18.1f} {:>18.1f} {:>18.1f} {:>8.1f}x".format(
+            row["batch_size"],
+            row["sklearn_dataframe"]["seconds_per_call"] * 1e6,
+            row["sklearn_ndarray"]["seconds_per_call"] * 1e6,
+            row["compiled"]["seconds_per_call"] * 1e6,
+            row["sklearn_dataframe"]["seconds_per_call"] / row["compiled"]["seconds_per_call"],
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", help="path to a pickled DecisionTreeClassifier")
+    parser.add_argument("--features", type=int, default=20, help="features of the synthetic model")
+    parser.add_argument("--max-leaf-nodes", type=int, default=256, help="size of the synthetic model")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="time spent on each measurement")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.model:
+        with open(args.model, "rb") as inp:
+            clf = pickle.load(inp)
+    else:
+        clf = synthetic_model(args.features, args.max_leaf_nodes)
+    print("Tree with {} nodes, depth {}, {} features".format(
+        clf.tree_.node_count, clf.tree_.max_depth, clf.n_features_in_))
+
+    results = run(clf, args.batch_sizes, args.min_seconds)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
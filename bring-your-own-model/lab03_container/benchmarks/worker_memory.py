@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Measures what each gunicorn worker costs as MODEL_SERVER_WORKERS grows, with and without
+# MODEL_SERVER_PRELOAD.
+#
+# For every worker count and mode this starts the app locally, times how long it takes from launch
+# to the first successful /invocations response, then sends a burst of concurrent requests so that
+# every worker has served at least once and records the slowest of them (the lazy-load spike in a
+# worker that had not loaded the model yet). Finally it reads the RSS and PSS of every worker. With
+# preloading the workers share the model's pages, which shows up as a PSS well below the RSS.
+#
+#     python benchmarks/worker_memory.py --workers 1 2 4 8 --json worker_memory.json
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from local_server import LocalServer, process_memory, train_model
+
+
+def first_prediction_seconds(server, body, limit=120):
+    server.wait_until_listening(limit)
+    deadline = time.monotonic() + limit
+    while time.monotonic() < deadline:
+        status, _ = server.request("POST", "/invocations", body, {"Content-Type": "text/csv"})
+        if status == 200:
+            return time.perf_counter() - server.started_at
+        time.sleep(0.01)
+    raise RuntimeError("No successful prediction within {} seconds".format(limit))
+
+
+def timed_request(server, body):
+    start = time.perf_counter()
+    status, _ = server.request("POST", "/invocations", body, {"Content-Type": "text/csv"})
+    if status != 200:
+        raise RuntimeError("/invocations returned {}".format(status))
+    return time.perf_counter() - start
+
+
+def measure(model_dir, workers, preload, body):
+    env = {"MODEL_SERVER_PRELOAD": "true" if preload else "false"}
+    with LocalServer(model_dir, workers=workers, env=env) as server:
+        ttfp = first_prediction_seconds(server, body)
+        burst = workers * 8
+        with ThreadPoolExecutor(max_workers=burst) as pool:
+            latencies = list(pool.map(lambda _: timed_request(server, body), range(burst)))
+        memory = [process_memory(pid) for pid in server.worker_pids()]
+        master = process_memory(server.process.pid)
+    return {
+        "workers": workers,
+        "preload": preload,
+        "time_to_first_prediction_seconds": ttfp,
+        "burst_max_latency_seconds": max(latencies),
+        "burst_median_latency_seconds": float(np.median(latencies)),
+        "master": master,
+        "worker_rss_kb": [m.get("rss_kb") for m in memory],
+        "worker_pss_kb": [m.get("pss_kb") for m in memory],
+        "total_pss_kb": sum(m.get("pss_kb", 0) for m in memory) + master.get("pss_kb", 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model-dir", help="directory with decision-tree-model.pkl; a synthetic model is trained if omitted")
+    parser.add_argument("--rows", type=int, default=200000, help="training rows of the synthetic model")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    if model_dir is None:
+        model_dir = tempfile.mkdtemp(prefix="worker-memory-")
+        n_features = train_model(model_dir, n_rows=args.rows)
+    else:
+        with open(os.path.join(model_dir, "decision-tree-model.pkl"), "rb") as inp:
+            n_features = pickle.load(inp).n_features_in_
+    body = ",".join(["0.5"] * n_features) + "\n"
+
+    results = []
+    print("{:>8} {:>8} {:>10} {:>12} {:>14} {:>14} {:>14}".format(
+        "workers", "preload", "ttfp (s)", "burst max(s)", "worker RSS MB", "worker PSS MB", "total PSS MB"))
+    for workers in args.workers:
+        for preload in (False, True):
+            row = measure(model_dir, workers, preload, body)
+            results.append(row)
+            print("{:>8} {:>8} {:>10.3f} {:>12.3f} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+                workers, str(preload),
+                row["time_to_first_prediction_seconds"],
+                row["burst_max_latency_seconds"],
+                np.mean(row["worker_rss_kb"]) / 1024,
+                np.mean([p or 0 for p in row["worker_pss_kb"]]) / 1024,
+                row["total_pss_kb"] / 1024,
+            ))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
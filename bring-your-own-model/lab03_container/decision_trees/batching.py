@@ -0,0 +1,102 @@
+# Micro-batching for /invocations.
+#
+# When gunicorn runs threaded workers, several requests can be in flight in the same process at once.
+# MicroBatcher collects them for up to max_delay seconds (or until max_batch_size rows are waiting),
+# makes one predict call on the stacked rows and hands each caller back its own slice of the result.
+# Clients that send one row per request then share the fixed cost of a predict call. Requests are only
+# stacked with others that have the same extra arguments (in multi-model mode, the same model).
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent predict calls into batched ones.
+
+    Args:
+        predict (callable): Takes a 2-D numpy array, followed by any extra arguments given to
+            MicroBatcher.predict, and returns one prediction per row.
+        max_batch_size (int): Stop waiting for more requests once this many rows are queued.
+        max_delay (float): The longest, in seconds, that the first request of a batch waits for
+            others to join it.
+    """
+
+    def __init__(self, predict, max_batch_size, max_delay):
+        self.predict_fn = predict
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def predict(self, data, *args):
+        """Queue data for the next batch and block until its predictions are ready. Any args are
+        passed on to the predict function; only requests with equal args are batched together."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((np.asarray(data), future, args))
+        return future.result()
+
+    def _ensure_started(self):
+        # The thread is started on first use rather than in __init__ so that it is created in the
+        # gunicorn worker, not in a process that is about to fork.
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._process(self._collect())
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        rows = batch[0][0].shape[0]
+        deadline = time.monotonic() + self.max_delay
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += item[0].shape[0]
+        return batch
+
+    def _process(self, batch):
+        groups = OrderedDict()
+        for data, future, args in batch:
+            groups.setdefault(args, []).append((data, future))
+        for args, items in groups.items():
+            self._process_group(items, args)
+
+    def _process_group(self, items, args):
+        if len(items) == 1:
+            self._predict_one(items[0][0], items[0][1], args)
+            return
+        try:
+            stacked = np.concatenate([data for data, _ in items])
+            predictions = self.predict_fn(stacked, *args)
+        except Exception:
+            # Requests with mismatched shapes cannot be stacked, and one bad request must not
+            # fail the others, so fall back to predicting each one on its own.
+            for data, future in items:
+                self._predict_one(data, future, args)
+            return
+        offsets = np.cumsum([data.shape[0] for data, _ in items])[:-1]
+        for (_, future), result in zip(items, np.split(predictions, offsets)):
+            future.set_result(result)
+
+    def _predict_one(self, data, future, args):
+        try:
+            future.set_result(self.predict_fn(data, *args))
+        except Exception as e:
+            future.set_exception(e)
@@ -0,0 +1,97 @@
+# An in-process cache of per-row predictions.
+#
+# Retries and popular entities mean the same feature rows are scored over and over. PredictionCache
+# remembers the prediction for each row it has seen, keyed by the row's bytes as float64, and only
+# sends the rows it does not know to the model, in a single batch. Entries are evicted least recently
+# used first once the cache is full, can expire after a TTL, and are all dropped when the model
+# version changes.
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PredictionCache(object):
+    """A bounded LRU map from feature rows to predictions.
+
+    Args:
+        max_entries (int): The number of rows to remember.
+        ttl (float): Seconds after which an entry is no longer used, or None to keep entries until
+            they are evicted.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # row bytes -> (prediction, expiry time or None)
+        self._versions = {}  # namespace -> the model version its entries were made with
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def predict(self, data, predict, version=None, namespace=None):
+        """Predict every row of data, calling predict once with just the rows that are not cached.
+
+        Args:
+            data: A 2-D array or data frame of features.
+            predict (callable): The model's predict function.
+            version: Identifies the model that predict belongs to. When it differs from the one the
+                namespace's entries were made with, the cache is cleared first. None, for models
+                that the namespace already identifies, is not tracked.
+            namespace (str): Keeps the entries of different models apart when one cache serves
+                several of them.
+        """
+        X = np.ascontiguousarray(data, dtype=np.float64)
+        n_rows = X.shape[0]
+        row_size = X.shape[1] * X.itemsize if X.ndim == 2 else X.itemsize
+        buf = X.tobytes()
+        prefix = namespace.encode("utf-8") + b"\0" if namespace else b""
+        keys = [prefix + buf[i * row_size:(i + 1) * row_size] for i in range(n_rows)]
+
+        results = [None] * n_rows
+        missing = OrderedDict()  # key -> the rows it appears in; repeats in one batch are predicted once
+        now = time.monotonic()
+        with self._lock:
+            if version is not None and self._versions.setdefault(namespace, version) != version:
+                # Entries are not indexed by namespace, and a model changing is rare enough that
+                # dropping everything is cheaper than tracking them.
+                self._entries.clear()
+                self._versions[namespace] = version
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self._entries.move_to_end(key)
+                    results[i] = entry[0]
+                else:
+                    missing.setdefault(key, []).append(i)
+            n_missing = sum(len(rows) for rows in missing.values())
+            self.hits += n_rows - n_missing
+            self.misses += n_missing
+
+        if missing:
+            predictions = predict(X[[rows[0] for rows in missing.values()]])
+            expires = now + self.ttl if self.ttl else None
+            with self._lock:
+                for (key, rows), prediction in zip(missing.items(), predictions):
+                    for i in rows:
+                        results[i] = prediction
+                    self._entries[key] = (prediction, expires)
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        return np.asarray(results)
@@ -0,0 +1,150 @@
+# A flat, array-backed copy of a fitted scikit-learn decision tree.
+#
+# sklearn's predict() validates its input, converts it to float32, walks the tree one row at a time
+# and then maps the winning class index back to a label. For small batches the validation and
+# pandas handling cost more than the walk itself. CompiledTree keeps only the arrays needed to walk
+# the tree and moves every row of a batch down one level per step with vectorized NumPy indexing,
+# so the per-call overhead is a handful of array operations.
+
+import json
+import os
+
+import numpy as np
+
+# The arrays written by CompiledTree.save, one .npy file each, plus a small JSON file for the rest.
+_ARRAYS = ["feature", "threshold", "children", "missing_left", "value"]
+_METADATA = "tree.json"
+
+
+class CompiledTree(object):
+    """A single-output decision tree flattened into contiguous node arrays.
+
+    Node i tests feature[i] against threshold[i] and continues to left[i] if the value is less
+    than or equal to the threshold, or to right[i] otherwise. Leaves point to themselves, so every
+    row can take exactly max_depth steps. missing_left[i] says where NaN goes at node i and
+    value[i] is the prediction of leaf i.
+
+    The children are stored as one (n_nodes, 2) array of [right, left] pairs, so that a single
+    gather on 2 * node + go_left picks the next node.
+    """
+
+    def __init__(self, feature, threshold, children, missing_left, value, max_depth, n_features_in=None):
+        # None of these copy when given arrays that already have the right layout, which is what
+        # lets load() hand back memory-mapped arrays untouched.
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+        self.children = np.ascontiguousarray(children, dtype=np.intp)
+        self.missing_left = np.ascontiguousarray(missing_left, dtype=bool)
+        self.value = np.ascontiguousarray(value)
+        self.max_depth = int(max_depth)
+        self.n_features_in_ = n_features_in
+        self._flat_children = self.children.reshape(-1)
+        # Without n_features_in, rows can only be checked to reach the last feature the tree tests.
+        self._min_features = int(self.feature.max(initial=-1)) + 1
+
+    @property
+    def left(self):
+        return self.children[:, 1]
+
+    @property
+    def right(self):
+        return self.children[:, 0]
+
+    @classmethod
+    def from_sklearn(cls, estimator):
+        """Compile a fitted DecisionTreeClassifier or DecisionTreeRegressor.
+
+        Raises:
+            ValueError: If the estimator has more than one output.
+        """
+        tree = estimator.tree_
+        if tree.n_outputs != 1:
+            raise ValueError("Only single-output trees can be compiled")
+
+        n_nodes = tree.node_count
+        nodes = np.arange(n_nodes)
+        is_leaf = tree.children_left < 0
+        feature = np.where(is_leaf, 0, tree.feature)
+        left = np.where(is_leaf, nodes, tree.children_left)
+        right = np.where(is_leaf, nodes, tree.children_right)
+        # Trees fitted by scikit-learn < 1.3 have no missing value support and send NaN right,
+        # because NaN <= threshold is false.
+        missing_left = getattr(tree, "missing_go_to_left", np.zeros(n_nodes, dtype=np.uint8)).astype(bool)
+
+        values = tree.value[:, 0, :]
+        if hasattr(estimator, "classes_"):
+            # Same tie-breaking as sklearn: the first class with the highest weight wins.
+            value = np.asarray(estimator.classes_).take(values.argmax(axis=1))
+        else:
+            value = values[:, 0]
+        if value.dtype.hasobject:
+            # String labels come out of sklearn as an object array, which .npy can only store
+            # with pickle. Fixed-width strings can be memory-mapped.
+            value = value.astype(str)
+
+        return cls(
+            feature,
+            tree.threshold,
+            np.stack([right, left], axis=1),
+            missing_left,
+            value,
+            tree.max_depth,
+            n_features_in=getattr(estimator, "n_features_in_", None),
+        )
+
+    def save(self, path):
+        """Write the tree to the directory path as plain .npy files that load() can memory-map."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name), allow_pickle=False)
+        with open(os.path.join(path, _METADATA), "w") as out:
+            json.dump({"max_depth": self.max_depth, "n_features_in": self.n_features_in_}, out)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Read a tree written by save().
+
+        Args:
+            path (str): The directory the tree was saved to.
+            mmap_mode (str): Passed to np.load. With "r" the arrays are read-only views of the files'
+                pages, so processes that load the same tree share one copy of it in memory.
+        """
+        with open(os.path.join(path, _METADATA)) as inp:
+            metadata = json.load(inp)
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False) for name in _ARRAYS]
+        return cls(*arrays, max_depth=metadata["max_depth"], n_features_in=metadata["n_features_in"])
+
+    def apply(self, X):
+        """Return the index of the leaf that each row of X lands in.
+
+        Raises:
+            ValueError: If X is not 2-D, or has another number of columns than the tree was fitted on.
+        """
+        # sklearn compares float32 inputs against float64 thresholds, so do the same to get the
+        # same splits.
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError("Expected a 2-D array, got shape {}".format(X.shape))
+        n_rows, n_features = X.shape
+        # Rows are read at row * n_features + feature, so rows of another width would silently
+        # read their neighbours' values, or past the end of the array.
+        if self.n_features_in_ is not None and n_features != self.n_features_in_:
+            raise ValueError("X has {} features, but the tree expects {}".format(n_features, self.n_features_in_))
+        if n_features < self._min_features:
+            raise ValueError("X has {} features, but the tree expects at least {}".format(n_features, self._min_features))
+        flat = X.reshape(-1)
+        row_offsets = np.arange(n_rows, dtype=np.intp) * n_features
+        node = np.zeros(n_rows, dtype=np.intp)
+        has_nan = bool(np.isnan(flat).any())
+        for _ in range(self.max_depth):
+            x = flat.take(row_offsets + self.feature.take(node))
+            go_left = x <= self.threshold.take(node)
+            if has_nan:
+                go_left = np.where(np.isnan(x), self.missing_left.take(node), go_left)
+            node = self._flat_children.take(2 * node + go_left)
+        return node
+
+    def predict(self, X):
+        """Predict a label (or value, for regressors) for each row of X."""
+        return self.value[self.apply(X)]
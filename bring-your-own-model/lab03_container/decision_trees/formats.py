@@ -0,0 +1,159 @@
+# Request and response encodings for the /invocations endpoint.
+#
+# CSV is the original (and fallback) format. The binary formats below exist so that callers can
+# send feature matrices without paying for a text round-trip: the request body is wrapped in a
+# NumPy array with np.frombuffer, so the bytes that flask read off the socket are the bytes the
+# model sees.
+#
+#     Content type                          Layout
+#     ------------                          ------
+#     text/csv                              one row per line, no header
+#     application/x-npy                     a .npy file (format version 1.0 or 2.0)
+#     application/vnd.apache.arrow.stream   an Arrow IPC stream, one column per feature
+#     application/x-float32                 raw little-endian float32, row-major
+#     application/x-float64                 raw little-endian float64, row-major
+#
+# The raw float types carry no shape, so the number of features comes from a "features"
+# parameter on the content type (e.g. "application/x-float32; features=4") or, failing that,
+# from the model itself.
+
+import io
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow support is optional; the other formats work without it.
+    pa = None
+
+CSV = "text/csv"
+NPY = "application/x-npy"
+ARROW = "application/vnd.apache.arrow.stream"
+FLOAT32 = "application/x-float32"
+FLOAT64 = "application/x-float64"
+
+_RAW_DTYPES = {FLOAT32: np.dtype("<f4"), FLOAT64: np.dtype("<f8")}
+
+
+def supported_types():
+    """The content types this server can read and write, in order of preference."""
+    types = [CSV, NPY, FLOAT32, FLOAT64]
+    if pa is not None:
+        types.append(ARROW)
+    return types
+
+
+def decode(body, content_type, params=None, n_features=None):
+    """Turn a request body into something ScoringService.predict accepts.
+
+    Args:
+        body (bytes): The raw request body. CSV bodies may also be given as an already decoded str.
+        content_type (str): The request mimetype, without parameters.
+        params (dict): The content type parameters, e.g. {"features": "4"}.
+        n_features (int): The number of features the model expects. Only used for the raw float
+            types when the request does not say.
+
+    Returns:
+        A pandas data frame for CSV and a 2-D numpy array for everything else, or None if the
+        content type is not supported. Binary formats are not copied.
+
+    Raises:
+        ValueError: If the body does not match the declared content type.
+    """
+    params = params or {}
+    if content_type == CSV:
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        return pd.read_csv(io.StringIO(body), header=None)
+    if content_type == NPY:
+        return _as_matrix(_npy_from_buffer(body))
+    if content_type in _RAW_DTYPES:
+        n_features = int(params.get("features", n_features or 0))
+        return _raw_from_buffer(body, _RAW_DTYPES[content_type], n_features)
+    if content_type == ARROW and pa is not None:
+        return _arrow_from_buffer(body)
+    return None
+
+
+def encode(predictions, content_type):
+    """Serialize a vector of predictions as the given content type.
+
+    Raises:
+        ValueError: If the predictions cannot be represented in that content type, e.g. class
+            labels that are strings requested as raw floats.
+    """
+    predictions = np.asarray(predictions)
+    if content_type == CSV:
+        out = io.StringIO()
+        pd.DataFrame({"results": predictions}).to_csv(out, header=False, index=False)
+        return out.getvalue()
+    if content_type == NPY:
+        if predictions.dtype.hasobject:
+            # Object arrays can only be written with pickle; fixed-width strings can be read
+            # anywhere with allow_pickle=False.
+            predictions = predictions.astype(str)
+        out = io.BytesIO()
+        np.lib.format.write_array(out, predictions, allow_pickle=False)
+        return out.getvalue()
+    if content_type in _RAW_DTYPES:
+        if predictions.dtype.kind not in "biuf":
+            raise ValueError(
+                "Predictions of type {} cannot be returned as {}".format(predictions.dtype, content_type)
+            )
+        return predictions.astype(_RAW_DTYPES[content_type], copy=False).tobytes()
+    if content_type == ARROW and pa is not None:
+        table = pa.table({"results": predictions})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    raise ValueError("Unsupported response type {}".format(content_type))
+
+
+def _as_matrix(array):
+    if array.ndim == 1:
+        return array.reshape(1, -1)
+    if array.ndim != 2:
+        raise ValueError("Expected a 1-D or 2-D array, got shape {}".format(array.shape))
+    return array
+
+
+def _npy_from_buffer(body):
+    buf = io.BytesIO(body)
+    version = np.lib.format.read_magic(buf)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(buf)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(buf)
+    else:
+        # Newer header versions have no public reader; np.load copies but still works.
+        return np.load(buf, allow_pickle=False)
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not accepted")
+    count = int(np.prod(shape))
+    if len(body) - buf.tell() < count * dtype.itemsize:
+        raise ValueError("The .npy body is shorter than its header declares")
+    array = np.frombuffer(body, dtype=dtype, count=count, offset=buf.tell())
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def _raw_from_buffer(body, dtype, n_features):
+    if n_features <= 0:
+        raise ValueError("The number of features is unknown; pass it as a 'features' content type parameter")
+    row_size = dtype.itemsize * n_features
+    if len(body) % row_size != 0:
+        raise ValueError(
+            "Body of {} bytes is not a whole number of {}-byte rows".format(len(body), row_size)
+        )
+    return np.frombuffer(body, dtype=dtype).reshape(-1, n_features)
+
+
+def _arrow_from_buffer(body):
+    table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+    if table.num_columns == 0:
+        raise ValueError("The Arrow stream has no columns")
+    # Single-chunk columns without nulls are viewed without copying; stacking them into the
+    # row-major matrix the model wants is the only copy on this path.
+    columns = [column.to_numpy() for column in table.columns]
+    return np.column_stack(columns)
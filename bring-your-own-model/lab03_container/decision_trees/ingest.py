@@ -0,0 +1,251 @@
+# Reading a training channel into one float32 feature matrix.
+#
+# The features of every row are written into a single preallocated float32 array backed by a scratch
+# file. float32 is what scikit-learn's trees work in, so fitting on it does not make another copy, and
+# pages of the file that are not in use can be dropped, so the data does not have to fit in memory twice
+# the way a list of data frames and pd.concat does.
+#
+# In File mode the channel is a directory. Its files are cut into byte ranges at line ends, the rows of
+# every range are counted in a process pool so that each range's slice of the array is known, and then
+# the pool parses the ranges in parallel, each worker writing its rows straight into its own slice.
+#
+# In Pipe mode SageMaker streams the channel through a FIFO, training_0 for the first epoch, that can only
+# be read once, front to back. It is read in blocks cut at line ends, the blocks are parsed in the pool,
+# and their rows are appended to the scratch file in order. Only a few blocks are in memory at a time.
+#
+# Labels are in the first column and keep whatever type pandas infers for them.
+
+import atexit
+import collections
+import io
+import os
+import stat
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Bytes of a file each File mode task parses, and bytes read from a pipe at a time.
+RANGE_SIZE = 64 * 1024 * 1024
+BLOCK_SIZE = 16 * 1024 * 1024
+# Rows parsed at a time within a task, which bounds each worker's memory.
+CHUNK_ROWS = 100000
+
+
+def read_channel(input_path, channel_name, workers=None, scratch_dir=None):
+    """Read every row of a training channel, in File or Pipe mode.
+
+    Args:
+        input_path (str): The directory SageMaker mounts the channels in.
+        channel_name (str): The name of the channel.
+        workers (int): The number of parsing processes. Defaults to the number of CPUs.
+        scratch_dir (str): Where to put the file backing the feature matrix. Defaults to the
+            system's temporary directory. The file is removed when the process exits.
+
+    Returns:
+        (features, labels): an (n_rows, n_features) float32 numpy.memmap and a 1-D array of labels.
+
+    Raises:
+        ValueError: If the channel is missing or empty, or its rows have different numbers of columns.
+    """
+    workers = workers or os.cpu_count() or 1
+    channel_path = os.path.join(input_path, channel_name)
+    pipe_path = channel_path + "_0"
+    start = time.perf_counter()
+    if os.path.isdir(channel_path):
+        features, labels, n_bytes = _read_files(channel_path, workers, scratch_dir)
+    elif os.path.exists(pipe_path) and stat.S_ISFIFO(os.stat(pipe_path).st_mode):
+        features, labels, n_bytes = _read_pipe(pipe_path, workers, scratch_dir)
+    else:
+        features = None
+    if features is None or features.shape[0] == 0:
+        raise ValueError(("There are no files in {}.\n" +
+                          "This usually indicates that the channel ({}) was incorrectly specified,\n" +
+                          "the data specification in S3 was incorrectly specified or the role specified\n" +
+                          "does not have permission to access the data.").format(channel_path, channel_name))
+    elapsed = time.perf_counter() - start
+    print("Read {} rows of {} features ({:.1f} MB) from the {} channel in {:.2f}s, {:.1f} MB/s".format(
+        features.shape[0], features.shape[1], n_bytes / 1e6, channel_name, elapsed, n_bytes / 1e6 / max(elapsed, 1e-9)))
+    return features, labels
+
+
+def _read_files(channel_path, workers, scratch_dir):
+    paths = sorted(os.path.join(channel_path, name) for name in os.listdir(channel_path))
+    paths = [path for path in paths if os.path.isfile(path) and os.path.getsize(path) > 0]
+    if not paths:
+        return None, None, 0
+    n_bytes = sum(os.path.getsize(path) for path in paths)
+    n_columns = _count_columns(_head(paths[0]))
+    ranges = [r for path in paths for r in _split_file(path)]
+
+    with ProcessPoolExecutor(min(workers, len(ranges))) as pool:
+        counts = list(pool.map(_count_rows, ranges))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        fd, features_path = _scratch_file(scratch_dir)
+        os.ftruncate(fd, int(offsets[-1]) * (n_columns - 1) * 4)
+        os.close(fd)
+        shape = (int(offsets[-1]), n_columns - 1)
+        parsed = list(pool.map(_parse_range, ranges, [features_path] * len(ranges), [shape] * len(ranges),
+                               offsets[:-1], [n_columns] * len(ranges)))
+
+    features = np.memmap(features_path, dtype=np.float32, mode="r+", shape=shape)
+    # Blank lines are counted but not parsed, which leaves gaps at the end of some slices. Close them.
+    row = 0
+    for offset, (n_rows, _) in zip(offsets, parsed):
+        if offset != row:
+            features[row:row + n_rows] = features[offset:offset + n_rows]
+        row += n_rows
+    if row != shape[0]:
+        features = np.memmap(features_path, dtype=np.float32, mode="r+", shape=(row, n_columns - 1))
+    return features, _concatenate_labels([labels for _, labels in parsed]), n_bytes
+
+
+def _read_pipe(pipe_path, workers, scratch_dir):
+    fd, features_path = _scratch_file(scratch_dir)
+    n_bytes = 0
+    n_rows = 0
+    n_columns = None
+    labels = []
+    pending = collections.deque()
+
+    def append(future):
+        block_features, block_labels = future.result()
+        out.write(memoryview(block_features))
+        labels.append(block_labels)
+        return block_features.shape[0]
+
+    with open(pipe_path, "rb") as inp, os.fdopen(fd, "wb") as out, ProcessPoolExecutor(workers) as pool:
+        tail = b""
+        for block in iter(lambda: inp.read(BLOCK_SIZE), b""):
+            n_bytes += len(block)
+            block = tail + block
+            cut = block.rfind(b"\n") + 1
+            block, tail = block[:cut], block[cut:]
+            if not block.strip():
+                continue
+            if n_columns is None:
+                n_columns = _count_columns(block)
+            pending.append(pool.submit(_parse_block, block, n_columns))
+            # Keep the pool busy without reading ahead of it without bound.
+            while len(pending) > 2 * workers:
+                n_rows += append(pending.popleft())
+        if tail.strip():
+            if n_columns is None:
+                n_columns = _count_columns(tail)
+            pending.append(pool.submit(_parse_block, tail, n_columns))
+        while pending:
+            n_rows += append(pending.popleft())
+
+    if n_columns is None or n_rows == 0:
+        return None, None, n_bytes
+    features = np.memmap(features_path, dtype=np.float32, mode="r+", shape=(n_rows, n_columns - 1))
+    return features, _concatenate_labels(labels), n_bytes
+
+
+def scratch_array(shape, dtype=np.float32, scratch_dir=None):
+    """A zeroed numpy.memmap backed by a scratch file that is removed when the process exits. Other
+    processes can map the same pages by opening its filename."""
+    fd, path = _scratch_file(scratch_dir)
+    os.ftruncate(fd, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    os.close(fd)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+
+def _concatenate_labels(labels):
+    # Empty arrays would turn integer labels into floats.
+    labels = [block for block in labels if len(block)]
+    return np.concatenate(labels) if labels else np.empty(0)
+
+
+def _scratch_file(scratch_dir):
+    fd, path = tempfile.mkstemp(prefix="training-features-", suffix=".f32", dir=scratch_dir)
+    atexit.register(_remove, path)
+    return fd, path
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _head(path, size=1024 * 1024):
+    with open(path, "rb") as inp:
+        return inp.read(size)
+
+
+def _count_columns(data):
+    """The number of columns in the first row of CSV data, labels included."""
+    first = data.lstrip(b"\r\n")
+    end = first.find(b"\n")
+    n_columns = pd.read_csv(io.BytesIO(first if end < 0 else first[:end + 1]), header=None).shape[1]
+    if n_columns < 2:
+        raise ValueError("Training rows need a label and at least one feature")
+    return n_columns
+
+
+def _split_file(path):
+    """Cut a file into (path, start, end) ranges of about RANGE_SIZE bytes that end at line ends."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as inp:
+        while start < size:
+            end = start + RANGE_SIZE
+            if end < size:
+                inp.seek(end)
+                end += len(inp.readline())
+            end = min(end, size)
+            ranges.append((path, start, end))
+            start = end
+    return ranges
+
+
+def _read_range(path, start, end):
+    with open(path, "rb") as inp:
+        inp.seek(start)
+        return inp.read(end - start)
+
+
+def _count_rows(file_range):
+    data = _read_range(*file_range)
+    return data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+
+
+def _feature_dtypes(n_columns):
+    return {i: np.float32 for i in range(1, n_columns)}
+
+
+def _frames(data, n_columns):
+    if not data.strip():
+        return
+    for frame in pd.read_csv(io.BytesIO(data), header=None, dtype=_feature_dtypes(n_columns), chunksize=CHUNK_ROWS):
+        if frame.shape[1] != n_columns:
+            raise ValueError("Expected {} columns in every row, found {}".format(n_columns, frame.shape[1]))
+        yield frame
+
+
+def _parse_range(file_range, features_path, shape, offset, n_columns):
+    """Parse a byte range of a file into rows offset onwards of the feature matrix. Returns the
+    number of rows parsed and their labels."""
+    features = np.memmap(features_path, dtype=np.float32, mode="r+", shape=shape)
+    row = offset
+    labels = []
+    for frame in _frames(_read_range(*file_range), n_columns):
+        features[row:row + frame.shape[0]] = frame.iloc[:, 1:].to_numpy(np.float32)
+        labels.append(frame.iloc[:, 0].to_numpy())
+        row += frame.shape[0]
+    features.flush()
+    return row - offset, np.concatenate(labels) if labels else np.empty(0)
+
+
+def _parse_block(data, n_columns):
+    """Parse a block of whole lines into a float32 feature array and its labels."""
+    frames = list(_frames(data, n_columns))
+    if not frames:
+        return np.empty((0, n_columns - 1), dtype=np.float32), np.empty(0)
+    features = np.concatenate([frame.iloc[:, 1:].to_numpy(np.float32) for frame in frames])
+    return np.ascontiguousarray(features), np.concatenate([frame.iloc[:, 0].to_numpy() for frame in frames])
@@ -0,0 +1,130 @@
+# Latency histograms for the stages of an /invocations request, in Prometheus text format.
+#
+# Each request is split into decode (reading the body and, for CSV, turning it into text), parse
+# (building the feature matrix), predict and serialize (encoding the response). Metrics.stage()
+# returns a context manager that records how long its block took. When metrics are off it returns one
+# shared no-op context manager, so instrumented code costs nothing beyond the with statement.
+#
+# Every gunicorn worker keeps its own histograms and labels them with its pid. A scrape through nginx
+# reaches one worker, so each worker's series advance as the scraper happens to reach it.
+
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency buckets.
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+# Upper bounds of the records-per-request buckets.
+RECORD_BUCKETS = [1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000]
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Histogram(object):
+    """A cumulative Prometheus histogram with fixed bucket bounds."""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        """(le, cumulative count) pairs, then the sum and the count."""
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        buckets = []
+        for bound, n in zip(self.bounds + ["+Inf"], counts):
+            cumulative += n
+            buckets.append((bound, cumulative))
+        return buckets, total, count
+
+
+class _StageTimer(object):
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    """The histograms of one worker.
+
+    Args:
+        enabled (bool): When False, nothing is recorded and stage() returns a shared no-op.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.stages = {}
+        self.records = Histogram(RECORD_BUCKETS)
+        self.collectors = []  # callables returning extra exposition lines
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        histogram = self.stages.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(name, Histogram(LATENCY_BUCKETS))
+        return _StageTimer(histogram)
+
+    def observe_records(self, n):
+        if self.enabled:
+            self.records.observe(n)
+
+    def render(self):
+        """The current values in the Prometheus text exposition format."""
+        worker = 'worker="{}"'.format(os.getpid())
+        lines = [
+            "# HELP model_server_stage_seconds Time spent in each stage of an /invocations request.",
+            "# TYPE model_server_stage_seconds histogram",
+        ]
+        for name in sorted(self.stages):
+            lines.extend(histogram_lines("model_server_stage_seconds", self.stages[name], '{},stage="{}"'.format(worker, name)))
+        lines.extend([
+            "# HELP model_server_request_records Records per /invocations request.",
+            "# TYPE model_server_request_records histogram",
+        ])
+        lines.extend(histogram_lines("model_server_request_records", self.records, worker))
+        for collect in self.collectors:
+            lines.extend(collect(worker))
+        return "\n".join(lines) + "\n"
+
+
+def sample_lines(name, kind, help, value, labels):
+    """Exposition lines for a single counter or gauge sample."""
+    return [
+        "# HELP {} {}".format(name, help),
+        "# TYPE {} {}".format(name, kind),
+        "{}{{{}}} {}".format(name, labels, value),
+    ]
+
+
+def histogram_lines(name, histogram, labels):
+    """Exposition lines for the samples of a histogram, without its HELP and TYPE lines."""
+    buckets, total, count = histogram.samples()
+    lines = ['{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, n) for bound, n in buckets]
+    lines.append("{}_sum{{{}}} {}".format(name, labels, total))
+    lines.append("{}_count{{{}}} {}".format(name, labels, count))
+    return lines
@@ -0,0 +1,110 @@
+# On-demand loading of many models in one server.
+#
+# In multi-model mode every subdirectory of the model directory holds one model, and ModelStore loads
+# them the first time they are asked for. Loaded models are kept in least recently used order and
+# evicted once their total size goes over a memory budget. When several requests ask for the same model
+# while it is loading, one of them loads it and the others wait for that load instead of starting their
+# own.
+#
+# Every load of a model is numbered, its generation, so that what is remembered about a model, such as
+# its cached predictions, can be told apart from what was remembered about an earlier load of it.
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from metrics import Histogram, LATENCY_BUCKETS
+
+# Model names are used as directory names, so keep them to one plain path component.
+_VALID_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
+def valid_model_name(name):
+    return bool(_VALID_NAME.match(name)) and ".." not in name
+
+
+class ModelStore(object):
+    """An LRU of named models bounded by their total size in bytes.
+
+    Args:
+        loader (callable): Takes a model name and returns (model, size in bytes). Raises IOError if
+            there is no such model.
+        memory_budget (int): The most bytes of models to keep loaded. The most recently used model is
+            kept even if it alone is over the budget.
+    """
+
+    def __init__(self, loader, memory_budget):
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.resident_bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = Histogram(LATENCY_BUCKETS)
+        self.evict_seconds = Histogram(LATENCY_BUCKETS)
+        self._models = OrderedDict()  # name -> (model, size, generation)
+        self._loading = {}  # name -> Future of the model
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, name):
+        return name in self._models
+
+    def get(self, name):
+        """Return the named model, loading it first if it is not resident."""
+        return self.get_with_generation(name)[0]
+
+    def get_with_generation(self, name):
+        """Return the named model, loading it first if it is not resident, and the number of the load
+        it came from. A model that is evicted and loaded again, perhaps from new files, gets a new one."""
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+                return entry[0], entry[2]
+            future = self._loading.get(name)
+            loading = future is None
+            if loading:
+                future = self._loading[name] = Future()
+        if not loading:
+            return future.result()
+
+        try:
+            start = time.perf_counter()
+            model, size = self.loader(name)
+            self.load_seconds.observe(time.perf_counter() - start)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[name]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self.loads += 1
+            generation = self.loads
+            self._models[name] = (model, size, generation)
+            self.resident_bytes += size
+            del self._loading[name]
+            self._evict()
+        future.set_result((model, generation))
+        return model, generation
+
+    def _evict(self):
+        while self.resident_bytes > self.memory_budget and len(self._models) > 1:
+            start = time.perf_counter()
+            name, (model, size, _) = self._models.popitem(last=False)
+            self.resident_bytes -= size
+            self.evictions += 1
+            del model
+            self.evict_seconds.observe(time.perf_counter() - start)
+            print("Evicted model {} ({} bytes)".format(name, size))
+
+    def stats(self):
+        return {
+            "resident_models": len(self._models),
+            "resident_bytes": self.resident_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
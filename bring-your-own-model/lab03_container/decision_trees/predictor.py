@@ -7,15 +7,65 @@ import io
 import json
 import os
 import pickle
+import shutil
 import signal
 import sys
+import tempfile
+import time
 import traceback
 
 import flask
+import numpy as np
 import pandas as pd
 
+import formats
+from batching import MicroBatcher
+from cache import PredictionCache
+from compiled_tree import CompiledTree
+from metrics import Metrics, histogram_lines, sample_lines
+from model_store import ModelStore, valid_model_name
+
 prefix = "/opt/ml/"
-model_path = os.path.join(prefix, "model")
+model_path = os.environ.get("SM_MODEL_DIR", os.path.join(prefix, "model"))
+
+# "sklearn" calls the unpickled estimator's predict; "compiled" flattens the tree into arrays when
+# the model loads and evaluates batches with NumPy (see compiled_tree.py). Both give the same
+# predictions.
+tree_evaluator = os.environ.get("MODEL_SERVER_TREE_EVALUATOR", "sklearn")
+
+# With a non-zero delay, concurrent requests in a worker are held for up to that many milliseconds
+# and predicted together in batches of up to MODEL_SERVER_BATCH_MAX_SIZE rows. serve switches
+# gunicorn to threaded workers in this mode so that there are concurrent requests to batch.
+batch_max_delay_ms = float(os.environ.get("MODEL_SERVER_BATCH_MAX_DELAY_MS", 0))
+batch_max_size = int(os.environ.get("MODEL_SERVER_BATCH_MAX_SIZE", 1000))
+
+# In preload mode serve starts gunicorn with --preload, so wsgi.py loads and warms the model once in
+# the master before the workers are forked. The model is held as memory-mapped compiled arrays
+# rather than unpickled objects, so the workers share its pages instead of each holding a copy.
+preload = os.environ.get("MODEL_SERVER_PRELOAD", "false").lower() == "true"
+
+# In streaming mode CSV bodies are parsed, predicted and answered MODEL_SERVER_STREAM_CHUNK_ROWS rows at
+# a time, so memory stays bounded for batch transform payloads of any size.
+streaming = os.environ.get("MODEL_SERVER_STREAMING", "false").lower() == "true"
+stream_chunk_rows = int(os.environ.get("MODEL_SERVER_STREAM_CHUNK_ROWS", 10000))
+
+# With a non-zero size, each worker remembers the predictions for that many distinct rows and only
+# sends unseen rows to the model. Entries expire after MODEL_SERVER_CACHE_TTL seconds if it is set.
+# The model file is checked for changes at most every model_check_interval seconds; when it has
+# changed the model is reloaded and the cache emptied.
+cache_size = int(os.environ.get("MODEL_SERVER_CACHE_SIZE", 0))
+cache_ttl = float(os.environ.get("MODEL_SERVER_CACHE_TTL", 0)) or None
+model_check_interval = 1.0
+
+# In multi-model mode each subdirectory of the model directory holds a model, chosen per request by the
+# X-Amzn-SageMaker-Target-Model header or by POSTing to /invocations/<name>. Models are loaded on first
+# use and the least recently used are evicted once the loaded ones add up to MODEL_SERVER_MODEL_MEMORY_MB.
+multi_model = os.environ.get("MODEL_SERVER_MULTI_MODEL", "false").lower() == "true"
+model_memory_mb = int(os.environ.get("MODEL_SERVER_MODEL_MEMORY_MB", 1024))
+target_model_header = "X-Amzn-SageMaker-Target-Model"
+
+# With metrics on, each request stage is timed into histograms served in Prometheus format on /metrics.
+metrics = Metrics(os.environ.get("MODEL_SERVER_METRICS", "false").lower() == "true")
 
 # A singleton for holding the model. This simply loads the model and holds it.
 # It has a predict function that does a prediction based on the model and the input data.
@@ -23,26 +73,226 @@ model_path = os.path.join(prefix, "model")
 
 class ScoringService(object):
     model = None  # Where we keep the model when it's loaded
+    warm = False  # Whether the model has made its first prediction
+    model_version = None  # The modification time and size of the model file that was loaded
+    store = None  # The named models in multi-model mode
+    _checked_at = 0.0
 
     @classmethod
-    def get_model(cls):
-        """Get the model object for this instance, loading it if it's not already loaded."""
+    def get_model(cls, name=None):
+        """Get the model object for this instance, loading it if it's not already loaded. In multi-model
+        mode, name picks one of the models in the subdirectories of the model directory."""
+        if name is not None:
+            return cls.store.get(name)
         if cls.model == None:
-            with open(os.path.join(model_path, "decision-tree-model.pkl"), "rb") as inp:
-                cls.model = pickle.load(inp)
+            cls.model_version = cls._model_file_version(model_path)
+            cls.model = cls.load(model_path)
         return cls.model
 
     @classmethod
-    def predict(cls, input):
+    def load(cls, directory):
+        """Load the model saved in directory in the form the server is configured to use."""
+        if preload:
+            return cls._load_mapped(directory)
+        model = cls._load_pickle(directory)
+        if tree_evaluator == "compiled":
+            try:
+                model = CompiledTree.from_sklearn(model)
+            except ValueError as e:
+                print("Not compiling the model, using sklearn instead: {}".format(e))
+        return model
+
+    @classmethod
+    def warm_up(cls):
+        """Load the model and run one prediction through it, so that the first real request pays
+        for neither. Returns True once the model is ready to serve."""
+        if not cls.warm:
+            model = cls.get_model()
+            n_features = getattr(model, "n_features_in_", None)
+            if n_features:
+                model.predict(np.zeros((1, n_features)))
+            cls.warm = True
+        return cls.warm
+
+    @classmethod
+    def reload_if_changed(cls):
+        """Drop the loaded model if the model file has changed since it was loaded, so that the
+        next get_model loads the new one. Checks at most every model_check_interval seconds."""
+        now = time.monotonic()
+        if cls.model is None or now - cls._checked_at < model_check_interval:
+            return
+        cls._checked_at = now
+        if cls._model_file_version(model_path) != cls.model_version:
+            print("The model file has changed, reloading it")
+            cls.model = None
+            cls.warm = False
+
+    @classmethod
+    def has_default_model(cls):
+        """Whether there is a model at the top of the model directory, which multi-model mode does
+        not need."""
+        return os.path.exists(os.path.join(model_path, "decision-tree-model.pkl"))
+
+    @classmethod
+    def _model_file_version(cls, directory):
+        stat = os.stat(os.path.join(directory, "decision-tree-model.pkl"))
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def _load_pickle(cls, directory):
+        with open(os.path.join(directory, "decision-tree-model.pkl"), "rb") as inp:
+            return pickle.load(inp)
+
+    @classmethod
+    def _load_mapped(cls, directory):
+        # The train program writes the compiled arrays next to the pickle. Models trained before it
+        # did are compiled here and written to local disk, so that they can be mapped all the same.
+        arrays_path = os.path.join(directory, "decision-tree-model")
+        if os.path.isdir(arrays_path):
+            return CompiledTree.load(arrays_path, mmap_mode="r")
+        model = cls._load_pickle(directory)
+        try:
+            compiled = CompiledTree.from_sklearn(model)
+        except ValueError as e:
+            print("Not compiling the model, preloading the pickle instead: {}".format(e))
+            return model
+        arrays_path = tempfile.mkdtemp(prefix="decision-tree-model-")
+        try:
+            compiled.save(arrays_path)
+            return CompiledTree.load(arrays_path, mmap_mode="r")
+        finally:
+            # A mapping outlives its file's name, so the files can go as soon as they are mapped,
+            # rather than one directory being left behind per load. Their pages are freed once the
+            # model is dropped by every process that maps them.
+            shutil.rmtree(arrays_path, ignore_errors=True)
+
+    @classmethod
+    def predict(cls, input, name=None):
         """For the input, do the predictions and return them.
 
         Args:
-            input (a pandas dataframe): The data on which to do the predictions. There will be
-                one prediction per row in the dataframe"""
-        clf = cls.get_model()
+            input (a pandas dataframe or 2-D numpy array): The data on which to do the predictions.
+                There will be one prediction per row in the input
+            name (str): The model to use in multi-model mode, or None for the default model."""
+        if cache is not None:
+            if name is None:
+                cls.reload_if_changed()
+                clf = cls.get_model()
+                return cache.predict(input, clf.predict, cls.model_version)
+            # A named model's entries are kept under the load it was predicted by, so that once it
+            # has been evicted and loaded again, perhaps from new files, the old ones are never hit.
+            clf, generation = cls.store.get_with_generation(name)
+            return cache.predict(input, clf.predict, namespace="{}@{}".format(name, generation))
+        clf = cls.get_model(name)
         return clf.predict(input)
 
 
+def load_named_model(name):
+    """Load the model in the subdirectory name of the model directory, with its approximate size."""
+    directory = os.path.join(model_path, name)
+    if not os.path.isdir(directory):
+        raise IOError("No model named {}".format(name))
+    model = ScoringService.load(directory)
+    if isinstance(model, CompiledTree):
+        size = sum(getattr(model, array).nbytes for array in ["feature", "threshold", "children", "missing_left", "value"])
+    else:
+        # An unpickled tree takes about as much memory as its pickle.
+        size = os.path.getsize(os.path.join(directory, "decision-tree-model.pkl"))
+    return model, size
+
+
+if multi_model:
+    ScoringService.store = ModelStore(load_named_model, model_memory_mb * 1024 * 1024)
+
+    def store_metrics(labels):
+        store = ScoringService.store
+        stats = store.stats()
+        lines = (
+            sample_lines("model_server_resident_models", "gauge", "Models loaded in this worker.", stats["resident_models"], labels)
+            + sample_lines("model_server_resident_model_bytes", "gauge", "Approximate size of the loaded models.", stats["resident_bytes"], labels)
+            + sample_lines("model_server_model_loads_total", "counter", "Models loaded.", stats["loads"], labels)
+            + sample_lines("model_server_model_evictions_total", "counter", "Models evicted.", stats["evictions"], labels)
+        )
+        for name, histogram, help in [
+            ("model_server_model_load_seconds", store.load_seconds, "Time to load a model."),
+            ("model_server_model_evict_seconds", store.evict_seconds, "Time to evict a model."),
+        ]:
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} histogram".format(name)]
+            lines += histogram_lines(name, histogram, labels)
+        return lines
+
+    metrics.collectors.append(store_metrics)
+
+
+cache = None
+if cache_size > 0:
+    cache = PredictionCache(cache_size, ttl=cache_ttl)
+
+    def cache_metrics(labels):
+        stats = cache.stats()
+        return (
+            sample_lines("model_server_cache_hits_total", "counter", "Rows answered from the cache.", stats["hits"], labels)
+            + sample_lines("model_server_cache_misses_total", "counter", "Rows sent to the model.", stats["misses"], labels)
+            + sample_lines("model_server_cache_evictions_total", "counter", "Rows evicted from the cache.", stats["evictions"], labels)
+            + sample_lines("model_server_cache_entries", "gauge", "Rows in the cache.", stats["entries"], labels)
+        )
+
+    metrics.collectors.append(cache_metrics)
+
+
+batcher = None
+if batch_max_delay_ms > 0:
+    batcher = MicroBatcher(ScoringService.predict, batch_max_size, batch_max_delay_ms / 1000.0)
+
+
+def stream_predictions(stream, chunk_rows, name=None, n_features=None):
+    """Read CSV rows from stream chunk_rows at a time and return a generator of the CSV predictions
+    for each chunk.
+
+    Only one chunk of input and its predictions are held in memory at a time, however large the
+    body is. The response is sent with chunked transfer encoding as the chunks are yielded, so the
+    first chunk is read, checked and predicted here, before the response starts: a body that is
+    malformed from its first rows raises ValueError while the status can still say so. A malformed
+    row further on can only end the response early. Every chunk must have n_features columns, if
+    it is given.
+
+    Raises:
+        ValueError: If the first chunk cannot be parsed or predicted.
+    """
+    with metrics.stage("parse"):
+        chunks = pd.read_csv(stream, header=None, chunksize=chunk_rows)
+        first = next(chunks, None)
+    if first is None:
+        return iter([])
+    first_result = _predict_chunk(first, name, n_features)
+
+    def generate():
+        records = first.shape[0]
+        try:
+            yield first_result
+            while True:
+                with metrics.stage("parse"):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                records += chunk.shape[0]
+                yield _predict_chunk(chunk, name, n_features)
+        finally:
+            metrics.observe_records(records)
+            print("Streamed predictions for {} records".format(records))
+
+    return generate()
+
+
+def _predict_chunk(chunk, name, n_features):
+    if n_features is not None and chunk.shape[1] != n_features:
+        raise ValueError("X has {} features, but the model expects {}".format(chunk.shape[1], n_features))
+    with metrics.stage("predict"):
+        predictions = ScoringService.predict(chunk, name)
+    with metrics.stage("serialize"):
+        return formats.encode(predictions, formats.CSV)
+
+
 # The flask app for serving predictions
 app = flask.Flask(__name__)
 
@@ -50,39 +300,113 @@ app = flask.Flask(__name__)
 @app.route("/ping", methods=["GET"])
 def ping():
     """Determine if the container is working and healthy. In this sample container, we declare
-    it healthy if we can load the model successfully."""
-    health = ScoringService.get_model() is not None  # You can insert a health check here
+    it healthy once the model has loaded and made its warm-up prediction. In multi-model mode the
+    models are loaded on demand, so we only check that the model directory is there."""
+    if multi_model:
+        health = os.path.isdir(model_path)
+    else:
+        health = ScoringService.warm_up()  # You can insert a health check here
 
     status = 200 if health else 404
     return flask.Response(response="\n", status=status, mimetype="application/json")
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Per-stage latency and request size histograms of this worker, for Prometheus to scrape."""
+    if not metrics.enabled:
+        return flask.Response(response="Metrics are disabled", status=404, mimetype="text/plain")
+    return flask.Response(response=metrics.render(), status=200, mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/invocations", methods=["POST"])
-def transformation():
+@app.route("/invocations/<model_name>", methods=["POST"])
+def transformation(model_name=None):
     """Do an inference on a single batch of data. In this sample server, we take data as CSV, convert
     it to a pandas data frame for internal use and then convert the predictions back to CSV (which really
     just means one prediction per line, since there's a single column.
-    """
-    data = None
 
-    # Convert from CSV to pandas
-    if flask.request.content_type == "text/csv":
-        data = flask.request.data.decode("utf-8")
-        s = io.StringIO(data)
-        data = pd.read_csv(s, header=None)
+    Callers that want to skip the text round-trip can instead send NumPy, Arrow or raw float bodies
+    (see formats.py) and pick the response encoding with the Accept header. Without an Accept header
+    the response uses the same encoding as the request.
+
+    In streaming mode CSV requests are not read into memory at all; see stream_predictions.
+
+    In multi-model mode the model is named by the path or the X-Amzn-SageMaker-Target-Model header.
+    Requests that name no model use the one at the top of the model directory, as before.
+    """
+    if model_name is None:
+        model_name = flask.request.headers.get(target_model_header) if multi_model else None
+    elif not multi_model:
+        return flask.Response(response="Multi-model mode is off", status=404, mimetype="text/plain")
+    if model_name is not None:
+        if not valid_model_name(model_name):
+            return flask.Response(response="Invalid model name", status=400, mimetype="text/plain")
+        try:
+            model = ScoringService.get_model(model_name)
+        except IOError:
+            return flask.Response(response="No model named {}".format(model_name), status=404, mimetype="text/plain")
+    elif multi_model and not ScoringService.has_default_model():
+        return flask.Response(
+            response="There is no default model; name one with the {} header or /invocations/<name>".format(target_model_header),
+            status=404,
+            mimetype="text/plain",
+        )
     else:
+        model = ScoringService.get_model()
+
+    content_type = flask.request.mimetype
+    supported = formats.supported_types()
+    if content_type not in supported:
         return flask.Response(
-            response="This predictor only supports CSV data", status=415, mimetype="text/plain"
+            response="This predictor supports {}".format(", ".join(supported)),
+            status=415,
+            mimetype="text/plain",
         )
 
+    # Without an Accept header, or with one that names nothing this predictor can write, such as the
+    # application/json that SageMaker's SDK sends by default, the response uses the request's encoding,
+    # as it always used CSV before there was a choice.
+    accept = flask.request.accept_mimetypes.best_match([content_type] + supported) or content_type
+
+    n_features = getattr(model, "n_features_in_", None)
+    if streaming and content_type == formats.CSV and accept == formats.CSV:
+        try:
+            predictions = stream_predictions(flask.request.stream, stream_chunk_rows, model_name, n_features)
+        except ValueError as e:
+            return flask.Response(response=str(e), status=400, mimetype="text/plain")
+        return flask.Response(flask.stream_with_context(predictions), status=200, mimetype=formats.CSV)
+
+    try:
+        with metrics.stage("decode"):
+            body = flask.request.get_data()
+            if content_type == formats.CSV:
+                # A UnicodeDecodeError is a ValueError, and so a 400, like any other malformed body.
+                body = body.decode("utf-8")
+        with metrics.stage("parse"):
+            data = formats.decode(body, content_type, params=flask.request.mimetype_params, n_features=n_features)
+    except ValueError as e:
+        return flask.Response(response=str(e), status=400, mimetype="text/plain")
+
     print("Invoked with {} records".format(data.shape[0]))
+    metrics.observe_records(data.shape[0])
 
-    # Do the prediction
-    predictions = ScoringService.predict(data)
+    # Do the prediction. The model rejects input of the wrong shape, such as rows with another
+    # number of features than it was trained on, with a ValueError.
+    try:
+        with metrics.stage("predict"):
+            if batcher is not None:
+                predictions = batcher.predict(data, model_name)
+            else:
+                predictions = ScoringService.predict(data, model_name)
+    except ValueError as e:
+        return flask.Response(response=str(e), status=400, mimetype="text/plain")
 
-    # Convert from numpy back to CSV
-    out = io.StringIO()
-    pd.DataFrame({"results": predictions}).to_csv(out, header=False, index=False)
-    result = out.getvalue()
+    # Convert from numpy back to the requested encoding
+    try:
+        with metrics.stage("serialize"):
+            result = formats.encode(predictions, accept)
+    except ValueError as e:
+        return flask.Response(response=str(e), status=406, mimetype="text/plain")
 
-    return flask.Response(response=result, status=200, mimetype="text/csv")
+    return flask.Response(response=result, status=200, mimetype=accept)
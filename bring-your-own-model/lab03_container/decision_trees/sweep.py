@@ -0,0 +1,162 @@
+# Hyperparameter sweeps inside one training job.
+#
+# Any tree hyperparameter can be given as a JSON list, e.g. "max_leaf_nodes": "[8, 16, 32]", and the
+# sweep trains one candidate per combination of the listed values. Explicit combinations can be given
+# instead as "candidates": "[{\"max_depth\": 4}, {\"max_leaf_nodes\": 16}]". Every candidate is fit on
+# the same training split in a pool of processes and scored on the held-out rows.
+#
+# The rows are shuffled once into a scratch-file-backed array (see ingest.scratch_array), training rows
+# first. Each worker maps that file read-only, so the matrix is in memory once, shared through the page
+# cache, and the training and holdout splits are plain slices of it rather than copies pickled to every
+# worker. Only the labels are sent to each worker, once, when it starts.
+#
+# The best candidate's parameters are then fit again on all the rows, holdout included, and that is the
+# model that is saved, unless the job sets "sweep_refit": "false" to keep the candidate as it was scored.
+
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn import tree
+
+from ingest import scratch_array
+
+# The DecisionTreeClassifier hyperparameters a sweep can vary, and how to convert their values.
+TREE_PARAMS = {
+    "max_leaf_nodes": int,
+    "max_depth": int,
+    "min_samples_split": int,
+    "min_samples_leaf": int,
+    "min_impurity_decrease": float,
+    "criterion": str,
+    "splitter": str,
+    "max_features": lambda v: v if isinstance(v, (str, float)) else int(v),
+}
+
+# Rows of the shuffled copy written at a time.
+_COPY_ROWS = 100000
+
+_worker_data = None
+
+
+def candidates_from(params):
+    """The list of candidate hyperparameter dicts described by the training job's hyperparameters, or
+    None if they describe a single model. Hyperparameters arrive as strings, so list values are JSON."""
+    if "candidates" in params:
+        return [_convert(candidate) for candidate in json.loads(params["candidates"])]
+    axes = {}
+    for name, value in params.items():
+        if name not in TREE_PARAMS:
+            continue
+        value = _decode(value)
+        axes[name] = value if isinstance(value, list) else [value]
+    if not any(len(values) > 1 for values in axes.values()):
+        return None
+    names = sorted(axes)
+    return [_convert(dict(zip(names, values))) for values in itertools.product(*[axes[name] for name in names])]
+
+
+def tree_params(params):
+    """The DecisionTreeClassifier arguments of a single model from the job's hyperparameters."""
+    return _convert({name: _decode(value) for name, value in params.items() if name in TREE_PARAMS})
+
+
+def _decode(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _convert(candidate):
+    unknown = set(candidate) - set(TREE_PARAMS)
+    if unknown:
+        raise ValueError("Cannot sweep over {}; supported: {}".format(", ".join(sorted(unknown)), ", ".join(sorted(TREE_PARAMS))))
+    return {name: None if value is None or value == "None" else TREE_PARAMS[name](value)
+            for name, value in candidate.items()}
+
+
+def refit_from(params):
+    """Whether the job's hyperparameters ask for the best candidate to be refit on all the rows."""
+    value = _decode(params.get("sweep_refit", True))
+    if not isinstance(value, bool):
+        raise ValueError("sweep_refit must be true or false, got {!r}".format(value))
+    return value
+
+
+def run(features, labels, candidates, holdout_fraction=0.2, workers=None, seed=0, refit=True):
+    """Fit every candidate on a training split, score it on the rest and refit the best on all rows.
+
+    Args:
+        features (numpy.memmap): The (n_rows, n_features) float32 matrix from ingest.read_channel.
+        labels (numpy array): One label per row.
+        candidates (list of dict): DecisionTreeClassifier arguments for each candidate.
+        holdout_fraction (float): The fraction of rows held out for scoring.
+        workers (int): The number of processes. Defaults to the number of CPUs.
+        seed (int): Seeds the split and the trees.
+        refit (bool): Fit the best candidate's parameters again on all the rows. If false, the model
+            returned is the one fitted on the training split and scored on the holdout.
+
+    Returns:
+        (best model, report): the estimator with the highest holdout accuracy (ties go to the earlier
+        candidate) and a list with the parameters, timings and score of every candidate.
+    """
+    n_rows = features.shape[0]
+    n_holdout = int(round(n_rows * holdout_fraction))
+    if not 0 < n_holdout < n_rows:
+        raise ValueError("A holdout fraction of {} leaves no rows to train or score on".format(holdout_fraction))
+    start = time.perf_counter()
+    order = np.random.default_rng(seed).permutation(n_rows)
+    shuffled = scratch_array(features.shape)
+    for i in range(0, n_rows, _COPY_ROWS):
+        shuffled[i:i + _COPY_ROWS] = features[order[i:i + _COPY_ROWS]]
+    shuffled.flush()
+    labels = np.asarray(labels)
+    print("Shuffled {} rows into a {} row training split and a {} row holdout in {:.2f}s".format(
+        n_rows, n_rows - n_holdout, n_holdout, time.perf_counter() - start))
+
+    workers = min(workers or os.cpu_count() or 1, len(candidates))
+    data = (shuffled.filename, shuffled.shape, n_rows - n_holdout, labels[order])
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(data,)) as pool:
+        results = list(pool.map(_fit_candidate, candidates, [seed] * len(candidates)))
+
+    report = [dict(result, index=i) for i, (result, _) in enumerate(results)]
+    for result in report:
+        print("candidate {index}: {params} accuracy {score:.4f}, fit {fit_seconds:.2f}s, {n_leaves} leaves".format(**result))
+    best = max(range(len(results)), key=lambda i: (results[i][0]["score"], -i))
+    print("Best candidate: {}".format(best))
+    if not refit:
+        return results[best][1], report
+    start = time.perf_counter()
+    clf = tree.DecisionTreeClassifier(random_state=seed, **candidates[best]).fit(features, labels)
+    print("Refit candidate {} on all {} rows in {:.2f}s".format(best, n_rows, time.perf_counter() - start))
+    return clf, report
+
+
+def _init_worker(data):
+    global _worker_data
+    path, shape, n_train, labels = data
+    features = np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+    _worker_data = (features[:n_train], labels[:n_train], features[n_train:], labels[n_train:])
+
+
+def _fit_candidate(params, seed):
+    train_X, train_y, holdout_X, holdout_y = _worker_data
+    start = time.perf_counter()
+    clf = tree.DecisionTreeClassifier(random_state=seed, **params).fit(train_X, train_y)
+    fitted = time.perf_counter()
+    score = clf.score(holdout_X, holdout_y)
+    result = {
+        "params": params,
+        "score": float(score),
+        "fit_seconds": fitted - start,
+        "score_seconds": time.perf_counter() - fitted,
+        "n_leaves": int(clf.get_n_leaves()),
+        "depth": int(clf.get_depth()),
+    }
+    return result, clf
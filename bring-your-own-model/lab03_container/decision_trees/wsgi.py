@@ -5,3 +5,9 @@ import predictor as myapp
 # new file.
 
 app = myapp.app
+
+# With gunicorn's --preload this module is imported once in the master, so loading the model here
+# means the forked workers start with it already in memory. In multi-model mode the top-level model is
+# optional, and only preloaded if there is one.
+if myapp.preload and (not myapp.multi_model or myapp.ScoringService.has_default_model()):
+    myapp.ScoringService.warm_up()
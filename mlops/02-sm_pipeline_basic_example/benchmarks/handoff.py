@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Serialization time and bytes moved at each step boundary of the pipeline, before and after the
+# dataset hand-off format of steps/dataset.py.
+#
+# Before: the preprocessing step's three DataFrames are pickled with cloudpickle, as @step does with
+# return values, and unpickled by the training and evaluation steps, which then copy the label out
+# and drop it before building their DMatrix. After: the splits are written as datasets, and the
+# steps memory-map them and build their DMatrix from the maps. Both are timed on synthetic splits
+# shaped like the preprocessed abalone data (1 label + 10 feature columns), at several row counts.
+#
+#     python benchmarks/handoff.py --rows 4177 1000000
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cloudpickle
+import numpy as np
+import pandas as pd
+import xgboost
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from steps.dataset import as_dataset, save  # noqa: E402
+from steps.preprocess import split_names, split_sizes  # noqa: E402
+
+N_COLUMNS = 11
+
+
+def make_splits(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_rows, N_COLUMNS))
+    X[:, 0] = rng.integers(1, 30, n_rows)
+    train_size, validation_size, _ = split_sizes(n_rows)
+    return [pd.DataFrame(split) for split in np.split(X, [train_size, train_size + validation_size])]
+
+
+def pickled(splits, directory):
+    """The old hand-off: one pickle per split, then to_numpy and drop in the consuming step."""
+    timings = {}
+    start = time.perf_counter()
+    paths = []
+    for name, split in zip(split_names, splits):
+        path = os.path.join(directory, f"{name}.pkl")
+        with open(path, "wb") as f:
+            cloudpickle.dump(split, f)
+        paths.append(path)
+    timings["preprocess"] = (time.perf_counter() - start, sum(os.path.getsize(path) for path in paths))
+
+    def consume(path):
+        with open(path, "rb") as f:
+            df = cloudpickle.load(f)
+        y = df.iloc[:, 0].to_numpy()
+        df.drop(df.columns[0], axis=1, inplace=True)
+        return xgboost.DMatrix(df.to_numpy(), label=y)
+
+    start = time.perf_counter()
+    consume(paths[0]), consume(paths[1])
+    timings["train"] = (time.perf_counter() - start, os.path.getsize(paths[0]) + os.path.getsize(paths[1]))
+    start = time.perf_counter()
+    consume(paths[2])
+    timings["evaluate"] = (time.perf_counter() - start, os.path.getsize(paths[2]))
+    return timings
+
+
+def datasets(splits, directory):
+    """The new hand-off: a dataset per split, memory-mapped by the consuming step."""
+    timings = {}
+    start = time.perf_counter()
+    written = [save(split, os.path.join(directory, name)) for name, split in zip(split_names, splits)]
+    timings["preprocess"] = (time.perf_counter() - start, sum(dataset.nbytes for dataset in written))
+    uris = [dataset.uri for dataset in written]
+
+    start = time.perf_counter()
+    train, validation = as_dataset(uris[0]), as_dataset(uris[1])
+    train.dmatrix(), validation.dmatrix()
+    timings["train"] = (time.perf_counter() - start, train.nbytes + validation.nbytes)
+    start = time.perf_counter()
+    test = as_dataset(uris[2])
+    test.dmatrix()
+    timings["evaluate"] = (time.perf_counter() - start, test.nbytes)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[4177, 100000, 1000000])
+    args = parser.parse_args()
+
+    print("{:>9} {:>10} {:>14} {:>12} {:>14} {:>12} {:>8}".format(
+        "rows", "step", "pickle s", "pickle MB", "dataset s", "dataset MB", "speedup"))
+    for n_rows in args.rows:
+        splits = make_splits(n_rows)
+        directory = tempfile.mkdtemp(prefix="handoff-")
+        try:
+            os.makedirs(os.path.join(directory, "pickle"))
+            before = pickled(splits, os.path.join(directory, "pickle"))
+            after = datasets(splits, os.path.join(directory, "datasets"))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        for step in ("preprocess", "train", "evaluate"):
+            (old_s, old_bytes), (new_s, new_bytes) = before[step], after[step]
+            print("{:>9} {:>10} {:>14.4f} {:>12.2f} {:>14.4f} {:>12.2f} {:>7.1f}x".format(
+                n_rows, step, old_s, old_bytes / 1e6, new_s, new_bytes / 1e6, old_s / max(new_s, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# Wall time, peak RSS and throughput of each step function of the pipeline (preprocess, train, evaluate,
+# register) at scale factors of the abalone dataset's 4177 rows, compared with a stored baseline.
+#
+# For each scale, a synthetic CSV with the abalone schema is written, and the steps are run on it in
+# turn, each in its own process so that its peak RSS is its own, with the local stand-ins for S3 and
+# the model registry (steps/local.py) and a local MLflow file store, all in a temporary directory.
+# The steps hand each other data as in the pipeline: dataset URIs, the booster and the report.
+# register needs the sagemaker package, and is skipped where it is not installed.
+#
+# With --save_baseline, the results are written to the baseline file. Otherwise they are compared with
+# it, and the run fails, exit status 1, if any step at any scale took longer or peaked higher than its
+# baseline by more than the tolerances. Baselines are only comparable on the same kind of machine with
+# the same packages, so if the CPU count, a package version or the streaming mode differ from the
+# baseline's, nothing is run and the benchmark exits with status 2; save a new baseline there first.
+#
+#     python benchmarks/scaling.py --scales 1 10 100 1000 --save_baseline
+#     python benchmarks/scaling.py --scales 1 10 100 1000
+
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from steps.preprocess import peak_rss_mb, split_sizes  # noqa: E402
+
+ABALONE_ROWS = 4177
+STEPS = ("preprocess", "train", "evaluate", "register")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def write_abalone(path, n_rows, seed=0, chunk_rows=500000):
+    """A headerless CSV of n_rows synthetic abalone: sex, seven measurements that grow together, and rings."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as f:
+        for start in range(0, n_rows, chunk_rows):
+            n = min(chunk_rows, n_rows - start)
+            sex = rng.choice(np.array(["M", "F", "I"]), n, p=[0.37, 0.31, 0.32])
+            age = rng.gamma(6.0, 1.7, n) + 1
+            length = np.clip(0.75 * (1 - np.exp(-age / 6)) + rng.normal(0, 0.04, n), 0.07, 0.82)
+            diameter = length * 0.78 + rng.normal(0, 0.01, n)
+            height = length * 0.27 + rng.normal(0, 0.01, n)
+            whole_weight = 2.2 * length ** 3 * (1 + rng.normal(0, 0.1, n))
+            frame = pd.DataFrame({
+                "sex": sex,
+                "length": length.round(3),
+                "diameter": diameter.round(3),
+                "height": height.round(3),
+                "whole_weight": whole_weight.round(4),
+                "shucked_weight": (whole_weight * rng.uniform(0.38, 0.48, n)).round(4),
+                "viscera_weight": (whole_weight * rng.uniform(0.19, 0.24, n)).round(4),
+                "shell_weight": (whole_weight * rng.uniform(0.26, 0.32, n)).round(4),
+                "rings": np.maximum(1, np.round(age + rng.normal(0, 1.5, n))).astype(int),
+            })
+            frame.to_csv(f, header=False, index=False)
+
+
+def use_local_services(directory):
+    os.environ["LOCAL_S3_ROOT"] = os.path.join(directory, "s3")
+    os.environ["LOCAL_MODEL_REGISTRY"] = os.path.join(directory, "model-registry")
+    os.environ["MLFLOW_TRACKING_URI"] = "file://" + os.path.join(directory, "mlruns")
+    # MLflow 3 refuses file stores unless this is set.
+    os.environ["MLFLOW_ALLOW_FILE_STORE"] = "true"
+
+
+def run_step(step, directory, scale, run_id, streaming):
+    """Run one step in this process on the outputs of the previous ones, and print its measurements."""
+    use_local_services(directory)
+    scale_dir = os.path.join(directory, f"{scale}x")
+    n_rows = ABALONE_ROWS * scale
+    train_rows, validation_rows, test_rows = split_sizes(n_rows)
+    # The step's modules are imported before it is timed, as they are before a SageMaker step runs.
+    import xgboost
+    from steps.evaluation import evaluate
+    from steps.preprocess import preprocess
+    from steps.train import train
+    if step == "register":
+        try:
+            from steps.register import register
+        except ImportError as e:
+            print(json.dumps({"skipped": f"cannot import the register step: {e}"}))
+            return
+
+    result = {}
+    start = time.perf_counter()
+    if step == "preprocess":
+        uris = preprocess(
+            os.path.join(scale_dir, "abalone.csv"), run_id=run_id, streaming=streaming, seed=0,
+            output_uri=f"s3://bench/datasets/{scale}x",
+        )
+        result["rows"] = n_rows
+        outputs = {"splits.json": json.dumps(uris)}
+    elif step == "train":
+        with open(os.path.join(scale_dir, "splits.json")) as f:
+            uris = json.load(f)
+        booster = train(uris[0], uris[1], run_id=run_id, seed=0)
+        result["rows"] = train_rows + validation_rows
+        outputs = {"model.ubj": bytes(booster.save_raw("ubj"))}
+    elif step == "evaluate":
+        with open(os.path.join(scale_dir, "splits.json")) as f:
+            uris = json.load(f)
+        booster = xgboost.Booster(model_file=os.path.join(scale_dir, "model.ubj"))
+        report = evaluate(booster, uris[2], run_id=run_id)
+        result["rows"] = test_rows
+        outputs = {"evaluation.json": json.dumps(report)}
+    else:
+        booster = xgboost.Booster(model_file=os.path.join(scale_dir, "model.ubj"))
+        with open(os.path.join(scale_dir, "evaluation.json")) as f:
+            report = json.load(f)
+        register(booster, report, "PendingManualApproval", "abalone-benchmark", "bench", run_id=run_id)
+        result["rows"] = train_rows + validation_rows
+        outputs = {}
+    result["seconds"] = time.perf_counter() - start
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["rows_per_second"] = result["rows"] / max(result["seconds"], 1e-9)
+    for name, content in outputs.items():
+        with open(os.path.join(scale_dir, name), "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+    print(json.dumps(result))
+
+
+def environment():
+    import sklearn
+    import xgboost
+
+    versions = {
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scikit-learn": sklearn.__version__,
+        "xgboost": xgboost.__version__,
+    }
+    # MLflow's autologging costs the steps seconds and hundreds of MB, more with the integrations it
+    # finds installed, and register only runs with sagemaker, so these change the results too.
+    for package in ("mlflow", "mlflow-skinny", "sagemaker", "sagemaker-core", "s3fs"):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def baseline_differences(stored, streaming):
+    """What about this run differs from the stored baseline's, so that its results are not comparable."""
+    current = environment()
+    differences = [
+        f"{key}: {stored['environment'].get(key)}, here {current.get(key)}"
+        for key in sorted(set(stored["environment"]) | set(current))
+        if stored["environment"].get(key) != current.get(key)
+    ]
+    if stored["streaming"] != streaming:
+        differences.append(f"streaming: {stored['streaming']}, here {streaming}")
+    return differences
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, min_seconds, min_rss_mb):
+    """The measurements of results that are worse than baseline's beyond the tolerances."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None or "seconds" not in result or "seconds" not in base:
+            continue
+        if result["seconds"] > base["seconds"] * (1 + time_tolerance) + min_seconds:
+            regressions.append(f"{key}: {result['seconds']:.2f}s, baseline {base['seconds']:.2f}s")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + memory_tolerance) + min_rss_mb:
+            regressions.append(f"{key}: peak RSS {result['peak_rss_mb']:.0f} MB, baseline {base['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--steps", nargs="+", default=list(STEPS), choices=STEPS,
+                        help="steps to measure; the steps before them run too, for their outputs")
+    parser.add_argument("--streaming", action="store_true", help="preprocess with streaming=True")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save_baseline", action="store_true", help="write the results as the baseline")
+    parser.add_argument("--time_tolerance", type=float, default=0.3, help="fraction slower than the baseline allowed")
+    parser.add_argument("--memory_tolerance", type=float, default=0.2, help="fraction more peak RSS allowed")
+    parser.add_argument("--min_seconds", type=float, default=1.0, help="slowdown always allowed, for noise")
+    parser.add_argument("--min_rss_mb", type=float, default=30.0, help="peak RSS increase always allowed")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--run", choices=STEPS, help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--run_id", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_step(args.run, args.dir, args.scale, args.run_id, args.streaming)
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored["results"]
+        differences = baseline_differences(stored, args.streaming)
+        if differences:
+            print(f"{args.baseline} is not comparable with this run:")
+            for difference in differences:
+                print("  " + difference)
+            print("Re-baseline here with --save_baseline, or pass --baseline with a baseline from this environment")
+            sys.exit(2)
+
+    directory = tempfile.mkdtemp(prefix="scaling-")
+    results = {}
+    try:
+        use_local_services(directory)
+        import mlflow
+
+        mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+        mlflow.set_experiment("sm-id-pipeline-experiment")
+        with mlflow.start_run(run_name="scaling-benchmark") as run:
+            run_id = run.info.run_id
+
+        print("{:>6} {:>9} {:<11} {:>9} {:>12} {:>12} {:>10} {:>9}".format(
+            "scale", "rows", "step", "seconds", "peak RSS MB", "rows/s", "baseline s", "change"))
+        for scale in args.scales:
+            scale_dir = os.path.join(directory, f"{scale}x")
+            os.makedirs(scale_dir)
+            write_abalone(os.path.join(scale_dir, "abalone.csv"), ABALONE_ROWS * scale)
+            for step in STEPS[:max(STEPS.index(step) for step in args.steps) + 1]:
+                command = [sys.executable, __file__, "--run", step, "--dir", directory, "--scale", str(scale),
+                           "--run_id", run_id] + (["--streaming"] if args.streaming else [])
+                completed = subprocess.run(command, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    sys.stderr.write(completed.stderr)
+                    raise SystemExit(f"{step} failed at {scale}x")
+                if step not in args.steps:
+                    continue
+                key = f"{step}@{scale}x"
+                results[key] = result = json.loads(completed.stdout.splitlines()[-1])
+                if "skipped" in result:
+                    print("{:>6} {:>9} {:<11} skipped: {}".format(f"{scale}x", ABALONE_ROWS * scale, step, result["skipped"]))
+                    continue
+                base = baseline.get(key, {}).get("seconds")
+                print("{:>6} {:>9} {:<11} {:>9.2f} {:>12.0f} {:>12.0f} {:>10} {:>9}".format(
+                    f"{scale}x", ABALONE_ROWS * scale, step, result["seconds"], result["peak_rss_mb"],
+                    result["rows_per_second"], "" if base is None else f"{base:.2f}",
+                    "" if base is None else f"{result['seconds'] / base - 1:+.0%}"))
+            shutil.rmtree(os.path.join(directory, "s3", "bench", "datasets", f"{scale}x"), ignore_errors=True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    document = {"environment": environment(), "streaming": args.streaming, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(document, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return
+    if not baseline:
+        print(f"No baseline at {args.baseline}; save one with --save_baseline")
+        return
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.min_seconds, args.min_rss_mb)
+    if regressions:
+        print("Regressions against the baseline:")
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
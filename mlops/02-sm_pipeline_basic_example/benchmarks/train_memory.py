@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Peak memory and wall time of the training step's data modes (see steps/train.py build_dmatrices).
+#
+# Writes synthetic train and validation datasets shaped like the preprocessed abalone data, in
+# shards, then trains on them once per data mode, each in its own process so that its peak RSS is
+# its own, with train()'s default hyperparameters and early stopping. Also prints the best
+# validation RMSE and the number of rounds, which should be about the same for every mode.
+#
+#     python benchmarks/train_memory.py --rows 2000000 --modes memory quantile external
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import xgboost
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from steps.dataset import DatasetWriter, load  # noqa: E402
+from steps.train import build_dmatrices, data_modes, peak_rss_mb  # noqa: E402
+
+N_FEATURES = 10
+
+# train()'s defaults
+PARAMS = {
+    "objective": "reg:squarederror",
+    "max_depth": 5,
+    "eta": 0.2,
+    "gamma": 4,
+    "min_child_weight": 6,
+    "subsample": 0.7,
+    "max_bin": 256,
+    "tree_method": "hist",
+}
+
+
+def write_dataset(uri, n_rows, shard_rows, seed):
+    rng = np.random.default_rng(seed)
+    coefficients = np.linspace(1, 3, N_FEATURES)
+    writer = DatasetWriter(uri)
+    for start in range(0, n_rows, shard_rows):
+        features = rng.standard_normal((min(shard_rows, n_rows - start), N_FEATURES)).astype(np.float32)
+        label = 10 + features @ coefficients + rng.standard_normal(len(features))
+        writer.write(label, features)
+    return writer.close()
+
+
+def run(mode, directory, num_round, batch_rows):
+    start = time.perf_counter()
+    train_dmatrix, validation_dmatrix = build_dmatrices(
+        load(os.path.join(directory, "train")), load(os.path.join(directory, "validation")),
+        mode, PARAMS["max_bin"], batch_rows, os.path.join(directory, "cache", mode),
+    )
+    results = {}
+    booster = xgboost.train(
+        PARAMS, train_dmatrix, num_round,
+        evals=[(train_dmatrix, "train"), (validation_dmatrix, "validation")],
+        early_stopping_rounds=5, evals_result=results, verbose_eval=False,
+    )
+    print(json.dumps({
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss_mb(),
+        "validation_rmse": booster.best_score,
+        "rounds": booster.best_iteration + 1,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--shard-rows", type=int, default=100000)
+    parser.add_argument("--batch-rows", type=int, default=None)
+    parser.add_argument("--num-round", type=int, default=50)
+    parser.add_argument("--modes", nargs="+", default=list(data_modes), choices=data_modes)
+    parser.add_argument("--run", choices=data_modes, help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run(args.run, args.dir, args.num_round, args.batch_rows)
+
+    directory = tempfile.mkdtemp(prefix="train-memory-")
+    try:
+        train = write_dataset(os.path.join(directory, "train"), args.rows, args.shard_rows, seed=0)
+        write_dataset(os.path.join(directory, "validation"), args.rows * 15 // 70, args.shard_rows, seed=1)
+        print(f"{args.rows} training rows, {train.nbytes / 1e6:.0f} MB in {len(train.manifest['shards'])} shards")
+        print("{:>10} {:>10} {:>14} {:>16} {:>8}".format("mode", "seconds", "peak RSS MB", "validation rmse", "rounds"))
+        for mode in args.modes:
+            command = [sys.executable, __file__, "--run", mode, "--dir", directory, "--num-round", str(args.num_round)]
+            if args.batch_rows:
+                command += ["--batch-rows", str(args.batch_rows)]
+            result = json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout.splitlines()[-1])
+            print("{:>10} {:>10.2f} {:>14.0f} {:>16.4f} {:>8}".format(
+                mode, result["seconds"], result["peak_rss_mb"], result["validation_rmse"], result["rounds"]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Wall time of the training step's tuning mode (see steps/tuning.py) at several numbers of workers,
+# and a check that the outcome does not depend on them.
+#
+# Trains the same random candidates by successive halving on synthetic data shaped like the
+# preprocessed abalone data, once per number of workers, and fails, exit status 1, unless every run
+# ranks the candidates in the same order with the same validation RMSEs and returns the same booster.
+#
+#     python benchmarks/tuning.py --rows 200000 --candidates 27 --workers 1 2 4 8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import xgboost
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from steps.tuning import sample_candidates, successive_halving  # noqa: E402
+
+N_FEATURES = 10
+
+# train()'s defaults that the candidates do not override
+PARAMS = {"objective": "reg:squarederror", "max_bin": 256, "tree_method": "hist"}
+
+
+def make_dmatrices(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((rows, N_FEATURES)).astype(np.float32)
+    y = X @ rng.standard_normal(N_FEATURES) + np.sin(3 * X[:, 0]) + rng.standard_normal(rows)
+    n_train = rows * 4 // 5
+    train = xgboost.QuantileDMatrix(X[:n_train], label=y[:n_train], max_bin=PARAMS["max_bin"])
+    validation = xgboost.QuantileDMatrix(X[n_train:], label=y[n_train:], ref=train)
+    return train, validation
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--candidates", type=int, default=27)
+    parser.add_argument("--num_round", type=int, default=100)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    train, validation = make_dmatrices(args.rows, args.seed)
+    candidates = sample_candidates(args.candidates, seed=args.seed)
+    print("{:>8} {:>9} {:>10} {:>12}".format("workers", "seconds", "best RMSE", "best rounds"))
+    outcomes = {}
+    for workers in args.workers:
+        start = time.perf_counter()
+        booster, results = successive_halving(
+            PARAMS, candidates, train, validation, args.num_round, workers=workers, seed=args.seed
+        )
+        seconds = time.perf_counter() - start
+        print("{:>8} {:>9.2f} {:>10.5f} {:>12}".format(
+            workers, seconds, results[0]["validation_rmse"], results[0]["best_rounds"]))
+        outcomes[workers] = (
+            [(result["candidate"], result["validation_rmse"], result["rounds"]) for result in results],
+            bytes(booster.save_raw("ubj")),
+        )
+
+    different = [workers for workers, outcome in outcomes.items() if outcome != outcomes[args.workers[0]]]
+    if different:
+        print(f"The ranking or the best booster with {different} workers differs from that with {args.workers[0]}")
+        sys.exit(1)
+    print(f"The same ranking and best booster with {', '.join(map(str, args.workers))} workers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Model packaging and upload time of the register step, before and after steps/packaging.py, against
+# the local S3 stand-in of steps/local.py with simulated network costs: each request takes --latency
+# seconds plus its bytes over --bandwidth MB/s, and concurrent requests share nothing, as uploads of
+# separate parts to S3 mostly don't.
+#
+# Before: the model is saved to a temporary file, archived to another with tarfile's "w:gz", read back
+# whole and written through the filesystem, which s3fs uploads in 50 MB parts, one after the other.
+# After: the archive is streamed through the compressor into a MultipartUpload. Both are run on XGBoost
+# models of several sizes, and the streaming path with each codec and level.
+#
+# Peak memory is that of Python's allocations, from tracemalloc. It counts the model's serialized bytes
+# in the streaming path, where Booster.save_raw returns them, but not in the temporary file path, where
+# save_model holds them in XGBoost's own memory.
+#
+#     python benchmarks/upload.py --rounds 100 1000 --latency 0.05 --bandwidth 50
+
+import argparse
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import xgboost
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from steps.local import LocalS3Client, LocalS3FileSystem  # noqa: E402
+from steps.packaging import archive_name, upload_model_archive  # noqa: E402
+
+# The part size of s3fs's buffered writes.
+S3FS_BLOCK_SIZE = 50 * 1024 ** 2
+
+
+class SlowS3Client(LocalS3Client):
+    """LocalS3Client with the time a request would take over the network added to each call."""
+
+    def __init__(self, fs):
+        super().__init__(fs)
+        for name in ("put_object", "create_multipart_upload", "upload_part", "complete_multipart_upload",
+                     "abort_multipart_upload"):
+            setattr(self, name, self._slow(getattr(self, name)))
+
+    def _slow(self, call):
+        def slow_call(**kwargs):
+            self.fs._transfer(len(kwargs.get("Body", b"")))
+            return call(**kwargs)
+
+        return slow_call
+
+
+class SlowS3FileSystem(LocalS3FileSystem):
+    """LocalS3FileSystem with the time a request would take over the network added to each one."""
+
+    def __init__(self, root, latency, bandwidth):
+        super().__init__(root)
+        self.s3 = SlowS3Client(self)
+        self.latency = latency
+        self.bytes_per_second = bandwidth * 1e6
+
+    def _transfer(self, n_bytes):
+        time.sleep(self.latency + n_bytes / self.bytes_per_second)
+
+    def open(self, uri, mode="rb"):
+        f = super().open(uri, mode)
+        if "w" not in mode:
+            return f
+        fs, close = self, f.close
+
+        def close_after_upload():
+            # s3fs uploads a part per block as the buffer fills, and the rest on close, in turn.
+            size = f.tell()
+            for start in range(0, max(size, 1), S3FS_BLOCK_SIZE):
+                fs._transfer(min(S3FS_BLOCK_SIZE, size - start))
+            close()
+
+        f.close = close_after_upload
+        return f
+
+
+def make_model(rounds, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((20000, 10))
+    y = X @ rng.standard_normal(10) + rng.standard_normal(20000)
+    return xgboost.train({"max_depth": 8, "eta": 0.05, "nthread": 1}, xgboost.DMatrix(X, label=y), rounds)
+
+
+def temp_file_upload(model, fs, uri):
+    """The old path of the register step."""
+    tmp_dir = tempfile.mkdtemp()
+    native_model_path = os.path.join(tmp_dir, "xgboost-model")
+    model.save_model(native_model_path)
+    model_tar_path = tempfile.mktemp(suffix=".tar.gz")
+    with tarfile.open(model_tar_path, "w:gz") as tar:
+        tar.add(native_model_path, arcname="xgboost-model")
+    with fs.open(uri, "wb") as f:
+        with open(model_tar_path, "rb") as local_f:
+            f.write(local_f.read())
+    size = os.path.getsize(model_tar_path)
+    shutil.rmtree(tmp_dir)
+    os.remove(model_tar_path)
+    return size
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, nargs="+", default=[100, 1000, 3000])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--bandwidth", type=float, default=50.0, help="MB/s per request")
+    parser.add_argument("--part_mb", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="upload-")
+    fs = SlowS3FileSystem(root, args.latency, args.bandwidth)
+    options = [("gz", 1), ("gz", 6), ("gz", 9), ("xz", 6), ("bz2", 9), ("none", 0)]
+    print("{:>7} {:>9} {:<10} {:>10} {:>10} {:>14} {:>8}".format(
+        "rounds", "model MB", "path", "archive MB", "seconds", "py alloc MB", "speedup"))
+    try:
+        for rounds in args.rounds:
+            model = make_model(rounds)
+            model_mb = len(model.save_raw("ubj")) / 1e6
+            archive_bytes, base_seconds, peak = measure(lambda: temp_file_upload(model, fs, "s3://bench/old/model.tar.gz"))
+            print("{:>7} {:>9.1f} {:<10} {:>10.2f} {:>10.2f} {:>14.1f} {:>8}".format(
+                rounds, model_mb, "temp file", archive_bytes / 1e6, base_seconds, peak / 1e6, ""))
+            for codec, level in options:
+                uri = f"s3://bench/new/{archive_name(codec)}"
+                upload, seconds, peak = measure(lambda: upload_model_archive(
+                    model, fs, uri, codec, level, args.part_mb * 1024 ** 2, args.workers
+                ))
+                print("{:>7} {:>9.1f} {:<10} {:>10.2f} {:>10.2f} {:>14.1f} {:>7.1f}x".format(
+                    rounds, model_mb, f"{codec}:{level}", upload["archive_bytes"] / 1e6, seconds, peak / 1e6,
+                    base_seconds / seconds))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
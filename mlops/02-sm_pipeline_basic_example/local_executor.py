@@ -0,0 +1,171 @@
+import concurrent.futures
+import json
+import multiprocessing
+import resource
+import time
+
+import cloudpickle
+
+# Runs the pipeline's steps on this machine instead of SageMaker. step() here has the interface of
+# sagemaker.mlops.workflow.function_step.step, so pipeline.build_pipeline_steps builds the same DAG
+# with either: calling a step records a Node, with the Nodes it takes outputs of as its dependencies,
+# and indexing a Node refers to an element of its output, as with SageMaker's DelayedReturn.
+#
+# run() executes the DAG in a process pool, each step as soon as the steps it depends on are done, so
+# independent steps run concurrently, up to workers at a time (the number of CPUs by default). Each
+# step runs in a fresh process, as each SageMaker step runs in its own job, with its function and
+# arguments serialized with cloudpickle as SageMaker does. The profile of a run gives, for each step,
+# its wall time, its peak RSS, how long it waited for a worker, and the bytes of its serialized
+# arguments and result.
+
+
+class Node:
+    def __init__(self, fn, name, args, kwargs):
+        self.fn = fn
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def __getitem__(self, index):
+        return Output(self, index)
+
+    def __repr__(self):
+        return f"Node({self.name!r})"
+
+    def dependencies(self):
+        return _nodes_in((self.args, self.kwargs))
+
+
+class Output:
+    """An element of the output of a Node."""
+
+    def __init__(self, node, index):
+        self.node = node
+        self.index = index
+
+
+def step(fn, name=None, **_):
+    """Record calls of fn as Nodes of the DAG. Other arguments of SageMaker's step, such as instance
+    types, do not apply locally and are ignored."""
+
+    def record(*args, **kwargs):
+        return Node(fn, name or fn.__name__, args, kwargs)
+
+    return record
+
+
+def _nodes_in(value):
+    if isinstance(value, Node):
+        return [value]
+    if isinstance(value, Output):
+        return [value.node]
+    if isinstance(value, (list, tuple)):
+        return [node for item in value for node in _nodes_in(item)]
+    if isinstance(value, dict):
+        return [node for item in value.values() for node in _nodes_in(item)]
+    return []
+
+
+def _resolve(value, results):
+    if isinstance(value, Node):
+        return results[value]
+    if isinstance(value, Output):
+        return results[value.node][value.index]
+    if isinstance(value, list):
+        return [_resolve(item, results) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_resolve(item, results) for item in value)
+    if isinstance(value, dict):
+        return {key: _resolve(item, results) for key, item in value.items()}
+    return value
+
+
+def graph(*final_nodes):
+    """Every Node that final_nodes depend on, and themselves, with each after its dependencies."""
+    ordered, seen = [], set()
+
+    def visit(node):
+        if node in seen:
+            return
+        seen.add(node)
+        for dependency in node.dependencies():
+            visit(dependency)
+        ordered.append(node)
+
+    for node in final_nodes:
+        visit(node)
+    return ordered
+
+
+def _run_step(payload, submitted):
+    started = time.time()
+    fn, args, kwargs = cloudpickle.loads(payload)
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    data = cloudpickle.dumps(result)
+    return data, {
+        "started": started,
+        "queued_seconds": started - submitted,
+        "seconds": seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "result_bytes": len(data),
+    }
+
+
+def run(*final_nodes, workers=None):
+    """Run the DAG that final_nodes are the last steps of.
+
+    Returns:
+        (results, profile): the result of each Node, and the profile of the run, a dict with the
+        "wall_seconds" of the whole run and a "steps" entry per step, in the order they finished.
+    """
+    nodes = graph(*final_nodes)
+    results, profile = {}, {"steps": []}
+    pending = {node: set(node.dependencies()) for node in nodes}
+    # A new process per step. They are forked from a server process that has imported the steps'
+    # modules once, rather than each importing pandas, scikit-learn and XGBoost again, which takes
+    # longer than running the steps on small data.
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(sorted({node.fn.__module__ for node in nodes} - {"__main__"}))
+    start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, max_tasks_per_child=1) as pool:
+        running = {}
+
+        def submit_ready():
+            for node in [node for node, dependencies in pending.items() if not dependencies]:
+                del pending[node]
+                payload = cloudpickle.dumps((node.fn, _resolve(node.args, results), _resolve(node.kwargs, results)))
+                future = pool.submit(_run_step, payload, time.time())
+                running[future] = (node, len(payload))
+
+        submit_ready()
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                node, argument_bytes = running.pop(future)
+                data, timings = future.result()
+                results[node] = cloudpickle.loads(data)
+                profile["steps"].append(dict(
+                    timings, name=node.name, started=timings["started"] - start, argument_bytes=argument_bytes
+                ))
+                for dependencies in pending.values():
+                    dependencies.discard(node)
+            submit_ready()
+    profile["wall_seconds"] = time.time() - start
+    return results, profile
+
+
+def print_profile(profile):
+    print("{:<32} {:>9} {:>9} {:>9} {:>12} {:>12} {:>12}".format(
+        "step", "start s", "wall s", "queued s", "peak RSS MB", "args bytes", "result bytes"))
+    for entry in profile["steps"]:
+        print("{:<32} {:>9.2f} {:>9.2f} {:>9.2f} {:>12.0f} {:>12} {:>12}".format(
+            entry["name"], entry["started"], entry["seconds"], entry["queued_seconds"],
+            entry["peak_rss_mb"], entry["argument_bytes"], entry["result_bytes"]))
+    print(f"pipeline wall time {profile['wall_seconds']:.2f}s")
+
+
+def write_profile(profile, path):
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
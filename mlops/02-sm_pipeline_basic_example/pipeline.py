@@ -10,9 +10,53 @@ from steps.preprocess import preprocess
 from steps.train import train
 from steps.evaluation import evaluate
 from steps.register import register
+from steps.cache import StepCache, cached
+import local_executor
 
 import mlflow
 
+def build_pipeline_steps(step, input_path, bucket, pipeline_name, run_id, model_approval_status,
+                         model_package_group_name, cache=None):
+    """Define the steps with step, which is SageMaker's or local_executor's, and return the last one."""
+    # The splits are handed to the next steps as datasets on S3, not as pickled DataFrames.
+    data = step(cached(preprocess, cache), name="Abalone_Data_Preprocessing")(
+        input_path,
+        run_id=run_id,
+        output_uri=f"s3://{bucket}/{pipeline_name}/datasets/{run_id}",
+    )
+
+    model = step(cached(train, cache), name="Model_Training")(
+        train_df=data[0],
+        validation_df=data[1],
+        run_id=run_id
+    )
+
+    evaluation_result = step(cached(evaluate, cache), name="Model_Evaluation")(
+        model=model,
+        test_df=data[2],
+        run_id=run_id
+    )
+
+    # Registering is not cached: its point is its side effect, a new model package, which a cache hit
+    # would skip while reporting success.
+    return step(register, name="Model_Registration")(
+        model=model,
+        evaluation=evaluation_result,
+        model_approval_status=model_approval_status,
+        model_package_group_name=model_package_group_name,
+        bucket=bucket,
+        run_id=run_id
+    )
+
+
+def use_local_services(root):
+    """Point the steps at the local stand-ins for S3, MLflow and the model registry under root."""
+    root = os.path.abspath(root)
+    os.environ["LOCAL_S3_ROOT"] = os.path.join(root, "s3")
+    os.environ["LOCAL_MODEL_REGISTRY"] = os.path.join(root, "model-registry")
+    os.environ.setdefault("MLFLOW_TRACKING_URI", "file://" + os.path.join(root, "mlruns"))
+
+
 if __name__ == "__main__":
     os.environ["SAGEMAKER_USER_CONFIG_OVERRIDE"] = os.getcwd()
 
@@ -20,57 +64,74 @@ if __name__ == "__main__":
     parser.add_argument('--mlflow_tracking_uri', help='MLflow tracking server URI')
     parser.add_argument('--mlflow_experiment_name', help='mlflow_experiment_name')
     parser.add_argument('--sagemaker_pipeline_name', help='name of the SageMaker Pipeline', default="abalone-sm-pipeline-new-sdk")
+    parser.add_argument('--step_cache_uri', help='where to cache step results (default: s3://<default bucket>/<pipeline name>/step-cache)')
+    parser.add_argument('--step_cache_max_gb', help='size to evict the step cache down to', type=float, default=10.0)
+    parser.add_argument('--no_step_cache', help='always run every step', action='store_true')
+    parser.add_argument('--local', help='run the steps on this machine, with local stand-ins for S3, MLflow and the model registry', action='store_true')
+    parser.add_argument('--local_root', help='directory of the local stand-ins', default='.local-pipeline')
+    parser.add_argument('--local_workers', help='steps to run at once locally', type=int, default=None)
+    parser.add_argument('--input_path', help='the abalone CSV file (default: the SageMaker example file on S3)')
     args = parser.parse_args()
 
-    sagemaker_session = Session()
-
-    bucket = sagemaker_session.default_bucket()
-    input_path = (f"s3://sagemaker-example-files-prod-{sagemaker_session.boto_region_name}/datasets"
-                  f"/tabular/uci_abalone/abalone.csv")
-
     model_pkg_group_name = "abalone-model-new-sdk"
-    model_approval_status_param = ParameterString(name="ModelApprovalStatus", default_value="PendingManualApproval")
 
-    mlflow.set_tracking_uri(args.mlflow_tracking_uri)
+    if args.local:
+        if not args.input_path:
+            parser.error("--local needs --input_path, a local copy of the abalone CSV file")
+        if args.mlflow_tracking_uri:
+            os.environ["MLFLOW_TRACKING_URI"] = args.mlflow_tracking_uri
+        use_local_services(args.local_root)
+        bucket = "local-bucket"
+        input_path = args.input_path
+        model_approval_status_param = "PendingManualApproval"
+        tracking_uri = os.environ["MLFLOW_TRACKING_URI"]
+    else:
+        sagemaker_session = Session()
+
+        bucket = sagemaker_session.default_bucket()
+        input_path = args.input_path or (f"s3://sagemaker-example-files-prod-{sagemaker_session.boto_region_name}/datasets"
+                                         f"/tabular/uci_abalone/abalone.csv")
+        model_approval_status_param = ParameterString(name="ModelApprovalStatus", default_value="PendingManualApproval")
+        tracking_uri = args.mlflow_tracking_uri
+
+    # Steps whose code, arguments and input data are unchanged since a previous run are skipped, and
+    # their results taken from the cache.
+    cache = None
+    if not args.no_step_cache:
+        cache = StepCache(
+            args.step_cache_uri or f"s3://{bucket}/{args.sagemaker_pipeline_name}/step-cache",
+            max_bytes=int(args.step_cache_max_gb * 1024 ** 3),
+        )
+
+    mlflow.set_tracking_uri(tracking_uri)
     mlflow.set_experiment(args.mlflow_experiment_name)
 
     with mlflow.start_run(run_name=args.sagemaker_pipeline_name) as run:
         run_id = run.info.run_id
         print(run)
 
-        data = step(preprocess, name="Abalone_Data_Preprocessing")(
-            input_path,
-            run_id=run_id
-        )
-
-        model = step(train, name="Model_Training")(
-            train_df=data[0],
-            validation_df=data[1],
-            run_id=run_id
-        )
-
-        evaluation_result = step(evaluate, name="Model_Evaluation")(
-            model=model,
-            test_df=data[2],
-            run_id=run_id
-        )
-
-        model_register = step(register, name="Model_Registration")(
-            model=model,
-            evaluation=evaluation_result,
-            model_approval_status=model_approval_status_param,
-            model_package_group_name=model_pkg_group_name,
-            bucket=bucket,
-            run_id=run_id
-        )
-
-        pipeline = Pipeline(
-            name=args.sagemaker_pipeline_name,
-            parameters=[model_approval_status_param],
-            steps=[model_register],
-        )
-
-        pipeline.upsert(
-            role_arn=get_execution_role()
-        )
-        pipeline.start()
\ No newline at end of file
+        if args.local:
+            model_register = build_pipeline_steps(
+                local_executor.step, input_path, bucket, args.sagemaker_pipeline_name, run_id,
+                model_approval_status_param, model_pkg_group_name, cache,
+            )
+            results, profile = local_executor.run(model_register, workers=args.local_workers)
+            local_executor.print_profile(profile)
+            local_executor.write_profile(profile, os.path.join(args.local_root, "profile.json"))
+            print(f"Registered Model Package ARN: {results[model_register]}")
+        else:
+            model_register = build_pipeline_steps(
+                step, input_path, bucket, args.sagemaker_pipeline_name, run_id,
+                model_approval_status_param, model_pkg_group_name, cache,
+            )
+
+            pipeline = Pipeline(
+                name=args.sagemaker_pipeline_name,
+                parameters=[model_approval_status_param],
+                steps=[model_register],
+            )
+
+            pipeline.upsert(
+                role_arn=get_execution_role()
+            )
+            pipeline.start()
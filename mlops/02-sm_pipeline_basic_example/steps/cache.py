@@ -0,0 +1,258 @@
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+
+import cloudpickle
+import numpy as np
+import pandas as pd
+import xgboost
+import mlflow
+
+from steps.local import s3_filesystem
+
+# A cache of the results of the pipeline's steps, keyed by everything a result depends on:
+#
+#     sha256(step name, code version, arguments, fingerprints of the input data)
+#
+# The code version is a hash of the sources of the step's package, so that changing any step or helper
+# misses. Input data is fingerprinted by content for local files, by ETag for S3 objects, and by
+# value for DataFrames, arrays and XGBoost models, so a step whose inputs come from a cache hit upstream
+# gets the same key too. An entry is a pickled result and a small JSON record of its size and last use,
+# which is what the least recently used entries are evicted by when the cache grows over max_bytes.
+CACHE_VERSION = 1
+
+# Arguments that identify a run, or say where to write a result, rather than change it. A hit on a
+# step that wrote datasets returns the URIs they were written to then, which are checked to still exist.
+IGNORED_ARGUMENTS = ("run_id", "experiment_name", "output_uri")
+
+_file_fingerprints = {}  # (path, size, mtime_ns) -> sha256 of the file, so each file is read once
+
+
+class StepCache:
+    """A cache of step results in a local directory or under an S3 prefix.
+
+    Args:
+        uri (str): A directory, or an s3:// prefix (see steps/local.py to use a local stand-in for S3).
+        max_bytes (int): The size to evict entries down to after each new one, None for no limit.
+    """
+
+    def __init__(self, uri, max_bytes=None):
+        self.uri = uri.rstrip("/")
+        self.max_bytes = max_bytes
+        self._fs = None
+
+    def __getstate__(self):
+        # The cache is pickled along with the steps it wraps, but not its connection to S3.
+        return dict(self.__dict__, _fs=None)
+
+    @property
+    def fs(self):
+        if self._fs is None:
+            self._fs = s3_filesystem() if self.uri.startswith("s3://") else _LocalFileSystem()
+        return self._fs
+
+    def _path(self, key, suffix):
+        return f"{self.uri}/{key}{suffix}"
+
+    def get(self, key):
+        """(True, result) for a cached key, (False, None) otherwise."""
+        try:
+            with self.fs.open(self._path(key, ".pkl"), "rb") as f:
+                result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+        self._write_record(key, self._read_record(key) or {"size": 0})
+        return True, result
+
+    def put(self, key, result, step_name=None):
+        data = cloudpickle.dumps(result)
+        with self.fs.open(self._path(key, ".pkl"), "wb") as f:
+            f.write(data)
+        self._write_record(key, {"size": len(data), "step": step_name, "created": time.time()})
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def _read_record(self, key):
+        try:
+            return json.loads(self.fs.cat(self._path(key, ".json")))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_record(self, key, record):
+        with self.fs.open(self._path(key, ".json"), "wb") as f:
+            f.write(json.dumps(dict(record, last_used=time.time())).encode("utf-8"))
+
+    def entries(self):
+        """The record of every entry, with its key, least recently used first."""
+        if not self.fs.exists(self.uri):
+            return []
+        entries = []
+        for path in self.fs.find(self.uri):
+            if path.endswith(".json"):
+                key = os.path.basename(path)[:-len(".json")]
+                record = self._read_record(key)
+                if record is not None:
+                    entries.append(dict(record, key=key))
+        return sorted(entries, key=lambda entry: entry["last_used"])
+
+    def evict(self, max_bytes):
+        """Remove the least recently used entries until the cache holds at most max_bytes."""
+        entries = self.entries()
+        total = sum(entry["size"] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            self.fs.rm(self._path(entry["key"], ".pkl"))
+            self.fs.rm(self._path(entry["key"], ".json"))
+            total -= entry["size"]
+            evicted.append(entry["key"])
+        return evicted
+
+
+class _LocalFileSystem:
+    """The methods of the S3 filesystems that StepCache uses, on local paths."""
+
+    def open(self, path, mode="rb"):
+        if "w" in mode:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def cat(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def find(self, path):
+        return sorted(glob.glob(os.path.join(path, "*")))
+
+    def rm(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def code_version(fn):
+    """A hash of the sources of the package that fn is defined in."""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(inspect.getfile(fn))), "*.py"))):
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _file_fingerprint(path):
+    stat = os.stat(path)
+    cache_key = (path, stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _file_fingerprints:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _file_fingerprints[cache_key] = digest.hexdigest()
+    return _file_fingerprints[cache_key]
+
+
+def fingerprint(value):
+    """A string that changes whenever value, or the data it refers to, does."""
+    if isinstance(value, str):
+        if value.startswith("s3://"):
+            fs = s3_filesystem()
+            if fs.exists(value):
+                # An object, or every object under a prefix, such as a dataset written by a step.
+                infos = [fs.info(path) for path in fs.find(value)]
+                return json.dumps([value] + [(info.get("ETag"), info.get("size", info.get("Size"))) for info in infos])
+        elif os.path.isfile(value):
+            return json.dumps([value, _file_fingerprint(value)])
+        elif os.path.isdir(value):
+            paths = sorted(glob.glob(os.path.join(value, "**", "*"), recursive=True))
+            return json.dumps([value] + [[os.path.relpath(p, value), _file_fingerprint(p)] for p in paths if os.path.isfile(p)])
+        return json.dumps(value)
+    if isinstance(value, pd.DataFrame):
+        digest = hashlib.sha256(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        digest.update(repr((list(value.columns), list(map(str, value.dtypes)))).encode("utf-8"))
+        return "DataFrame:" + digest.hexdigest()
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes())
+        return f"ndarray:{value.dtype}:{value.shape}:{digest.hexdigest()}"
+    if isinstance(value, xgboost.Booster):
+        return "Booster:" + hashlib.sha256(bytes(value.save_raw("ubj"))).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return json.dumps([type(value).__name__] + [fingerprint(item) for item in value])
+    if isinstance(value, dict):
+        return json.dumps({str(k): fingerprint(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))})
+    if value is None or isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    return "pickle:" + hashlib.sha256(cloudpickle.dumps(value)).hexdigest()
+
+
+def cache_key(fn, name, arguments, ignore=IGNORED_ARGUMENTS):
+    """The key of calling the step fn, named name, with a dict of its bound arguments."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([CACHE_VERSION, name, code_version(fn)]).encode("utf-8"))
+    for argument, value in sorted(arguments.items()):
+        if argument not in ignore:
+            digest.update(json.dumps([argument, fingerprint(value)]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _outputs_exist(result):
+    """Whether the files and S3 objects that a result refers to, if any, are still there."""
+    if isinstance(result, (list, tuple)):
+        return all(_outputs_exist(item) for item in result)
+    if isinstance(result, str) and result.startswith("s3://"):
+        return s3_filesystem().exists(result)
+    if isinstance(result, str) and os.path.isabs(result):
+        return os.path.exists(result)
+    return True
+
+
+def _tag_run(run_id, experiment_name, tags):
+    """Set tags on the pipeline's MLflow run, which the step itself may not have opened on a hit."""
+    if not run_id or "MLFLOW_TRACKING_URI" not in os.environ:
+        return
+    mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+    mlflow.set_experiment(experiment_name)
+    with mlflow.start_run(run_id=run_id):
+        mlflow.set_tags(tags)
+
+
+def cached(fn, cache, name=None):
+    """Wrap the step function fn so that it is skipped when cache has its result for the same code,
+    arguments and input data. Whether it was is set on the MLflow run given as run_id as the tags
+    step_cache.<name> ("hit" or "miss") and step_cache.<name>.key.
+
+    The wrapper has fn's signature, so it can be given to @step in its place. With cache None, fn is
+    returned as it is.
+    """
+    if cache is None:
+        return fn
+    name = name or fn.__name__
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = cache_key(fn, name, bound.arguments)
+        hit, result = cache.get(key)
+        hit = hit and _outputs_exist(result)
+        if not hit:
+            result = fn(*args, **kwargs)
+            cache.put(key, result, step_name=name)
+        print(f"Step cache {'hit' if hit else 'miss'} for {name}: {key}")
+        _tag_run(
+            bound.arguments.get("run_id"),
+            bound.arguments.get("experiment_name", "sm-id-pipeline-experiment"),
+            {f"step_cache.{name}": "hit" if hit else "miss", f"step_cache.{name}.key": key},
+        )
+        return result
+
+    return wrapper
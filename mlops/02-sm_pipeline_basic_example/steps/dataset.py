@@ -0,0 +1,226 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xgboost
+
+from steps.local import s3_filesystem
+
+# A dataset handed from one step to the next is a directory, local or on S3, of .npy shards and a
+# manifest that lists them:
+#
+#     manifest.json
+#     part-00000.label.npy      float32, (rows,)
+#     part-00000.features.npy   float32, (rows, n_features), C order
+#     ...
+#
+# The shards are float32 because that is what XGBoost stores, so building a DMatrix from a
+# memory-mapped shard reads it without converting it first. Steps pass the URI of the directory
+# to each other instead of the data, and the data itself is never pickled.
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+dtype = np.float32
+
+# Where datasets on S3 are downloaded to be memory-mapped.
+cache_dir = os.environ.get("STEP_DATASET_CACHE", os.path.join(tempfile.gettempdir(), "step-datasets"))
+
+
+def _is_s3(uri):
+    return uri.startswith("s3://")
+
+
+class DatasetWriter:
+    """Write a dataset shard by shard. The manifest is written by close, after the last shard.
+
+    If uri is on S3, the shards are written to a local directory and uploaded by close.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri.rstrip("/")
+        self.local_dir = tempfile.mkdtemp(prefix="step-dataset-") if _is_s3(self.uri) else self.uri
+        os.makedirs(self.local_dir, exist_ok=True)
+        self.shards = []
+        self.n_features = None
+
+    def write(self, label, features):
+        """Write a shard. label and features may be of any dtype and layout, e.g. columns of a larger
+        array; they are converted as they are copied into the shard's files."""
+        label, features = np.asarray(label).reshape(-1), np.asarray(features)
+        if features.ndim != 2 or len(features) != len(label):
+            raise ValueError(f"Expected a label per row of features, got {label.shape} and {features.shape}")
+        if self.n_features is None:
+            self.n_features = features.shape[1]
+        elif features.shape[1] != self.n_features:
+            raise ValueError(f"Shard has {features.shape[1]} features, the dataset has {self.n_features}")
+        name = f"part-{len(self.shards):05d}"
+        # One conversion to contiguous float32 each, which np.save then writes out as it is.
+        np.save(os.path.join(self.local_dir, f"{name}.label.npy"), np.asarray(label, dtype=dtype, order="C"))
+        np.save(os.path.join(self.local_dir, f"{name}.features.npy"), np.asarray(features, dtype=dtype, order="C"))
+        self.shards.append({"label": f"{name}.label.npy", "features": f"{name}.features.npy", "rows": len(label)})
+
+    def close(self):
+        manifest = {
+            "version": FORMAT_VERSION,
+            "dtype": np.dtype(dtype).name,
+            "rows": sum(shard["rows"] for shard in self.shards),
+            "n_features": self.n_features or 0,
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.local_dir, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        if _is_s3(self.uri):
+            s3 = s3_filesystem()
+            for name in os.listdir(self.local_dir):
+                s3.put(os.path.join(self.local_dir, name), f"{self.uri}/{name}")
+        return Dataset(self.uri, manifest, self.local_dir)
+
+
+def save(data, uri):
+    """Write a DataFrame or array whose first column is the label, as the preprocessing step lays
+    out its splits, as a dataset of one shard. Returns its Dataset."""
+    values = data.to_numpy() if isinstance(data, pd.DataFrame) else np.asarray(data)
+    writer = DatasetWriter(uri)
+    writer.write(values[:, 0], values[:, 1:])
+    return writer.close()
+
+
+def load(uri):
+    """Open the dataset at uri, downloading it first if it is on S3."""
+    uri = uri.rstrip("/")
+    local_dir = uri
+    if _is_s3(uri):
+        local_dir = os.path.join(cache_dir, uri[len("s3://"):])
+        if not os.path.exists(os.path.join(local_dir, MANIFEST)):
+            s3 = s3_filesystem()
+            os.makedirs(local_dir, exist_ok=True)
+            manifest = json.loads(s3.cat(f"{uri}/{MANIFEST}"))
+            for shard in manifest["shards"]:
+                for name in (shard["label"], shard["features"]):
+                    s3.get(f"{uri}/{name}", os.path.join(local_dir, name))
+            # The manifest goes last, so that an interrupted download is started over.
+            with open(os.path.join(local_dir, MANIFEST), "w") as f:
+                json.dump(manifest, f)
+    with open(os.path.join(local_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported dataset version {manifest.get('version')} at {uri}")
+    return Dataset(uri, manifest, local_dir)
+
+
+class Dataset:
+    """A dataset written by DatasetWriter, with its shards memory-mapped on first use, or, with
+    arrays, the (label, features) of a dataset in memory."""
+
+    def __init__(self, uri, manifest, local_dir, arrays=None):
+        self.uri = uri
+        self.manifest = manifest
+        self.local_dir = local_dir
+        self._arrays = arrays
+
+    def __repr__(self):
+        return f"Dataset({self.uri!r}, rows={self.rows}, n_features={self.n_features})"
+
+    @property
+    def rows(self):
+        return self.manifest["rows"]
+
+    @property
+    def n_features(self):
+        return self.manifest["n_features"]
+
+    @property
+    def nbytes(self):
+        """The size of the files of the dataset, i.e. the bytes a step reads or writes to hand it over."""
+        if self._arrays is not None:
+            return sum(array.nbytes for array in self._arrays)
+        names = [MANIFEST] + [shard[key] for shard in self.manifest["shards"] for key in ("label", "features")]
+        return sum(os.path.getsize(os.path.join(self.local_dir, name)) for name in names)
+
+    def shards(self):
+        """Yield the (label, features) of each shard, as read-only memory maps."""
+        if self._arrays is not None:
+            yield self._arrays
+            return
+        for shard in self.manifest["shards"]:
+            yield (
+                np.load(os.path.join(self.local_dir, shard["label"]), mmap_mode="r"),
+                np.load(os.path.join(self.local_dir, shard["features"]), mmap_mode="r"),
+            )
+
+    def arrays(self):
+        """The (label, features) of the whole dataset. These are the memory maps themselves for a
+        dataset of one shard; the shards of a larger one are concatenated into memory."""
+        shards = list(self.shards())
+        if len(shards) == 1:
+            return shards[0]
+        if not shards:
+            return np.empty(0, dtype=dtype), np.empty((0, self.n_features), dtype=dtype)
+        return np.concatenate([label for label, _ in shards]), np.concatenate([features for _, features in shards])
+
+    def batches(self, batch_rows=None):
+        """Yield the (label, features) of the dataset in order, a shard or, with batch_rows, at most
+        batch_rows rows of a shard at a time. The batches are slices of the memory maps."""
+        for label, features in self.shards():
+            step = batch_rows or max(len(label), 1)
+            for start in range(0, len(label), step):
+                yield label[start:start + step], features[start:start + step]
+
+    def dmatrix(self, **kwargs):
+        label, features = self.arrays()
+        return xgboost.DMatrix(features, label=label, **kwargs)
+
+    def quantile_dmatrix(self, batch_rows=None, **kwargs):
+        """A QuantileDMatrix for the hist tree method, built from the dataset a batch at a time. Only
+        the quantized matrix, about a quarter of the size of the float32 features, is held in memory,
+        never the whole of the features. Pass the training set's as ref for the validation set's."""
+        return xgboost.QuantileDMatrix(_BatchIter(self, batch_rows), **kwargs)
+
+    def external_dmatrix(self, cache_dir, batch_rows=None, **kwargs):
+        """An ExtMemQuantileDMatrix, which keeps the quantized batches in cache files under cache_dir
+        and reads them back at each boosting round, so that even they need not fit in memory."""
+        os.makedirs(cache_dir, exist_ok=True)
+        return xgboost.ExtMemQuantileDMatrix(_BatchIter(self, batch_rows, os.path.join(cache_dir, "cache")), **kwargs)
+
+    def to_frame(self):
+        """The dataset as a DataFrame laid out like the preprocessing step's, with the label first."""
+        label, features = self.arrays()
+        return pd.DataFrame(np.column_stack([label, features]))
+
+
+class _BatchIter(xgboost.DataIter):
+    """Feed Dataset.batches to XGBoost, which goes over them once or more through next and reset."""
+
+    def __init__(self, dataset, batch_rows=None, cache_prefix=None):
+        self.dataset = dataset
+        self.batch_rows = batch_rows
+        self._batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._batches is None:
+            self._batches = self.dataset.batches(self.batch_rows)
+        batch = next(self._batches, None)
+        if batch is None:
+            return False
+        label, features = batch
+        input_data(data=features, label=label)
+        return True
+
+    def reset(self):
+        self._batches = None
+
+
+def as_dataset(data):
+    """Accept what steps are given for a dataset: a Dataset, the URI of one, or, as before, a
+    DataFrame or array with the label in its first column, which is used in place without copying
+    the label out of it or dropping it."""
+    if isinstance(data, Dataset):
+        return data
+    if isinstance(data, str):
+        return load(data)
+    values = data.to_numpy() if isinstance(data, pd.DataFrame) else np.asarray(data)
+    label, features = values[:, 0], values[:, 1:]
+    manifest = {"version": FORMAT_VERSION, "rows": len(values), "n_features": features.shape[1], "shards": []}
+    return Dataset(None, manifest, None, arrays=(label, features))
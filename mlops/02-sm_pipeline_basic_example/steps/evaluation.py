@@ -1,49 +1,58 @@
-import numpy as np
-import os
-import xgboost
+import time
 import mlflow
 
-from sklearn.metrics import mean_squared_error
-
-
-def evaluate(model, test_df, experiment_name="sm-id-pipeline-experiment", run_id=None):
-    
-    # Enable autologging in MLflow
-    mlflow.set_tracking_uri(os.environ['MLFLOW_TRACKING_URI'])
-    mlflow.set_experiment(experiment_name)
-    with mlflow.start_run(run_id=run_id):
-        with mlflow.start_run(run_name="Evaluate", nested=True):
-            mlflow.autolog()
-            y_test = test_df.iloc[:, 0].to_numpy()
-            test_df.drop(test_df.columns[0], axis=1, inplace=True)
-            x_test = test_df.to_numpy()
-            predictions = model.predict(xgboost.DMatrix(x_test))
-
-            data = {
-                "actual": y_test,
-                "predicted": predictions,
-                "features": x_test  # Optional context
-            }
-            
-            # Log as a table
-            mlflow.log_table(data=data, artifact_file="predictions_table.json")
-            
-            mse = mean_squared_error(y_test, predictions)
-            std = np.std(y_test - predictions)
-            report_dict = {
-                "regression_metrics": {
-                    "mse": {"value": mse, "standard_deviation": std},
-                },
-            }
-
-            mlflow.set_tags(
-                {
-                    'mlflow.source.name': "evaluation.py",
-                    'mlflow.source.type': 'EVALUATION',
-                }
-            )
-            print(f"evaluation report: {report_dict}")
-            mlflow.log_metric("test-mse", mse)
-            mlflow.log_metric("test-mse-standard_deviation", std)
-
-    return report_dict
\ No newline at end of file
+from steps.dataset import as_dataset
+from steps.metrics import evaluate_in_chunks
+from steps.tracking import step_run
+
+
+def evaluate(
+    model,
+    test_df,
+    experiment_name="sm-id-pipeline-experiment",
+    run_id=None,
+    *,
+    chunk_rows=65536,
+    n_bootstrap=1000,
+    confidence=0.95,
+    sample_rows=1000,
+    seed=0,
+):
+    """Score model on the test set, chunk_rows rows at a time (see steps/metrics.py).
+
+    Reports MSE, RMSE, MAE, R^2 and quantiles of the absolute error, with confidence intervals from
+    n_bootstrap bootstrap replicates (0 for none), and logs a table of a uniform sample of sample_rows
+    of the predictions (0 for none) rather than all of them.
+    """
+    with step_run("Evaluate", "evaluation.py", "EVALUATION", experiment_name, run_id) as tracker:
+        # Enable autologging in MLflow
+        mlflow.autolog()
+        load_start = time.perf_counter()
+        test_data = as_dataset(test_df)
+        tracker.log_metrics({
+            "handoff_load_seconds": time.perf_counter() - load_start,
+            "handoff_bytes": test_data.nbytes,
+        })
+
+        report_dict, sample, rows_per_second = evaluate_in_chunks(
+            model, test_data, chunk_rows, n_bootstrap, confidence, sample_rows, seed
+        )
+
+        if sample_rows:
+            # Log a sample as a table
+            tracker.log_table(data=sample.rows(), artifact_file="predictions_table.json")
+
+        print(f"evaluation report: {report_dict}")
+        print(f"Evaluated {report_dict['rows']} rows at {rows_per_second:.0f} rows/s")
+        metrics = report_dict["regression_metrics"]
+        tracker.log_metric("test-mse", metrics["mse"]["value"])
+        tracker.log_metric("test-mse-standard_deviation", metrics["mse"]["standard_deviation"])
+        for name, metric in metrics.items():
+            if name != "mse":
+                tracker.log_metric(f"test-{name}", metric["value"])
+            if "confidence_interval" in metric:
+                tracker.log_metric(f"test-{name}-ci_lower", metric["confidence_interval"][0])
+                tracker.log_metric(f"test-{name}-ci_upper", metric["confidence_interval"][1])
+        tracker.log_metric("evaluation_rows_per_second", rows_per_second)
+
+    return report_dict
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+# Stand-ins for the AWS services the steps use, so that the pipeline can be run and tested offline.
+#
+# Set LOCAL_S3_ROOT to a directory to have s3_filesystem() return a LocalS3FileSystem, which keeps
+# s3://bucket/key at $LOCAL_S3_ROOT/bucket/key, instead of an s3fs.S3FileSystem.
+#
+# Set LOCAL_MODEL_REGISTRY to a directory to have the register step create model packages there, as
+# JSON files, instead of in SageMaker's model registry.
+#
+# MLflow needs no stand-in: point MLFLOW_TRACKING_URI at a local directory (file:///...).
+
+
+def s3_filesystem():
+    """The filesystem of s3:// URIs: S3 itself, or the local stand-in if LOCAL_S3_ROOT is set."""
+    root = os.environ.get("LOCAL_S3_ROOT")
+    if root:
+        return LocalS3FileSystem(root)
+    import s3fs
+
+    return s3fs.S3FileSystem()
+
+
+class LocalS3FileSystem:
+    """The part of the s3fs.S3FileSystem interface that the steps use, on a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+        # The client of the calls made to S3 directly rather than through the filesystem
+        self.s3 = LocalS3Client(self)
+
+    def _path(self, uri):
+        key = uri[len("s3://"):] if uri.startswith("s3://") else uri
+        return os.path.join(self.root, key.lstrip("/"))
+
+    def open(self, uri, mode="rb"):
+        path = self._path(uri)
+        if "w" in mode or "a" in mode:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode)
+
+    def exists(self, uri):
+        return os.path.exists(self._path(uri))
+
+    def cat(self, uri):
+        with self.open(uri) as f:
+            return f.read()
+
+    def put(self, local_path, uri):
+        path = self._path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path)
+
+    def get(self, uri, local_path):
+        shutil.copyfile(self._path(uri), local_path)
+
+    def info(self, uri):
+        stat = os.stat(self._path(uri))
+        # Not an MD5 like S3's, but it changes whenever the object is rewritten, which is what it is used for.
+        return {"Key": uri, "size": stat.st_size, "ETag": f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'}
+
+    def ls(self, uri):
+        path = self._path(uri)
+        prefix = uri.rstrip("/")
+        return [f"{prefix}/{name}" for name in sorted(os.listdir(path))] if os.path.isdir(path) else []
+
+    def find(self, uri):
+        """The URIs of all the objects under uri."""
+        path = self._path(uri)
+        prefix = uri.rstrip("/")
+        if os.path.isfile(path):
+            return [uri]
+        files = []
+        for directory, _, names in os.walk(path):
+            relative = os.path.relpath(directory, path)
+            for name in names:
+                files.append(prefix + "/" + (name if relative == "." else f"{relative}/{name}"))
+        return sorted(files)
+
+    def rm(self, uri, recursive=False):
+        path = self._path(uri)
+        if os.path.isdir(path):
+            if not recursive:
+                raise IsADirectoryError(uri)
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+class LocalS3Client:
+    """The S3 API calls that steps/packaging.py makes, put_object and those of multipart uploads, as
+    methods with the arguments and responses of a boto3 S3 client, which s3fs.S3FileSystem has as .s3,
+    on the directory of a LocalS3FileSystem. Parts are kept under .multipart/ until the upload is
+    completed, and objects appear whole, as on S3."""
+
+    # S3's minimum size of a part of a multipart upload, but for the last one.
+    MIN_PART_SIZE = 5 * 1024 ** 2
+
+    def __init__(self, fs):
+        self.fs = fs
+
+    def put_object(self, Bucket, Key, Body):
+        return {"ETag": self._write_atomically(self.fs._path(f"{Bucket}/{Key}"), [Body])}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_dir(upload_id))
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with open(os.path.join(self._upload_dir(UploadId, exists=True), str(PartNumber)), "wb") as f:
+            f.write(Body)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload_dir = self._upload_dir(UploadId, exists=True)
+        parts = MultipartUpload["Parts"]
+        paths = [os.path.join(upload_dir, str(part["PartNumber"])) for part in parts]
+        if [part["PartNumber"] for part in parts] != sorted({part["PartNumber"] for part in parts}):
+            raise ValueError("InvalidPartOrder: parts must be listed in ascending order, once each")
+        if any(os.path.getsize(part_path) < self.MIN_PART_SIZE for part_path in paths[:-1]):
+            raise ValueError(f"EntityTooSmall: parts but the last must be at least {self.MIN_PART_SIZE} bytes")
+        etag = self._write_atomically(self.fs._path(f"{Bucket}/{Key}"), paths)
+        shutil.rmtree(upload_dir)
+        return {"ETag": etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        shutil.rmtree(self._upload_dir(UploadId, exists=True))
+        return {}
+
+    def _upload_dir(self, upload_id, exists=False):
+        upload_dir = os.path.join(self.fs.root, ".multipart", upload_id)
+        if exists and not os.path.isdir(upload_dir):
+            raise FileNotFoundError(f"NoSuchUpload: {upload_id}")
+        return upload_dir
+
+    def _write_atomically(self, path, chunks):
+        """Write chunks, bytes or the paths of files, to path through a temporary file."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        md5 = hashlib.md5()
+        with open(temporary, "wb") as f:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    with open(chunk, "rb") as part:
+                        for block in iter(lambda: part.read(1024 ** 2), b""):
+                            f.write(block)
+                            md5.update(block)
+                else:
+                    f.write(chunk)
+                    md5.update(chunk)
+        os.replace(temporary, path)
+        return f'"{md5.hexdigest()}"'
+
+
+def local_model_registry():
+    """The local stand-in for the model registry if LOCAL_MODEL_REGISTRY is set, None otherwise."""
+    root = os.environ.get("LOCAL_MODEL_REGISTRY")
+    return LocalModelRegistry(root) if root else None
+
+
+class LocalModelRegistry:
+    """Model package groups as directories, and their model packages as numbered JSON files."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def create_model_package(self, model_package_group_name, **request):
+        """Record a model package, taking the arguments of create_model_package_from_containers
+        other than the session. Returns a response with its ModelPackageArn, as SageMaker does."""
+        group_dir = os.path.join(self.root, model_package_group_name)
+        os.makedirs(group_dir, exist_ok=True)
+        version = len(self.list_model_packages(model_package_group_name)) + 1
+        while True:
+            try:
+                # Exclusive creation, so that concurrent registrations get different versions.
+                fd = os.open(os.path.join(group_dir, f"{version}.json"), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                break
+            except FileExistsError:
+                version += 1
+        arn = f"arn:aws:sagemaker:local:000000000000:model-package/{model_package_group_name}/{version}"
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict(request, ModelPackageArn=arn, ModelPackageVersion=version), f, indent=2, default=str)
+        return {"ModelPackageArn": arn}
+
+    def list_model_packages(self, model_package_group_name):
+        """The model packages of a group, oldest first."""
+        group_dir = os.path.join(self.root, model_package_group_name)
+        if not os.path.isdir(group_dir):
+            return []
+        packages = []
+        for name in sorted(os.listdir(group_dir), key=lambda name: int(name.split(".")[0])):
+            with open(os.path.join(group_dir, name)) as f:
+                packages.append(json.load(f))
+        return packages
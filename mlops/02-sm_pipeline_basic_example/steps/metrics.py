@@ -0,0 +1,200 @@
+import math
+import time
+
+import numpy as np
+
+# Regression metrics computed over a test set a chunk of predictions at a time.
+#
+# RegressionMetrics keeps sums of the residuals and labels for MSE, MAE, R^2 and the residuals'
+# standard deviation, and a histogram of absolute errors over log-spaced bins for their quantiles. Its
+# confidence intervals come from the Poisson bootstrap: each row is counted Poisson(1) times in each of
+# n_bootstrap replicates, which resamples the test set like drawing with replacement but needs no
+# second pass, so every replicate's sums are accumulated with one matrix product per block of rows.
+# ReservoirSample keeps a uniform sample of the rows, for logging a table of predictions.
+
+# The relative accuracy of the absolute error quantiles, and the range of errors they cover.
+QUANTILE_ACCURACY = 0.01
+_MIN_ERROR, _MAX_ERROR = 1e-6, 1e6
+_GAMMA = (1 + QUANTILE_ACCURACY) / (1 - QUANTILE_ACCURACY)
+_N_BINS = int(math.ceil(math.log(_MAX_ERROR / _MIN_ERROR) / math.log(_GAMMA))) + 2
+ERROR_QUANTILES = (0.5, 0.9, 0.99)
+
+# Bootstrap weights are drawn for blocks of rows of about this many weights in all.
+_BOOTSTRAP_BLOCK_WEIGHTS = 1 << 22
+
+
+def _poisson_table(bits=16):
+    """A table that maps uniform random integers below 2**bits to Poisson(1) counts. Drawing weights
+    as random bytes looked up in it is several times faster than Generator.poisson, and its
+    probabilities are within 2**-bits of the exact ones."""
+    pmf = [math.exp(-1) / math.factorial(k) for k in range(32)]
+    cdf = np.round(np.cumsum(pmf) * (1 << bits))
+    return np.searchsorted(cdf, np.arange(1 << bits), side="right").astype(np.float32)
+
+
+_POISSON_TABLE = _poisson_table()
+
+
+def _error_bins(abs_errors):
+    """The bin of each absolute error: 0 below _MIN_ERROR, then log-spaced bins, and one for the rest."""
+    with np.errstate(divide="ignore"):
+        bins = np.ceil(np.log(np.maximum(abs_errors, _MIN_ERROR) / _MIN_ERROR) / math.log(_GAMMA)).astype(np.int64)
+    return np.clip(bins, 0, _N_BINS - 1)
+
+
+def _bin_value(index):
+    if index == 0:
+        return 0.0
+    # The middle of the bin, in relative terms, so values in it are within QUANTILE_ACCURACY of it.
+    return _MIN_ERROR * _GAMMA ** index * 2 / (1 + _GAMMA)
+
+
+class RegressionMetrics:
+    """Accumulate regression metrics, and their bootstrap confidence intervals, over chunks.
+
+    Args:
+        n_bootstrap (int): Bootstrap replicates, 0 for no confidence intervals.
+        confidence (float): The coverage of the confidence intervals.
+        seed (int): Seed of the bootstrap weights.
+    """
+
+    # The per-row terms that the bootstrap replicates sum: count, squared error, absolute error, y, y^2
+    _TERMS = 5
+
+    def __init__(self, n_bootstrap=1000, confidence=0.95, seed=None):
+        self.n_bootstrap = n_bootstrap
+        self.confidence = confidence
+        self.rng = np.random.default_rng(seed)
+        self.sums = np.zeros(self._TERMS)
+        self.residual_sum = 0.0
+        self.error_counts = np.zeros(_N_BINS, dtype=np.int64)
+        self.replicate_sums = np.zeros((n_bootstrap, self._TERMS))
+        self.shift = None
+
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.float64)
+        errors = y_true - np.asarray(y_pred, dtype=np.float64)
+        if self.shift is None:
+            # R^2's total sum of squares is summed about the first chunk's mean label, which leaves it
+            # unchanged but keeps the float32 replicate sums from cancelling.
+            self.shift = float(y_true.mean()) if len(y_true) else 0.0
+        y = y_true - self.shift
+        terms = np.column_stack([np.ones_like(errors), errors * errors, np.abs(errors), y, y * y])
+        self.sums += terms.sum(axis=0)
+        self.residual_sum += errors.sum()
+        self.error_counts += np.bincount(_error_bins(terms[:, 2]), minlength=_N_BINS)
+        if self.n_bootstrap:
+            block = max(1, _BOOTSTRAP_BLOCK_WEIGHTS // self.n_bootstrap)
+            for start in range(0, len(terms), block):
+                rows = terms[start:start + block]
+                draws = np.frombuffer(self.rng.bytes(2 * self.n_bootstrap * len(rows)), dtype=np.uint16)
+                weights = _POISSON_TABLE.take(draws).reshape(self.n_bootstrap, len(rows))
+                self.replicate_sums += weights @ rows.astype(np.float32)
+        return self
+
+    @property
+    def count(self):
+        return int(self.sums[0])
+
+    @staticmethod
+    def _metrics(sums):
+        """MSE, MAE and R^2 from rows of summed terms."""
+        n, squared, absolute, y, y2 = (sums[..., i] for i in range(RegressionMetrics._TERMS))
+        n = np.maximum(n, 1)
+        total = y2 - y * y / n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r2 = np.where(total > 0, 1 - squared / total, np.nan)
+        return {"mse": squared / n, "mae": absolute / n, "r2": r2}
+
+    def error_quantile(self, q):
+        """The q quantile of the absolute errors, to within QUANTILE_ACCURACY relative error."""
+        cumulative = np.cumsum(self.error_counts)
+        if cumulative[-1] == 0:
+            return math.nan
+        return _bin_value(int(np.searchsorted(cumulative, q * (cumulative[-1] - 1), side="right")))
+
+    def report(self):
+        """The metrics in the form of a SageMaker model quality report, with confidence intervals."""
+        n = max(self.count, 1)
+        values = {name: float(value) for name, value in self._metrics(self.sums).items()}
+        values["rmse"] = math.sqrt(values["mse"])
+        mean_residual = self.residual_sum / n
+        residual_std = math.sqrt(max(self.sums[1] / n - mean_residual ** 2, 0.0))
+
+        intervals = {}
+        if self.n_bootstrap:
+            replicates = self._metrics(self.replicate_sums.astype(np.float64))
+            replicates["rmse"] = np.sqrt(replicates["mse"])
+            tail = (1 - self.confidence) / 2 * 100
+            for name, samples in replicates.items():
+                lower, upper = np.nanpercentile(samples, [tail, 100 - tail])
+                intervals[name] = [float(lower), float(upper)]
+
+        metrics = {}
+        for name, value in values.items():
+            metrics[name] = {"value": value}
+            if name in intervals:
+                metrics[name]["confidence_interval"] = intervals[name]
+        metrics["mse"]["standard_deviation"] = residual_std
+        for q in ERROR_QUANTILES:
+            metrics[f"abs_error_p{int(round(q * 100))}"] = {"value": self.error_quantile(q)}
+        return {"regression_metrics": metrics, "rows": self.count, "confidence": self.confidence}
+
+
+class ReservoirSample:
+    """A uniform random sample of at most size rows of a stream of chunks (Algorithm R, a chunk at a
+    time)."""
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.seen = 0
+        self.columns = None
+
+    def update(self, **columns):
+        """Offer the rows of a chunk, given as equal-length arrays by column name."""
+        n = len(next(iter(columns.values())))
+        if self.size == 0 or n == 0:
+            self.seen += n
+            return self
+        if self.columns is None:
+            self.columns = {
+                name: np.empty((self.size,) + np.shape(values)[1:], dtype=np.asarray(values).dtype)
+                for name, values in columns.items()
+            }
+        positions = self.seen + np.arange(n)
+        # Row t of the stream replaces a uniform slot below t + 1 if that slot is in the reservoir;
+        # the first size rows fill it. Of the rows that pick the same slot, the last one wins.
+        slots = np.where(positions < self.size, positions, self.rng.integers(0, positions + 1))
+        rows = np.nonzero(slots < self.size)[0]
+        last = len(rows) - 1 - np.unique(slots[rows][::-1], return_index=True)[1]
+        rows = rows[last]
+        for name, values in columns.items():
+            self.columns[name][slots[rows]] = np.asarray(values)[rows]
+        self.seen += n
+        return self
+
+    def rows(self):
+        """The sampled rows, by column name."""
+        if self.columns is None:
+            return {}
+        return {name: values[:min(self.seen, self.size)] for name, values in self.columns.items()}
+
+
+def evaluate_in_chunks(model, dataset, chunk_rows=65536, n_bootstrap=1000, confidence=0.95, sample_rows=1000,
+                       seed=None):
+    """Predict a Dataset chunk_rows rows at a time with model, and accumulate metrics as it goes.
+
+    Returns:
+        (report, sample, rows_per_second): the RegressionMetrics report, a ReservoirSample of
+        sample_rows rows of actual, predicted and features, and the rows predicted and scored per second.
+    """
+    metrics = RegressionMetrics(n_bootstrap, confidence, seed=seed)
+    sample = ReservoirSample(sample_rows, seed=None if seed is None else seed + 1)
+    start = time.perf_counter()
+    for label, features in dataset.batches(chunk_rows):
+        predictions = model.inplace_predict(features)
+        metrics.update(label, predictions)
+        sample.update(actual=label, predicted=predictions, features=features)
+    rows_per_second = metrics.count / max(time.perf_counter() - start, 1e-9)
+    return metrics.report(), sample, rows_per_second
@@ -0,0 +1,194 @@
+import bz2
+import concurrent.futures
+import gzip
+import io
+import lzma
+import tarfile
+import threading
+import time
+
+# Packaging the model for SageMaker, straight into S3.
+#
+# write_model_archive() writes the booster, in the format of Booster.save_model, into a tar archive
+# through a compressor, onto any writable file object, without temporary files. With a
+# MultipartUpload as that file object, the compressed archive is cut into parts as it is written,
+# and the parts are uploaded concurrently by a pool of threads while the next ones are compressed.
+# At most workers parts are in flight and one more is being filled, so memory is bounded by
+# (workers + 1) * part_size whatever the size of the model.
+#
+# SageMaker's model servers expect a gzipped archive, model.tar.gz; the other codecs are for
+# archiving.
+
+# The codecs of the archive: name -> (file suffix, compressor of a file object at a level)
+COMPRESSION_CODECS = {
+    "gz": (".tar.gz", lambda fileobj, level: gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level, mtime=0)),
+    "bz2": (".tar.bz2", lambda fileobj, level: bz2.BZ2File(fileobj, mode="wb", compresslevel=level)),
+    "xz": (".tar.xz", lambda fileobj, level: lzma.LZMAFile(fileobj, mode="wb", preset=level)),
+    "none": (".tar", None),
+}
+
+# S3 takes parts of 5 MiB to 5 GiB, but for the last one, and up to 10000 of them.
+MIN_PART_SIZE = 5 * 1024 ** 2
+DEFAULT_PART_SIZE = 8 * 1024 ** 2
+
+
+def archive_name(codec="gz"):
+    """The file name of a model archive compressed with codec, e.g. model.tar.gz."""
+    return "model" + _codec(codec)[0]
+
+
+def _codec(codec):
+    if codec not in COMPRESSION_CODECS:
+        raise ValueError(f"codec must be one of {tuple(COMPRESSION_CODECS)}, got {codec!r}")
+    return COMPRESSION_CODECS[codec]
+
+
+class _Uncloseable(io.RawIOBase):
+    """A write-only view of a file object that closing leaves open, as compressors close theirs."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+
+class _MemoryReader(io.RawIOBase):
+    """A file object that reads a bytes-like object in place, where io.BytesIO would copy a bytearray."""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), len(self.view) - self.position)
+        buffer[:n] = self.view[self.position:self.position + n]
+        self.position += n
+        return n
+
+
+def write_model_archive(booster, fileobj, codec="gz", compresslevel=6, member_name="xgboost-model"):
+    """Write booster to fileobj as a tar archive, compressed with codec at compresslevel, that holds
+    it as member_name. Returns the size of the model before compression, in bytes."""
+    _, compressor = _codec(codec)
+    model = booster.save_raw("ubj")
+    info = tarfile.TarInfo(member_name)
+    info.size = len(model)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    target = _Uncloseable(fileobj)
+    stream = compressor(target, compresslevel) if compressor else target
+    with stream:
+        # "w|" writes the archive as a stream, in order, rather than seeking back over it.
+        with tarfile.open(fileobj=stream, mode="w|") as tar:
+            tar.addfile(info, _MemoryReader(model))
+    return len(model)
+
+
+class MultipartUpload(io.RawIOBase):
+    """A writable file object that uploads what is written to it to the S3 URI uri with the
+    multipart upload API of the boto3 S3 client of fs, an s3fs.S3FileSystem or a
+    steps.local.LocalS3FileSystem, which both have it as .s3.
+
+    Every part_size bytes written become a part, uploaded by one of workers threads while writing
+    goes on; write blocks while workers parts are in flight. An object smaller than a part is put with
+    one request instead. The object is complete when the upload is closed, and the upload is aborted if
+    an error escapes its with block.
+    """
+
+    def __init__(self, fs, uri, part_size=DEFAULT_PART_SIZE, workers=4):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes, got {part_size}")
+        self.client = fs.s3
+        self.bucket, _, self.key = uri[len("s3://"):].partition("/")
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.upload_id = None
+        self._buffer = bytearray()
+        self._parts = []
+        self._slots = threading.BoundedSemaphore(workers)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            with memoryview(self._buffer) as view:
+                part = bytes(view[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def _submit(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        self._slots.acquire()
+        future = self._pool.submit(self._upload_part, len(self._parts) + 1, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _upload_part(self, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._pool.shutdown()
+            super().close()
+
+    def abort(self):
+        """Drop the parts uploaded so far; the object is left as it was."""
+        for future in self._parts:
+            future.cancel()
+        self._pool.shutdown()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def upload_model_archive(booster, fs, uri, codec="gz", compresslevel=6, part_size=DEFAULT_PART_SIZE, workers=4):
+    """Write booster as a model archive (see write_model_archive) straight to uri on fs.
+
+    Returns:
+        dict: model_bytes and archive_bytes, the sizes before and after compression, and seconds.
+    """
+    start = time.perf_counter()
+    with MultipartUpload(fs, uri, part_size, workers) as upload:
+        model_bytes = write_model_archive(booster, upload, codec, compresslevel)
+    return {"model_bytes": model_bytes, "archive_bytes": upload.bytes_written, "seconds": time.perf_counter() - start}
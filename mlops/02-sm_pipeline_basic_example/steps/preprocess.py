@@ -1,6 +1,11 @@
+import collections
 import numpy as np
 import pandas as pd
 import os
+import resource
+import shutil
+import tempfile
+import time
 
 from sklearn.pipeline import Pipeline
 from sklearn.compose import ColumnTransformer
@@ -9,6 +14,9 @@ from sklearn.preprocessing import StandardScaler, OneHotEncoder
 
 import mlflow
 
+from steps.dataset import DatasetWriter, save
+from steps.tracking import step_run
+
 # Since we get a headerless CSV file, we specify the column names here.
 feature_columns_names = [
     "sex",
@@ -35,69 +43,357 @@ feature_columns_dtype = {
 label_column_dtype = {"rings": np.float64}
 
 
+numeric_features = [name for name in feature_columns_names if name != "sex"]
+categorical_features = ["sex"]
+
+# The fractions of rows in the train and validation splits; the rest are the test split.
+split_fractions = (0.7, 0.15)
+split_names = ("train", "validation", "test")
+
+
 def merge_two_dicts(x, y):
     z = x.copy()
     z.update(y)
     return z
 
 
-def preprocess(raw_data_s3_path: str, experiment_name: str = "sm-id-pipeline-experiment", run_id: str = None) -> tuple[pd.DataFrame, ...]:
-    df = pd.read_csv(
+def read_raw_data(raw_data_s3_path, chunksize=None):
+    return pd.read_csv(
         raw_data_s3_path,
         header=None,
         names=feature_columns_names + [label_column],
         dtype=merge_two_dicts(feature_columns_dtype, label_column_dtype),
+        chunksize=chunksize,
     )
 
-    mlflow.set_tracking_uri(os.environ['MLFLOW_TRACKING_URI'])    
-    mlflow.set_experiment(experiment_name)
-
-    with mlflow.start_run(run_id=run_id) as run:
-        with mlflow.start_run(run_name="DataPreprocessing", nested=True):
-            # Enable autologging in MLflow
-            mlflow.sklearn.autolog(log_datasets=False)
-
-            dataset = mlflow.data.from_pandas(df, source=raw_data_s3_path)
-            
-            mlflow.log_input(dataset, context="feature-engineering")
-            numeric_features = list(feature_columns_names)
-            numeric_features.remove("sex")
-            numeric_transformer = Pipeline(
-                steps=[
-                    ("imputer", SimpleImputer(strategy="median")),
-                    ("scaler", StandardScaler()),
-                ]
-            )
-
-            categorical_features = ["sex"]
-            categorical_transformer = Pipeline(
-                steps=[
-                    ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
-                    ("onehot", OneHotEncoder(handle_unknown="ignore")),
-                ]
-            )
-
-            preprocess = ColumnTransformer(
-                transformers=[
-                    ("num", numeric_transformer, numeric_features),
-                    ("cat", categorical_transformer, categorical_features),
-                ]
-            )
-
-            mlflow.set_tags(
-                {
-                    'mlflow.source.name': "preprocess.py",
-                    'mlflow.source.type': 'PREPROCESS',
-                }
-            )
-
-            y = df.pop("rings")
-            X_pre = preprocess.fit_transform(df)
-            y_pre = y.to_numpy().reshape(len(y), 1)
-
-            X = np.concatenate((y_pre, X_pre), axis=1)
 
+def split_sizes(n_rows):
+    """The number of rows in each split, as np.split cuts them in the in-memory mode."""
+    train_end = int(split_fractions[0] * n_rows)
+    validation_end = int(sum(split_fractions) * n_rows)
+    return [train_end, validation_end - train_end, n_rows - validation_end]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class _ValueCounts:
+    """Exact counts of the distinct values of a column, for its median. If a column has more than
+    max_distinct distinct values, they are rounded to one significant digit fewer at a time until it
+    has fewer, so memory stays bounded and the median becomes approximate only then."""
+
+    def __init__(self, max_distinct=1 << 20):
+        self.max_distinct = max_distinct
+        self.values = np.empty(0)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.digits = None
+
+    def add(self, values):
+        if self.digits is not None:
+            values = self._round(values)
+        new_values, new_counts = np.unique(values, return_counts=True)
+        # Both are sorted and distinct, so the chunk's counts are merged in with a binary search for
+        # each of its values, rather than by sorting the values seen so far over again.
+        positions = np.searchsorted(self.values, new_values)
+        seen = positions < len(self.values)
+        seen[seen] = self.values[positions[seen]] == new_values[seen]
+        self.counts[positions[seen]] += new_counts[seen]
+        if not seen.all():
+            unseen = ~seen
+            self.values = np.insert(self.values, positions[unseen], new_values[unseen])
+            self.counts = np.insert(self.counts, positions[unseen], new_counts[unseen])
+        while len(self.values) > self.max_distinct:
+            self.digits = 15 if self.digits is None else self.digits - 1
+            self.values, inverse = np.unique(self._round(self.values), return_inverse=True)
+            self.counts = np.bincount(inverse, weights=self.counts, minlength=len(self.values)).astype(np.int64)
+
+    def _round(self, values):
+        magnitude = 10.0 ** (np.floor(np.log10(np.maximum(np.abs(values), 1e-300))) - self.digits + 1)
+        return np.round(values / magnitude) * magnitude
+
+    def median(self):
+        """The median as np.median computes it: the mean of the two middle values of an even count."""
+        cumulative = np.cumsum(self.counts)
+        n = cumulative[-1]
+        lower = self.values[np.searchsorted(cumulative, (n - 1) // 2, side="right")]
+        upper = self.values[np.searchsorted(cumulative, n // 2, side="right")]
+        return (lower + upper) / 2.0
+
+
+class StreamingPreprocessor:
+    """The transformations of the in-memory mode's ColumnTransformer, fitted one chunk at a time.
+
+    Numeric columns: missing values are imputed with the column's median, then standardized. The
+    median comes from exact counts of the column's values, and the scaler's mean and variance from
+    running moments of the non-missing values, combined with the missing ones at the median once it is
+    known, so no second pass is needed to fit. Categorical columns: missing values become "missing",
+    then are one-hot encoded over the sorted categories seen, ignoring unknown ones.
+    """
+
+    def __init__(self):
+        n = len(numeric_features)
+        self.n_rows = 0
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.value_counts = [_ValueCounts() for _ in numeric_features]
+        self.category_sets = [set() for _ in categorical_features]
+
+    def partial_fit(self, df):
+        X = df[numeric_features].to_numpy(np.float64)
+        present = ~np.isnan(X)
+        n = present.sum(axis=0)
+        mean = np.where(present, X, 0.0).sum(axis=0) / np.maximum(n, 1)
+        m2 = np.where(present, (X - mean) ** 2, 0.0).sum(axis=0)
+        self.count, self.mean, self.m2 = _combine_moments(self.count, self.mean, self.m2, n, mean, m2)
+        for j, counts in enumerate(self.value_counts):
+            counts.add(X[present[:, j], j])
+        for name, categories in zip(categorical_features, self.category_sets):
+            categories.update(df[name].fillna("missing").unique().tolist())
+        self.n_rows += len(df)
+        return self
+
+    def finish(self):
+        """Fix the imputer, scaler and encoder parameters once every chunk has been seen."""
+        self.medians = np.array([counts.median() if counts.counts.size else np.nan for counts in self.value_counts])
+        missing = self.n_rows - self.count
+        _, mean, m2 = _combine_moments(self.count, self.mean, self.m2, missing, self.medians, np.zeros_like(self.m2))
+        variance = m2 / max(self.n_rows, 1)
+        self.scaler_mean = mean
+        self.scaler_scale = np.where(variance > 0, np.sqrt(variance), 1.0)
+        self.categories = [np.array(sorted(categories), dtype=object) for categories in self.category_sets]
+        return self
+
+    def transform(self, df):
+        X = df[numeric_features].to_numpy(np.float64)
+        X = np.where(np.isnan(X), self.medians, X)
+        blocks = [(X - self.scaler_mean) / self.scaler_scale]
+        for name, categories in zip(categorical_features, self.categories):
+            values = df[name].fillna("missing").to_numpy(dtype=object)
+            blocks.append((values[:, None] == categories[None, :]).astype(np.float64))
+        return np.hstack(blocks)
+
+    def params(self):
+        return {
+            "rows": int(self.n_rows),
+            "medians": dict(zip(numeric_features, self.medians.tolist())),
+            "scaler_mean": dict(zip(numeric_features, self.scaler_mean.tolist())),
+            "scaler_scale": dict(zip(numeric_features, self.scaler_scale.tolist())),
+            "categories": {name: categories.tolist() for name, categories in zip(categorical_features, self.categories)},
+        }
+
+
+def _combine_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    weight = np.where(count > 0, count_b / np.maximum(count, 1), 0.0)
+    return count, mean_a + delta * weight, m2_a + m2_b + delta ** 2 * count_a * weight
+
+
+class _BucketFiles:
+    """Files that rows are appended to, named by number, of which at most max_open are open at a time:
+    the least recently written is closed to open another, and reopened for appending when needed."""
+
+    def __init__(self, directory, max_open=256):
+        self.directory = directory
+        self.max_open = max_open
+        self._open = collections.OrderedDict()  # bucket -> file
+
+    def path(self, bucket):
+        return os.path.join(self.directory, f"{bucket}.bin")
+
+    def write(self, bucket, data):
+        f = self._open.pop(bucket, None)
+        if f is None:
+            if len(self._open) >= self.max_open:
+                self._open.popitem(last=False)[1].close()
+            f = open(self.path(bucket), "ab")
+        self._open[bucket] = f
+        f.write(data)
+
+    def close(self):
+        while self._open:
+            self._open.popitem()[1].close()
+
+
+def write_shuffled_shards(raw_data_s3_path, preprocessor, output_uri, chunk_rows=100000, shard_rows=100000, seed=None,
+                          max_open_files=256):
+    """Transform the source a chunk at a time into shuffled train, validation and test shards.
+
+    Every row is sent to a split, so that the splits get exactly the sizes of the in-memory mode, and
+    then to a random bucket file within its split, with enough buckets that each holds about shard_rows
+    rows. Each bucket is then read back, shuffled and written as one shard, so the order of the rows in
+    a split is a uniform shuffle while only a chunk or a bucket is in memory at a time. Each split is
+    written as a dataset (see steps/dataset.py) at {output_uri}/{split}.
+
+    The rows of a chunk are sorted by bucket once, and each bucket's run of them appended to its file
+    with one write. At most max_open_files bucket files are open at a time, however many buckets
+    there are.
+
+    Returns:
+        The Datasets of the train, validation and test splits.
+    """
+    rng = np.random.default_rng(seed)
+    remaining = np.array(split_sizes(preprocessor.n_rows))
+    # The buckets of all the splits are numbered in turn: split s has n_buckets[s] from first_bucket[s].
+    n_buckets = np.maximum(1, -(-remaining // shard_rows))
+    first_bucket = np.concatenate([[0], np.cumsum(n_buckets)[:-1]])
+    bucket_dir = tempfile.mkdtemp(prefix="preprocess-buckets-")
+    buckets = _BucketFiles(bucket_dir, max_open_files)
+    n_columns = None
+    try:
+        for df in read_raw_data(raw_data_s3_path, chunksize=chunk_rows):
+            # Rows are stored label first, as the in-memory mode's arrays are.
+            rows = np.column_stack([df[label_column].to_numpy(np.float64), preprocessor.transform(df)]).astype(np.float32)
+            n_columns = rows.shape[1]
+            counts = rng.multivariate_hypergeometric(remaining, len(rows))
+            remaining -= counts
+            assignment = rng.permutation(np.repeat(np.arange(len(split_names)), counts))
+            targets = np.empty(len(rows), dtype=np.intp)
+            for s in range(len(split_names)):
+                in_split = assignment == s
+                targets[in_split] = first_bucket[s] + rng.integers(0, n_buckets[s], size=counts[s])
+            # A stable sort keeps each bucket's rows in chunk order, as writing them bucket by bucket did.
+            order = np.argsort(targets, kind="stable")
+            ends = np.cumsum(np.bincount(targets, minlength=n_buckets.sum()))
+            rows = rows[order]
+            start = 0
+            for bucket, end in enumerate(ends.tolist()):
+                if end > start:
+                    buckets.write(bucket, rows[start:end].tobytes())
+                start = end
+        buckets.close()
+
+        datasets = []
+        for s, split in enumerate(split_names):
+            writer = DatasetWriter(f"{output_uri.rstrip('/')}/{split}")
+            for bucket in range(first_bucket[s], first_bucket[s] + n_buckets[s]):
+                path = buckets.path(bucket)
+                if not os.path.exists(path):
+                    # A bucket that no row was sent to, which only happens to tiny splits.
+                    continue
+                rows = np.fromfile(path, dtype=np.float32).reshape(-1, n_columns or 1)
+                os.remove(path)
+                rows = rows[rng.permutation(len(rows))]
+                writer.write(rows[:, 0], rows[:, 1:])
+            datasets.append(writer.close())
+        return tuple(datasets)
+    finally:
+        buckets.close()
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+
+
+def preprocess(
+    raw_data_s3_path: str,
+    experiment_name: str = "sm-id-pipeline-experiment",
+    run_id: str = None,
+    *,
+    streaming: bool = False,
+    output_uri: str = None,
+    chunk_rows: int = 100000,
+    shard_rows: int = 100000,
+    seed: int = None,
+) -> tuple:
+    """Impute, scale and one-hot encode the raw data, shuffle it and split it 70/15/15.
+
+    By default the whole file is processed in memory and the splits are returned as DataFrames, label
+    first. With output_uri, a local directory or S3 prefix, the splits are written there as datasets
+    (see steps/dataset.py) instead, and their URIs are returned, so the next steps memory-map them
+    rather than getting the DataFrames pickled to them.
+
+    With streaming, the file is read chunk_rows rows at a time, once to fit the transformations and
+    once to write shuffled shards of the splits under output_uri (a new temporary directory by
+    default). Peak memory then depends on chunk_rows and shard_rows, not on the size of the file.
+    """
+    if streaming:
+        return _preprocess_streaming(raw_data_s3_path, experiment_name, run_id, output_uri, chunk_rows, shard_rows, seed)
+
+    start = time.perf_counter()
+    df = read_raw_data(raw_data_s3_path)
+
+    with step_run("DataPreprocessing", "preprocess.py", "PREPROCESS", experiment_name, run_id) as tracker:
+        # Enable autologging in MLflow
+        mlflow.sklearn.autolog(log_datasets=False)
+
+        dataset = mlflow.data.from_pandas(df, source=raw_data_s3_path)
+
+        mlflow.log_input(dataset, context="feature-engineering")
+        numeric_transformer = Pipeline(
+            steps=[
+                ("imputer", SimpleImputer(strategy="median")),
+                ("scaler", StandardScaler()),
+            ]
+        )
+
+        categorical_transformer = Pipeline(
+            steps=[
+                ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
+                ("onehot", OneHotEncoder(handle_unknown="ignore")),
+            ]
+        )
+
+        preprocess = ColumnTransformer(
+            transformers=[
+                ("num", numeric_transformer, numeric_features),
+                ("cat", categorical_transformer, categorical_features),
+            ]
+        )
+
+        y = df.pop("rings")
+        X_pre = preprocess.fit_transform(df)
+        y_pre = y.to_numpy().reshape(len(y), 1)
+
+        X = np.concatenate((y_pre, X_pre), axis=1)
+
+        if seed is not None:
+            np.random.default_rng(seed).shuffle(X)
+        else:
             np.random.shuffle(X)
-            train, validation, test = np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
+        train_size, validation_size, _ = split_sizes(len(X))
+        train, validation, test = np.split(X, [train_size, train_size + validation_size])
+        _log_throughput(tracker, len(X), time.perf_counter() - start)
+
+        if output_uri:
+            write_start = time.perf_counter()
+            splits = [save(split, f"{output_uri.rstrip('/')}/{name}") for name, split in zip(split_names, (train, validation, test))]
+            _log_handoff(tracker, splits, time.perf_counter() - write_start)
+            return tuple(split.uri for split in splits)
 
     return pd.DataFrame(train), pd.DataFrame(validation), pd.DataFrame(test)
+
+
+def _preprocess_streaming(raw_data_s3_path, experiment_name, run_id, output_uri, chunk_rows, shard_rows, seed):
+    output_uri = output_uri or tempfile.mkdtemp(prefix="preprocess-")
+    start = time.perf_counter()
+
+    with step_run("DataPreprocessing", "preprocess.py", "PREPROCESS", experiment_name, run_id) as tracker:
+        tracker.log_params({"streaming": True, "chunk_rows": chunk_rows, "shard_rows": shard_rows})
+
+        # First pass: fit the transformations. The dataset is logged from its first chunk, as
+        # the whole of it is never in memory.
+        preprocessor = StreamingPreprocessor()
+        for i, df in enumerate(read_raw_data(raw_data_s3_path, chunksize=chunk_rows)):
+            if i == 0:
+                dataset = mlflow.data.from_pandas(df, source=raw_data_s3_path)
+                mlflow.log_input(dataset, context="feature-engineering")
+            preprocessor.partial_fit(df)
+        preprocessor.finish()
+        tracker.log_dict(preprocessor.params(), "preprocess_params.json")
+
+        # Second pass: transform and write the shuffled splits.
+        splits = write_shuffled_shards(raw_data_s3_path, preprocessor, output_uri, chunk_rows, shard_rows, seed)
+        _log_throughput(tracker, preprocessor.n_rows, time.perf_counter() - start)
+        tracker.log_metric("handoff_bytes", sum(split.nbytes for split in splits))
+
+    return tuple(split.uri for split in splits)
+
+
+def _log_handoff(tracker, splits, seconds):
+    tracker.log_metrics({"handoff_write_seconds": seconds, "handoff_bytes": sum(split.nbytes for split in splits)})
+
+
+def _log_throughput(tracker, n_rows, seconds):
+    rows_per_second = n_rows / max(seconds, 1e-9)
+    print(f"Preprocessed {n_rows} rows in {seconds:.2f}s ({rows_per_second:.0f} rows/s), peak RSS {peak_rss_mb():.0f} MB")
+    tracker.log_metrics({"preprocess_rows_per_second": rows_per_second, "preprocess_peak_rss_mb": peak_rss_mb()})
@@ -1,10 +1,7 @@
+import concurrent.futures
 import json
-import os
-import tempfile
-import tarfile
 
 import numpy as np
-import s3fs as s3fs
 from sagemaker.core.model_metrics import ModelMetrics, MetricsSource
 from sagemaker.core.s3.utils import s3_path_join
 from sagemaker.core.common_utils import unique_name_from_base
@@ -14,6 +11,10 @@ from sagemaker.core.model_registry import create_model_package_from_containers
 
 import mlflow
 
+from steps.local import local_model_registry, s3_filesystem
+from steps.packaging import DEFAULT_PART_SIZE, archive_name, upload_model_archive
+from steps.tracking import step_run
+
 def register(
     model,
     evaluation,
@@ -21,82 +22,101 @@ def register(
     model_package_group_name,
     bucket,
     experiment_name="sm-id-pipeline-experiment",
-    run_id=None
+    run_id=None,
+    *,
+    codec="gz",
+    compresslevel=6,
+    part_size=DEFAULT_PART_SIZE,
+    upload_workers=4,
 ):
-    sagemaker_session = Session()
-    region = sagemaker_session.boto_region_name
-
-    mlflow.set_tracking_uri(os.environ['MLFLOW_TRACKING_URI'])
-    mlflow.set_experiment(experiment_name)
-    with mlflow.start_run(run_id=run_id) as run:
-        with mlflow.start_run(run_name="Register", nested=True) as nested_run:
-            # Upload evaluation report to s3
-            eval_file_name = unique_name_from_base("evaluation")
-            eval_report_s3_uri = s3_path_join(
-                "s3://", bucket, f"evaluation-report/{eval_file_name}.json"
+    """Upload the evaluation report and the model archive, and register the model.
+
+    The model archive is compressed with codec ("gz" for SageMaker's model servers) at compresslevel
+    and streamed to S3 in parts of part_size bytes, upload_workers of them at a time (see
+    steps/packaging.py), while the report is uploaded and the model is logged to MLflow.
+    """
+    # Without AWS, the model is registered in the local stand-in (see steps/local.py).
+    registry = local_model_registry()
+    if registry is None:
+        sagemaker_session = Session()
+        region = sagemaker_session.boto_region_name
+
+    with step_run("Register", "register.py", "REGISTER", experiment_name, run_id) as tracker:
+        # Upload evaluation report to s3
+        eval_file_name = unique_name_from_base("evaluation")
+        eval_report_s3_uri = s3_path_join(
+            "s3://", bucket, f"evaluation-report/{eval_file_name}.json"
+        )
+
+        tracker.log_param('eval_report_s3_uri', eval_report_s3_uri)
+        s3_fs = s3_filesystem()
+
+        model_metrics = ModelMetrics(
+            model_statistics=MetricsSource(
+                s3_uri=eval_report_s3_uri,
+                content_type="application/json",
             )
+        )
 
-            mlflow.log_param('eval_report_s3_uri', eval_report_s3_uri)
-            s3_fs = s3fs.S3FileSystem()
-            eval_report_str = json.dumps(evaluation)
-            with s3_fs.open(eval_report_s3_uri, "wb") as file:
-                file.write(eval_report_str.encode("utf-8"))
-
-            model_metrics = ModelMetrics(
-                model_statistics=MetricsSource(
-                    s3_uri=eval_report_s3_uri,
-                    content_type="application/json",
-                )
+        # 1. Upload the report, and the model as an archive for SageMaker, while logging the model to MLflow
+        model_s3_uri = s3_path_join("s3://", bucket, f"models/{unique_name_from_base('model')}/{archive_name(codec)}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            report_upload = pool.submit(_upload_report, s3_fs, eval_report_s3_uri, evaluation)
+            model_upload = pool.submit(
+                upload_model_archive, model, s3_fs, model_s3_uri, codec, compresslevel, part_size, upload_workers
             )
 
-            # 1. Log model to MLflow
+            # 2. Log model to MLflow
             model_info = mlflow.xgboost.log_model(model, artifact_path="model")
+            report_upload.result()
+            upload = model_upload.result()
 
-            # 2. Save native XGBoost model and create model.tar.gz for SageMaker
-            tmp_dir = tempfile.mkdtemp()
-            native_model_path = os.path.join(tmp_dir, "xgboost-model")
-            model.save_model(native_model_path)
+        print(f"Uploaded a {upload['model_bytes']} byte model as a {upload['archive_bytes']} byte {codec} archive "
+              f"in {upload['seconds']:.2f}s")
+        tracker.log_params({"model_archive_codec": codec, "model_archive_compresslevel": compresslevel})
+        tracker.log_metrics({
+            "model_bytes": upload["model_bytes"],
+            "model_archive_bytes": upload["archive_bytes"],
+            "model_upload_seconds": upload["seconds"],
+        })
 
-            model_tar_path = tempfile.mktemp(suffix=".tar.gz")
-            with tarfile.open(model_tar_path, "w:gz") as tar:
-                tar.add(native_model_path, arcname="xgboost-model")
-
-            model_s3_uri = s3_path_join("s3://", bucket, f"models/{unique_name_from_base('model')}/model.tar.gz")
-            with s3_fs.open(model_s3_uri, "wb") as f:
-                with open(model_tar_path, "rb") as local_f:
-                    f.write(local_f.read())
-
-            # 3. Register model package directly via core API (no sagemaker.serve dependency)
+        # 3. Register model package directly via core API (no sagemaker.serve dependency)
+        if registry is None:
             image_uri = image_uris.retrieve(
                 framework="xgboost",
                 region=region,
                 version="3.0-5",
             )
-            container_def = {
-                "Image": image_uri,
-                "ModelDataUrl": model_s3_uri,
-            }
-
-            response = create_model_package_from_containers(
-                sagemaker_session=sagemaker_session,
-                containers=[container_def],
-                content_types=["text/csv"],
-                response_types=["text/csv"],
-                inference_instances=["ml.t2.medium", "ml.m5.xlarge"],
-                transform_instances=["ml.m5.xlarge"],
-                model_package_group_name=model_package_group_name,
-                approval_status=model_approval_status,
-                model_metrics=model_metrics._to_request_dict(),
-            )
-            model_package_arn = response.get("ModelPackageArn")
+        else:
+            image_uri = "sagemaker-xgboost:3.0-5"
+        container_def = {
+            "Image": image_uri,
+            "ModelDataUrl": model_s3_uri,
+        }
 
-            mlflow.set_tags({
-                'mlflow.source.name': "register.py",
-                'mlflow.source.type': 'REGISTER',
-            })
+        request = dict(
+            containers=[container_def],
+            content_types=["text/csv"],
+            response_types=["text/csv"],
+            inference_instances=["ml.t2.medium", "ml.m5.xlarge"],
+            transform_instances=["ml.m5.xlarge"],
+            model_package_group_name=model_package_group_name,
+            approval_status=model_approval_status,
+            model_metrics=model_metrics._to_request_dict(),
+        )
+        if registry is None:
+            response = create_model_package_from_containers(sagemaker_session=sagemaker_session, **request)
+        else:
+            response = registry.create_model_package(**request)
+        model_package_arn = response.get("ModelPackageArn")
 
-            mlflow.log_param('mlflow_model_uri', model_info.model_uri)
-            mlflow.log_param('model_package_arn', model_package_arn)
-            print(f"Registered Model Package ARN: {model_package_arn}")
+        tracker.log_param('mlflow_model_uri', model_info.model_uri)
+        tracker.log_param('model_package_arn', model_package_arn)
+        print(f"Registered Model Package ARN: {model_package_arn}")
 
     return model_package_arn
+
+
+def _upload_report(s3_fs, uri, evaluation):
+    with s3_fs.open(uri, "wb") as file:
+        file.write(json.dumps(evaluation).encode("utf-8"))
@@ -0,0 +1,221 @@
+import contextlib
+import os
+import threading
+import time
+
+import mlflow
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.tracking import MlflowClient
+
+# MLflow logging for the steps that keeps the tracking server off their critical path.
+#
+# Each mlflow.log_metric, log_param or set_tags call is a round trip to the tracking server, which the
+# step waits for. A BatchLogger instead buffers metrics, params and tags, and a background thread sends
+# them to the run with MlflowClient.log_batch, a request for up to a few hundred of them at a time,
+# every flush_seconds or as soon as max_pending are waiting. Logging artifacts (log_dict, log_table)
+# and child runs are deferred to the same thread. The buffer is flushed in full when the step's run is
+# closed, so nothing is lost, and an error of the background thread is raised there rather than
+# dropped.
+#
+# step_run() opens the step's nested run under the pipeline's run and gives its BatchLogger, and logs
+# how much of the step's wall time was spent waiting for tracking, as tracking_seconds. Runs are set
+# up with the fluent API as before, so autologging and mlflow.log_input/log_model still apply to them.
+
+# The most of each entity that the tracking server accepts in one log_batch request.
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_TAGS_PER_BATCH = 100
+
+
+class BatchLogger:
+    """Log metrics, params, tags and artifacts to the MLflow run run_id from a background thread.
+
+    Args:
+        run_id (str): The run to log to.
+        flush_seconds (float): The longest anything logged waits in the buffer.
+        max_pending (int): Flush as soon as this many metrics, params and tags are buffered.
+        client (MlflowClient): The client to log with, for the current tracking URI by default.
+    """
+
+    def __init__(self, run_id, flush_seconds=5.0, max_pending=MAX_METRICS_PER_BATCH, client=None):
+        self.run_id = run_id
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.client = client or MlflowClient()
+        # Seconds the calling thread spent in this logger, and the background thread in requests.
+        self.tracking_seconds = 0.0
+        self.background_seconds = 0.0
+        self.requests = 0
+        self._metrics, self._params, self._tags, self._calls = [], {}, {}, []
+        self._sending = False
+        self._flush_requested = False
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"mlflow-batch-{run_id}", daemon=True)
+        self._thread.start()
+
+    # The fluent API's logging functions, for the run of this logger
+
+    def log_metric(self, key, value, step=None):
+        self.log_metrics({key: value}, step)
+
+    def log_metrics(self, metrics, step=None):
+        timestamp = int(time.time() * 1000)
+        self._add(lambda: self._metrics.extend(
+            Metric(key, float(value), timestamp, step or 0) for key, value in metrics.items()
+        ))
+
+    def log_param(self, key, value):
+        self.log_params({key: value})
+
+    def log_params(self, params):
+        self._add(lambda: self._params.update((key, str(value)) for key, value in params.items()))
+
+    def set_tag(self, key, value):
+        self.set_tags({key: value})
+
+    def set_tags(self, tags):
+        self._add(lambda: self._tags.update((key, str(value)) for key, value in tags.items()))
+
+    def log_dict(self, dictionary, artifact_file):
+        self._defer(self.client.log_dict, self.run_id, dictionary, artifact_file)
+
+    def log_table(self, data, artifact_file):
+        self._defer(self.client.log_table, self.run_id, data, artifact_file)
+
+    def log_child_run(self, run_name, params=None, metrics=None, tags=None):
+        """Log a finished nested run of this logger's run, such as a tuning candidate, in the background."""
+        self._defer(self._child_run, run_name, dict(params or {}), dict(metrics or {}), dict(tags or {}),
+                    int(time.time() * 1000))
+
+    def _child_run(self, run_name, params, metrics, tags, timestamp):
+        parent = self.client.get_run(self.run_id)
+        child = self.client.create_run(
+            parent.info.experiment_id,
+            tags=dict(tags, **{"mlflow.parentRunId": self.run_id}),
+            run_name=run_name,
+        )
+        self.client.log_batch(
+            child.info.run_id,
+            metrics=[Metric(key, float(value), timestamp, 0) for key, value in metrics.items()],
+            params=[Param(key, str(value)) for key, value in params.items()],
+        )
+        self.client.set_terminated(child.info.run_id)
+
+    def flush(self):
+        """Wait until everything logged so far has been sent."""
+        start = time.perf_counter()
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._error is not None or not (self._pending() or self._sending))
+            error = self._error
+        self.tracking_seconds += time.perf_counter() - start
+        if error is not None:
+            raise error
+
+    def close(self, raise_errors=True):
+        """Flush, and stop the background thread."""
+        try:
+            self.flush()
+        except Exception:
+            if raise_errors:
+                raise
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._thread.join()
+
+    def _add(self, append):
+        start = time.perf_counter()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(f"BatchLogger for run {self.run_id} is closed")
+            append()
+            if self._pending() >= self.max_pending:
+                self._condition.notify_all()
+        self.tracking_seconds += time.perf_counter() - start
+
+    def _defer(self, fn, *args):
+        self._add(lambda: self._calls.append((fn, args)))
+
+    def _pending(self):
+        return len(self._metrics) + len(self._params) + len(self._tags) + len(self._calls)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or self._flush_requested or self._pending() >= self.max_pending,
+                    timeout=self.flush_seconds,
+                )
+                if self._closed and not self._pending():
+                    return
+                metrics, params, tags, calls = self._metrics, self._params, self._tags, self._calls
+                self._metrics, self._params, self._tags, self._calls = [], {}, {}, []
+                self._flush_requested = False
+                self._sending = True
+            start = time.perf_counter()
+            try:
+                self._send(metrics, list(params.items()), list(tags.items()))
+                for fn, args in calls:
+                    fn(*args)
+                    self.requests += 1
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+            finally:
+                self.background_seconds += time.perf_counter() - start
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _send(self, metrics, params, tags):
+        while metrics or params or tags:
+            batch_params, params = params[:MAX_PARAMS_TAGS_PER_BATCH], params[MAX_PARAMS_TAGS_PER_BATCH:]
+            batch_tags, tags = tags[:MAX_PARAMS_TAGS_PER_BATCH], tags[MAX_PARAMS_TAGS_PER_BATCH:]
+            # The total of the three is limited too, to the same as the metrics.
+            n_metrics = MAX_METRICS_PER_BATCH - len(batch_params) - len(batch_tags)
+            batch_metrics, metrics = metrics[:n_metrics], metrics[n_metrics:]
+            self.client.log_batch(
+                self.run_id,
+                metrics=batch_metrics,
+                params=[Param(key, value) for key, value in batch_params],
+                tags=[RunTag(key, value) for key, value in batch_tags],
+            )
+            self.requests += 1
+
+
+@contextlib.contextmanager
+def step_run(run_name, source_name, source_type, experiment_name, run_id=None, **logger_options):
+    """Open a step's nested run, named run_name, under the pipeline's run run_id, and give its BatchLogger.
+
+    The run is tagged with mlflow.source.name and mlflow.source.type. On exit, the logger is flushed,
+    and the seconds the step spent waiting for tracking, in setting up the runs, logging and the final
+    flush, are logged as tracking_seconds, with the step's wall time as step_seconds.
+    """
+    start = time.perf_counter()
+    mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+    mlflow.set_experiment(experiment_name)
+    with mlflow.start_run(run_id=run_id):
+        with mlflow.start_run(run_name=run_name, nested=True) as run:
+            logger = BatchLogger(run.info.run_id, **logger_options)
+            logger.tracking_seconds += time.perf_counter() - start
+            logger.set_tags({"mlflow.source.name": source_name, "mlflow.source.type": source_type})
+            try:
+                yield logger
+            except BaseException:
+                logger.close(raise_errors=False)
+                raise
+            logger.close()
+            step_seconds = time.perf_counter() - start
+            print(f"{run_name}: {logger.tracking_seconds:.2f}s of {step_seconds:.2f}s spent waiting for tracking, "
+                  f"{logger.requests} requests sent in the background in {logger.background_seconds:.2f}s")
+            logger.client.log_batch(run.info.run_id, metrics=[
+                Metric(key, value, int(time.time() * 1000), 0) for key, value in {
+                    "tracking_seconds": logger.tracking_seconds,
+                    "tracking_background_seconds": logger.background_seconds,
+                    "step_seconds": step_seconds,
+                }.items()
+            ])
@@ -1,9 +1,53 @@
+import atexit
 import pandas as pd
 import os
+import resource
+import shutil
+import tempfile
+import time
 
 import xgboost
 import mlflow
 
+from steps.dataset import as_dataset
+from steps.tracking import step_run
+from steps.tuning import sample_candidates, successive_halving
+
+data_modes = ("memory", "quantile", "external")
+
+
+def build_dmatrices(train_data, validation_data, data_mode="memory", max_bin=256, batch_rows=None, cache_dir=None):
+    """The training and validation DMatrix of two Datasets.
+
+    data_mode is one of:
+        memory: DMatrix of the whole features, as arrays in memory.
+        quantile: QuantileDMatrix fed a batch at a time from the datasets' shards, so only the
+            quantized features are held in memory.
+        external: ExtMemQuantileDMatrix, which also keeps the quantized batches in cache files under
+            cache_dir (a temporary directory by default) rather than in memory.
+    The validation set is quantized with the training set's bins in both of the latter.
+    """
+    if data_mode == "memory":
+        return train_data.dmatrix(), validation_data.dmatrix()
+    if data_mode == "quantile":
+        train_dmatrix = train_data.quantile_dmatrix(batch_rows, max_bin=max_bin)
+        return train_dmatrix, validation_data.quantile_dmatrix(batch_rows, max_bin=max_bin, ref=train_dmatrix)
+    if data_mode == "external":
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix="xgboost-cache-")
+            atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+        train_dmatrix = train_data.external_dmatrix(os.path.join(cache_dir, "train"), batch_rows, max_bin=max_bin)
+        validation_dmatrix = validation_data.external_dmatrix(
+            os.path.join(cache_dir, "validation"), batch_rows, max_bin=max_bin, ref=train_dmatrix
+        )
+        return train_dmatrix, validation_dmatrix
+    raise ValueError(f"data_mode must be one of {data_modes}, got {data_mode!r}")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
 def train(
     train_df,
     validation_df,
@@ -16,47 +60,71 @@ def train(
     min_child_weight=6,
     subsample=0.7,
     use_gpu=False,
+    data_mode="memory",
+    max_bin=256,
+    batch_rows=None,
+    cache_dir=None,
+    tune_candidates=None,
+    tune_workers=None,
+    tune_min_rounds=5,
+    tune_reduction=3,
+    seed=None,
     experiment_name = "sm-id-pipeline-experiment",
     run_id=None
 ):
+    """Train an XGBoost regressor with early stopping on the validation set.
 
-    # Enable autologging in MLflow
-    mlflow.set_tracking_uri(os.environ['MLFLOW_TRACKING_URI'])
-    mlflow.set_experiment(experiment_name)
-    with mlflow.start_run(run_id=run_id) as run:
-        with mlflow.start_run(run_name="Train", nested=True):
-            # enable mlflow autolog
-            mlflow.xgboost.autolog()
-
-            y_train = train_df.iloc[:, 0].to_numpy()
-            train_df.drop(train_df.columns[0], axis=1, inplace=True)
-            x_train = train_df.to_numpy()
-            train_dmatrix = xgboost.DMatrix(x_train, label=y_train)
-
-            y_validation = validation_df.iloc[:, 0].to_numpy()
-            validation_df.drop(validation_df.columns[0], axis=1, inplace=True)
-            x_validation = validation_df.to_numpy()
-            validation_dmatrix = xgboost.DMatrix(x_validation, label=y_validation)
-
-            param = {
-                "objective": objective,
-                "max_depth": max_depth,
-                "eta": eta,
-                "gamma": gamma,
-                "min_child_weight": min_child_weight,
-                "subsample": subsample,
-                "tree_method": "gpu_hist"
-                if use_gpu
-                else "hist",  # Use GPU accelerated algorithm
-            }
-
-            mlflow.set_tags(
-                {
-                    'mlflow.source.name': "train.py",
-                    'mlflow.source.type': 'TRAIN',
-                }
-            )
+    With data_mode "quantile" or "external" (see build_dmatrices), the splits are fed to XGBoost from
+    their shards, batch_rows rows at most at a time, instead of as whole arrays, for datasets too large
+    to hold in memory several times over.
+
+    With tune_candidates, a number of random candidates or a list of dicts of parameters, the step tunes
+    instead (see steps/tuning.py): the candidates, each overriding the parameters above, are trained
+    tune_workers at a time and cut down by successive halving on validation RMSE, and the best one's
+    booster is returned. Each candidate is logged as a nested MLflow run.
+    """
+    start = time.perf_counter()
+
+    with step_run("Train", "train.py", "TRAIN", experiment_name, run_id) as tracker:
+        # enable mlflow autolog, except when tuning, which logs the candidates itself rather than a
+        # run for every xgboost.train call
+        mlflow.xgboost.autolog(disable=bool(tune_candidates))
+        if tune_candidates and data_mode == "memory":
+            # The candidates share the DMatrix from several threads, so it is quantized up front.
+            data_mode = "quantile"
+
+        # The splits are DataFrames with the label first, or the URIs of datasets written by the
+        # preprocessing step, which are memory-mapped rather than copied.
+        load_start = time.perf_counter()
+        train_data = as_dataset(train_df)
+        validation_data = as_dataset(validation_df)
+        train_dmatrix, validation_dmatrix = build_dmatrices(
+            train_data, validation_data, data_mode, max_bin, batch_rows, cache_dir
+        )
+        tracker.log_param("data_mode", data_mode)
+        tracker.log_metrics({
+            "handoff_load_seconds": time.perf_counter() - load_start,
+            "handoff_bytes": train_data.nbytes + validation_data.nbytes,
+        })
 
+        param = {
+            "objective": objective,
+            "max_depth": max_depth,
+            "eta": eta,
+            "gamma": gamma,
+            "min_child_weight": min_child_weight,
+            "subsample": subsample,
+            # The quantile and external DMatrix are binned when they are built, with this max_bin.
+            "max_bin": max_bin,
+            "tree_method": "gpu_hist"
+            if use_gpu
+            else "hist",  # Use GPU accelerated algorithm
+        }
+
+        if tune_candidates:
+            booster = _tune(tracker, param, train_dmatrix, validation_dmatrix, num_round, tune_candidates,
+                            tune_workers, tune_min_rounds, tune_reduction, seed)
+        else:
             evaluation_results = {}  # Store accuracy result
             booster = xgboost.train(
                 param,
@@ -66,6 +134,32 @@ def train(
                 early_stopping_rounds=5,
                 evals_result=evaluation_results,
             )
+        seconds = time.perf_counter() - start
+        print(f"Trained on {train_data.rows} rows ({data_mode}{', tuning' if tune_candidates else ''}) in {seconds:.2f}s, peak RSS {peak_rss_mb():.0f} MB")
+        tracker.log_metrics({"train_seconds": seconds, "train_peak_rss_mb": peak_rss_mb()})
+
+    return booster
 
 
+def _tune(tracker, param, train_dmatrix, validation_dmatrix, num_round, candidates, workers, min_rounds, reduction, seed):
+    if isinstance(candidates, int):
+        candidates = sample_candidates(candidates, seed=seed)
+    booster, results = successive_halving(
+        param, candidates, train_dmatrix, validation_dmatrix, num_round,
+        min_rounds=min_rounds, reduction=reduction, workers=workers, seed=seed,
+    )
+    for result in results:
+        tracker.log_child_run(f"Candidate-{result['candidate']}", result["params"], {
+            "validation_rmse": result["validation_rmse"],
+            "best_rounds": result["best_rounds"],
+            "rounds": result["rounds"],
+            "rungs": result["rungs"],
+            "seconds": result["seconds"],
+        })
+    best = results[0]
+    print(f"Best of {len(results)} candidates: {best['params']}, validation RMSE {best['validation_rmse']:.4f} "
+          f"after {best['best_rounds']} rounds")
+    tracker.log_params({f"best_{name}": value for name, value in best["params"].items()})
+    tracker.log_metrics({"best_validation_rmse": best["validation_rmse"], "best_rounds": best["best_rounds"]})
+    tracker.log_dict({"candidates": results}, "tuning_results.json")
     return booster
@@ -0,0 +1,142 @@
+import concurrent.futures
+import math
+import os
+import time
+
+import numpy as np
+import xgboost
+
+# Successive halving over XGBoost parameter candidates, for the training step's tuning mode.
+#
+# Every candidate is trained for min_rounds boosting rounds, then the best 1/reduction of them, by
+# validation RMSE, for reduction times as many rounds in all, and so on until they reach num_round or
+# one is left, which is trained up to num_round, so most of the rounds go to the candidates that are
+# doing best. The candidates of a rung are trained concurrently in threads, which XGBoost releases the
+# GIL in, on the same training and validation DMatrix, so the data is quantized once for all of them.
+# Each continues from its booster of the previous rung rather than starting over.
+#
+# Each candidate has its own seed, so that its row and column sampling does not depend on which thread
+# trains it, or after which other candidates: the scores, and so the ranking, are the same for any
+# number of workers. XGBoost keeps its random state per thread and only reseeds it when the seed
+# parameter changes, which continuing a booster with the same parameters does not, so every rung is
+# trained with a seed of its own, derived from the candidate's.
+
+# The space sample_candidates draws from: name -> (low, high, scale)
+SEARCH_SPACE = {
+    "max_depth": (3, 10, "int"),
+    "eta": (0.03, 0.3, "log"),
+    "gamma": (0.0, 8.0, "linear"),
+    "min_child_weight": (1.0, 10.0, "log"),
+    "subsample": (0.5, 1.0, "linear"),
+    "colsample_bytree": (0.5, 1.0, "linear"),
+}
+
+
+def sample_candidates(n, seed=None, space=SEARCH_SPACE):
+    """n random parameter dicts from space."""
+    rng = np.random.default_rng(seed)
+    candidates = []
+    for _ in range(n):
+        candidate = {}
+        for name, (low, high, scale) in space.items():
+            if scale == "int":
+                candidate[name] = int(rng.integers(low, high + 1))
+            elif scale == "log":
+                candidate[name] = float(math.exp(rng.uniform(math.log(low), math.log(high))))
+            else:
+                candidate[name] = float(rng.uniform(low, high))
+        candidates.append(candidate)
+    return candidates
+
+
+class Candidate:
+    def __init__(self, index, params, seed):
+        self.index = index
+        # A seed given with the parameters is kept.
+        self.params = dict({"seed": seed}, **params)
+        self.booster = None
+        self.rounds = 0  # boosting rounds trained so far
+        self.best_rounds = 0  # the number of rounds with the best validation RMSE
+        self.score = math.inf  # that RMSE
+        self.converged = False  # stopped early, so more rounds would not help
+        self.seconds = 0.0
+        self.rungs = 0
+
+    def train(self, base_params, train_dmatrix, validation_dmatrix, rounds, early_stopping_rounds):
+        start = time.perf_counter()
+        evals_result = {}
+        rung_seed = int(np.random.SeedSequence([self.params["seed"], self.rungs]).generate_state(1)[0])
+        booster = xgboost.train(
+            dict(base_params, **dict(self.params, seed=rung_seed)),
+            train_dmatrix,
+            rounds - self.rounds,
+            evals=[(validation_dmatrix, "validation")],
+            early_stopping_rounds=early_stopping_rounds,
+            evals_result=evals_result,
+            xgb_model=self.booster,
+            verbose_eval=False,
+        )
+        scores = evals_result["validation"]["rmse"]
+        best = int(np.argmin(scores))
+        if scores[best] < self.score:
+            self.score, self.best_rounds = float(scores[best]), self.rounds + best + 1
+        self.converged = len(scores) < rounds - self.rounds
+        self.booster, self.rounds = booster, self.rounds + len(scores)
+        self.seconds += time.perf_counter() - start
+        self.rungs += 1
+        return self
+
+    def result(self):
+        return {
+            "candidate": self.index,
+            "params": self.params,
+            "validation_rmse": self.score,
+            "best_rounds": self.best_rounds,
+            "rounds": self.rounds,
+            "rungs": self.rungs,
+            "seconds": self.seconds,
+        }
+
+
+def successive_halving(base_params, candidates, train_dmatrix, validation_dmatrix, num_round,
+                       min_rounds=5, reduction=3, early_stopping_rounds=5, workers=None, seed=None):
+    """Tune candidates, dicts of parameters that override base_params, by successive halving.
+
+    Args:
+        num_round (int): The most boosting rounds any candidate is trained for.
+        min_rounds (int): The rounds every candidate is trained for in the first rung.
+        reduction (int): The factor the candidates are cut by, and their rounds raised by, at each rung.
+        workers (int): Candidates trained at once; each gets an equal share of the CPUs as nthread.
+        seed (int): Candidate i is seeded with seed + i, unless its parameters have a "seed", and each
+            of its rungs with a seed derived from that. By default, base_params' seed or 0.
+
+    Returns:
+        (booster, results): the best candidate's booster, cut to its best round, and a dict per
+        candidate of its parameters, with its seed, validation RMSE, rounds and wall time, best first.
+    """
+    workers = workers or min(len(candidates), os.cpu_count() or 1)
+    base_params = dict(base_params, nthread=max(1, (os.cpu_count() or 1) // workers))
+    if base_params.get("objective") == "reg:linear":
+        # A deprecated alias, which a booster trained with cannot be sliced to its best round.
+        base_params["objective"] = "reg:squarederror"
+    seed = base_params.pop("seed", 0) if seed is None else seed
+    everyone = [Candidate(i, params, seed + i) for i, params in enumerate(candidates)]
+    alive = list(everyone)
+    rounds = min(min_rounds, num_round)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            training = [candidate for candidate in alive if not candidate.converged and candidate.rounds < rounds]
+            list(pool.map(
+                lambda candidate: candidate.train(base_params, train_dmatrix, validation_dmatrix, rounds, early_stopping_rounds),
+                training,
+            ))
+            if rounds >= num_round:
+                break
+            alive = sorted(alive, key=lambda candidate: candidate.score)[:max(1, len(alive) // reduction)]
+            # The last candidate left gets the rest of the rounds.
+            rounds = num_round if len(alive) == 1 else min(rounds * reduction, num_round)
+
+    best = min(everyone, key=lambda candidate: candidate.score)
+    booster = best.booster[:best.best_rounds]
+    results = sorted((candidate.result() for candidate in everyone), key=lambda result: result["validation_rmse"])
+    return booster, results
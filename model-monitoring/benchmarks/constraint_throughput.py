@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Throughput of the postprocessor's constraint checks, in records/sec and records/minute.
+#
+# Suggests constraints from test_data/training-dataset-with-header.csv the way a Model Monitor baseline
+# job would (completeness, Integral or Fractional, non-negative), then times ConstraintChecker.update
+# on matrices of rows sampled from the training data, and the whole path from data capture lines
+# through the postprocessor's copy of preprocess_batch, which is what postprocess_handler runs, after
+# checking that the copy agrees with preprocessor.py.
+#
+#     python benchmarks/constraint_throughput.py --records 1000000
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import postprocessor  # noqa: E402
+from postprocessor import COLUMNS, ConstraintChecker  # noqa: E402
+from preprocessor import FEATURE_NAMES, preprocess_batch  # noqa: E402
+from preprocess_throughput import make_capture_lines  # noqa: E402
+
+TRAINING = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_data", "training-dataset-with-header.csv")
+
+
+def suggest_constraints(frame):
+    features = []
+    for name in FEATURE_NAMES:
+        values = frame[name].to_numpy(np.float64)
+        features.append({
+            "name": name,
+            "inferred_type": "Integral" if np.all(values == np.round(values)) else "Fractional",
+            "completeness": 1.0,
+            "num_constraints": {"is_non_negative": bool(values.min() >= 0)},
+        })
+    return {"version": 0.0, "features": features, "monitoring_config": {"datatype_check_threshold": 1.0}}
+
+
+def rate(fn, n_records, min_seconds):
+    runs = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_seconds:
+        fn()
+        runs += 1
+    return n_records * runs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--capture-records", type=int, default=100000)
+    parser.add_argument("--min-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    frame = pd.read_csv(TRAINING)
+    constraints = suggest_constraints(frame)
+    rng = np.random.default_rng(0)
+    rows = frame[FEATURE_NAMES].to_numpy(np.float64)[rng.integers(0, len(frame), size=args.records)]
+    matrix = np.asfortranarray(np.column_stack([rows, rng.random(args.records)]))
+    assert matrix.shape[1] == len(COLUMNS)
+
+    checker = ConstraintChecker(constraints)
+    checks = rate(lambda: checker.update(matrix), args.records, args.min_seconds)
+    assert not checker.violations(), checker.violations()
+
+    captures = [json.loads(line) for line in make_capture_lines(args.capture_records, "BASE64")]
+    # The postprocessor has its own copy of the preprocessor's feature names and parsing, as it runs alone.
+    assert postprocessor.FEATURE_NAMES == FEATURE_NAMES
+    for parsed, expected in zip(postprocessor.parse_records(captures), preprocess_batch(captures)):
+        np.testing.assert_array_equal(parsed, expected)
+    end_to_end = rate(lambda: ConstraintChecker(constraints).update_records(captures), args.capture_records, args.min_seconds)
+
+    print("{:>28} {:>14} {:>16}".format("", "records/s", "records/minute"))
+    print("{:>28} {:>14.0f} {:>16.0f}".format("ConstraintChecker.update", checks, checks * 60))
+    print("{:>28} {:>14.0f} {:>16.0f}".format("capture lines, with decoding", end_to_end, end_to_end * 60))
+
+
+if __name__ == "__main__":
+    main()
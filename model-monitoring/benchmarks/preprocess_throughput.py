@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Throughput of the record preprocessor, in records/sec.
+#
+# Builds data capture records from the rows of test_data/test_sample.csv, with the payloads base64 or
+# CSV encoded the way data capture writes them, and decodes them three ways: with the original
+# csv.reader-per-record handler, with preprocess_handler, which calls preprocess_batch on the one record,
+# and with preprocess_batch in batches of the given sizes. Checks that all three agree before timing.
+#
+#     python benchmarks/preprocess_throughput.py --records 100000 --batch-sizes 1000 100000
+
+from __future__ import print_function
+
+import argparse
+import base64
+import csv
+import io
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from preprocessor import CATEGORIES, FEATURE_NAMES, INVALID_CODE, NUMERIC_NAMES, preprocess_batch, preprocess_handler  # noqa: E402
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_data", "test_sample.csv")
+
+
+def reference_handler(inference_record):
+    """The handler as it was before the batch API: one csv.reader and one dict per record."""
+    def decode(data, encoding):
+        if encoding == "BASE64":
+            return base64.b64decode(data).decode("utf-8")
+        return data
+
+    input_csv = decode(inference_record.endpoint_input.data, inference_record.endpoint_input.encoding)
+    values = next(csv.reader(io.StringIO(input_csv.strip())))
+    result = {name: float(val) for name, val in zip(FEATURE_NAMES, values)}
+    output_csv = decode(inference_record.endpoint_output.data, inference_record.endpoint_output.encoding)
+    result["prediction"] = float(output_csv.strip())
+    return result
+
+
+def make_capture_lines(n_records, encoding, seed=0):
+    """JSONL data capture lines for n_records inferences on rows of the sample file."""
+    with open(SAMPLE) as inp:
+        rows = [line.strip() for line in inp if line.strip()]
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in rng.integers(0, len(rows), size=n_records):
+        input_csv = rows[i] + "\n"
+        output_csv = "{:.6f}\n".format(rng.random())
+        if encoding == "BASE64":
+            input_csv = base64.b64encode(input_csv.encode("utf-8")).decode("ascii")
+            output_csv = base64.b64encode(output_csv.encode("utf-8")).decode("ascii")
+        lines.append(json.dumps({
+            "captureData": {
+                "endpointInput": {"observedContentType": "text/csv", "mode": "INPUT", "data": input_csv, "encoding": encoding},
+                "endpointOutput": {"observedContentType": "text/csv", "mode": "OUTPUT", "data": output_csv, "encoding": encoding},
+            },
+            "eventMetadata": {"eventId": str(i), "inferenceTime": "2024-01-01T00:00:00Z"},
+            "eventVersion": "0",
+        }))
+    return lines
+
+
+def as_inference_record(capture):
+    """The attribute-style record that Model Monitor passes to preprocess_handler."""
+    data = capture["captureData"]
+    return SimpleNamespace(
+        endpoint_input=SimpleNamespace(data=data["endpointInput"]["data"], encoding=data["endpointInput"]["encoding"]),
+        endpoint_output=SimpleNamespace(data=data["endpointOutput"]["data"], encoding=data["endpointOutput"]["encoding"]),
+    )
+
+
+def timed(fn, min_seconds):
+    """Seconds per call of fn, repeating it for at least min_seconds."""
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / runs
+
+
+def check(captures, records):
+    features, predictions = preprocess_batch(captures)
+    numeric, codes, _ = preprocess_batch(captures, compact=True)
+    for i, record in enumerate(records[:1000]):
+        expected = reference_handler(record)
+        assert preprocess_handler(record) == expected
+        assert features[i].tolist() == [expected[name] for name in FEATURE_NAMES]
+        assert predictions[i] == expected["prediction"]
+        compact = preprocess_handler(record, compact=True)
+        assert [compact[name] for name in NUMERIC_NAMES] == numeric[i].tolist()
+        assert [compact[group] for group in CATEGORIES] == [
+            categories[code] if code != INVALID_CODE else None for categories, code in zip(CATEGORIES.values(), codes[i])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--encodings", nargs="+", default=["BASE64", "CSV"])
+    parser.add_argument("--min-seconds", type=float, default=1.0)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print("{:>8} {:>24} {:>10} {:>14} {:>8}".format("encoding", "method", "batch", "records/s", "speedup"))
+    for encoding in args.encodings:
+        captures = [json.loads(line) for line in make_capture_lines(args.records, encoding)]
+        records = [as_inference_record(capture) for capture in captures]
+        check(captures, records)
+
+        baseline = None
+        cases = [
+            ("reference_handler", 1, lambda: [reference_handler(r) for r in records]),
+            ("preprocess_handler", 1, lambda: [preprocess_handler(r) for r in records]),
+        ]
+        for batch_size in args.batch_sizes:
+            cases.append(("preprocess_batch", batch_size, lambda b=batch_size: [
+                preprocess_batch(captures[i:i + b]) for i in range(0, len(captures), b)]))
+        for method, batch_size, fn in cases:
+            rate = len(records) / timed(fn, args.min_seconds)
+            baseline = baseline or rate
+            results.append({"encoding": encoding, "method": method, "batch_size": batch_size, "records_per_second": rate})
+            print("{:>8} {:>24} {:>10} {:>14.0f} {:>7.1f}x".format(encoding, method, batch_size, rate, rate / baseline))
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({"records": args.records, "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
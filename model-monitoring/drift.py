@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+
+# Streaming, mergeable statistics of captured traffic and their drift from a baseline.
+#
+# StreamStats keeps, for every column of the FEATURE_NAMES schema plus the prediction, the count of
+# values and of missing ones, the mean and variance (Welford's update, combined across batches with
+# Chan's formula), the minimum and maximum, and a QuantileSketch. The sketch buckets values on a log
+# scale, so its quantiles are within a fixed relative error and its size depends on the range of the
+# values rather than their number; it doubles as the column's histogram. All of this is additive, so
+# the statistics of separate files, processes or time windows can be merged into the statistics of
+# their union, and it serializes to JSON.
+#
+# CompactStats does the same for the columns that are not one-hot, and keeps a CategoryStats frequency
+# table of the categorical codes of each one-hot group (see preprocessor.encode_categories) instead of
+# statistics of every one-hot column: 4 tables rather than 58 columns of means, variances and sketches.
+#
+# drift_report compares current statistics with baseline ones. For each column it gives the
+# population stability index (PSI) over bins cut at the baseline's deciles, the shift of the mean in
+# baseline standard deviations, and the change in the missing rate. For each one-hot group of compact
+# statistics it gives the PSI of the category frequencies and the change in the rate of invalid codes.
+#
+#     python drift.py baseline --csv test_data/training-dataset-with-header.csv --out baseline.json
+#     python drift.py update --state state.json capture/*.jsonl
+#     python drift.py check --baseline baseline.json --state state.json
+#
+# Pass --compact to baseline to keep compact statistics; update and check follow the baseline or state.
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from preprocessor import CATEGORIES, FEATURE_NAMES, INVALID_CODE, NUMERIC_NAMES, encode_categories, preprocess_batch
+
+COLUMNS = FEATURE_NAMES + ["prediction"]
+NUMERIC_COLUMNS = NUMERIC_NAMES + ["prediction"]
+# The usual reading of PSI: below 0.1 no change, 0.1 to 0.2 a moderate one, above 0.2 a significant one.
+PSI_THRESHOLD = 0.2
+
+
+class QuantileSketch(object):
+    """A DDSketch: counts of values in logarithmically sized buckets.
+
+    Args:
+        alpha (float): The relative accuracy of the quantiles.
+        max_buckets (int): The most buckets kept for each sign. When there are more, the ones nearest
+            zero are collapsed into one, which only affects the accuracy of the smallest values.
+    """
+
+    def __init__(self, alpha=0.01, max_buckets=2048):
+        self.alpha = alpha
+        self.max_buckets = max_buckets
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}  # bucket index -> count; bucket i holds values in (gamma**(i-1), gamma**i]
+        self.negative = {}  # the same for the magnitudes of negative values
+        self.zero = 0
+        self.count = 0
+
+    def update(self, values):
+        """Add a 1-D array of values, which must not contain NaN."""
+        values = np.asarray(values, dtype=np.float64)
+        self.count += values.size
+        self.zero += int(np.count_nonzero(values == 0))
+        self._add(self.positive, values[values > 0])
+        self._add(self.negative, -values[values < 0])
+
+    def _add(self, store, magnitudes):
+        if magnitudes.size == 0:
+            return
+        indexes, counts = np.unique(np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+        self._collapse(store)
+
+    def _collapse(self, store):
+        if len(store) <= self.max_buckets:
+            return
+        indexes = sorted(store)
+        keep = indexes[len(store) - self.max_buckets]
+        store[keep] = sum(store.pop(index) for index in indexes[:len(store) - self.max_buckets]) + store[keep]
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with accuracies {} and {}".format(self.alpha, other.alpha))
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+            self._collapse(store)
+        self.zero += other.zero
+        self.count += other.count
+        return self
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def buckets(self):
+        """(value, count) pairs in increasing order of value: the sketch's histogram."""
+        pairs = [(-self._value(i), self.negative[i]) for i in sorted(self.negative, reverse=True)]
+        if self.zero:
+            pairs.append((0.0, self.zero))
+        pairs.extend((self._value(i), self.positive[i]) for i in sorted(self.positive))
+        return pairs
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float("nan")
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self.buckets():
+            seen += count
+            if seen > rank:
+                return value
+        return value
+
+    def cdf(self, x):
+        """The fraction of values that are at most x."""
+        if self.count == 0:
+            return float("nan")
+        return sum(count for value, count in self.buckets() if value <= x) / float(self.count)
+
+    def to_dict(self):
+        return {
+            "alpha": self.alpha,
+            "max_buckets": self.max_buckets,
+            "positive": {str(i): n for i, n in self.positive.items()},
+            "negative": {str(i): n for i, n in self.negative.items()},
+            "zero": self.zero,
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["alpha"], state["max_buckets"])
+        sketch.positive = {int(i): n for i, n in state["positive"].items()}
+        sketch.negative = {int(i): n for i, n in state["negative"].items()}
+        sketch.zero = state["zero"]
+        sketch.count = state["count"]
+        return sketch
+
+
+class StreamStats(object):
+    """Per-column statistics that are updated a batch of rows at a time and can be merged.
+
+    Args:
+        names (list of str): The column names, COLUMNS by default.
+        alpha (float): The relative accuracy of the quantile sketches.
+    """
+
+    def __init__(self, names=None, alpha=0.01):
+        self.names = list(names or COLUMNS)
+        n = len(self.names)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.missing = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)  # the sum of squared differences from the mean
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.sketches = [QuantileSketch(alpha) for _ in self.names]
+
+    def update(self, matrix):
+        """Add an (n_rows, n_columns) array of values, NaN where a value is missing. Column-major
+        arrays, such as those from preprocess_batch, are read without copying."""
+        X = np.asarray(matrix, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != len(self.names):
+            raise ValueError("Expected rows of {} values, got an array of shape {}".format(len(self.names), X.shape))
+        missing = np.isnan(X)
+        n = X.shape[0] - missing.sum(axis=0)
+        filled = np.where(missing, 0.0, X)
+        mean = filled.sum(axis=0) / np.maximum(n, 1)
+        m2 = np.where(missing, 0.0, (X - mean) ** 2).sum(axis=0)
+        self._combine(n, mean, m2)
+        self.missing += missing.sum(axis=0)
+        self.min = np.minimum(self.min, np.where(missing, np.inf, X).min(axis=0, initial=np.inf))
+        self.max = np.maximum(self.max, np.where(missing, -np.inf, X).max(axis=0, initial=-np.inf))
+        for j, sketch in enumerate(self.sketches):
+            column = X[:, j]
+            sketch.update(column[~missing[:, j]])
+        return self
+
+    def update_records(self, records):
+        """Add inference records, or data capture lines, via preprocessor.preprocess_batch."""
+        features, predictions = preprocess_batch(records)
+        return self.update(np.column_stack([features, predictions]))
+
+    def _combine(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self.mean
+        scale = np.where(total > 0, n / np.maximum(total, 1), 0.0)
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * scale
+        self.mean = self.mean + delta * scale
+        self.count = total
+
+    def merge(self, other):
+        if other.names != self.names:
+            raise ValueError("Cannot merge statistics of different columns")
+        self._combine(other.count, other.mean, other.m2)
+        self.missing += other.missing
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+        return self
+
+    @property
+    def variance(self):
+        return np.where(self.count > 1, self.m2 / np.maximum(self.count - 1, 1), np.nan)
+
+    def summary(self):
+        """A dict of the statistics of each column."""
+        std = np.sqrt(self.variance)
+        return {
+            name: {
+                "count": int(self.count[j]),
+                "missing": int(self.missing[j]),
+                "mean": float(self.mean[j]) if self.count[j] else None,
+                "std": float(std[j]) if self.count[j] > 1 else None,
+                "min": float(self.min[j]) if self.count[j] else None,
+                "max": float(self.max[j]) if self.count[j] else None,
+                "p50": _or_none(self.sketches[j].quantile(0.5)),
+                "p90": _or_none(self.sketches[j].quantile(0.9)),
+                "p99": _or_none(self.sketches[j].quantile(0.99)),
+            }
+            for j, name in enumerate(self.names)
+        }
+
+    def to_dict(self):
+        return {
+            "names": self.names,
+            "count": self.count.tolist(),
+            "missing": self.missing.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "min": [_or_none(v) for v in self.min.tolist()],
+            "max": [_or_none(v) for v in self.max.tolist()],
+            "sketches": [sketch.to_dict() for sketch in self.sketches],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls(state["names"])
+        stats.count = np.array(state["count"], dtype=np.int64)
+        stats.missing = np.array(state["missing"], dtype=np.int64)
+        stats.mean = np.array(state["mean"])
+        stats.m2 = np.array(state["m2"])
+        stats.min = np.array([np.inf if v is None else v for v in state["min"]])
+        stats.max = np.array([-np.inf if v is None else v for v in state["max"]])
+        stats.sketches = [QuantileSketch.from_dict(sketch) for sketch in state["sketches"]]
+        return stats
+
+    def save(self, path):
+        with open(path, "w") as out:
+            json.dump(self.to_dict(), out)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as inp:
+            return cls.from_dict(json.load(inp))
+
+
+class CategoryStats(object):
+    """Frequency tables of the codes of categorical columns.
+
+    Args:
+        categories (OrderedDict): The categories of each column, in the order of their codes.
+            preprocessor.CATEGORIES by default.
+    """
+
+    def __init__(self, categories=None):
+        self.categories = OrderedDict(categories or CATEGORIES)
+        # One count per category, then the count of INVALID_CODE
+        self.counts = [np.zeros(len(names) + 1, dtype=np.int64) for names in self.categories.values()]
+
+    def update(self, codes):
+        """Add an (n_rows, n_columns) array of codes."""
+        codes = np.asarray(codes)
+        for g, counts in enumerate(self.counts):
+            column = codes[:, g].astype(np.int64)
+            counts += np.bincount(np.where(column == INVALID_CODE, len(counts) - 1, column), minlength=len(counts))
+        return self
+
+    def merge(self, other):
+        if list(other.categories.items()) != list(self.categories.items()):
+            raise ValueError("Cannot merge frequency tables of different categories")
+        for counts, other_counts in zip(self.counts, other.counts):
+            counts += other_counts
+        return self
+
+    def frequencies(self):
+        """For each column, the fraction of rows in each category and with an invalid code."""
+        result = OrderedDict()
+        for (name, categories), counts in zip(self.categories.items(), self.counts):
+            total = float(max(counts.sum(), 1))
+            result[name] = OrderedDict(zip(categories + ["invalid"], (counts / total).tolist()))
+        return result
+
+    def to_dict(self):
+        return {"categories": list(self.categories.items()), "counts": [counts.tolist() for counts in self.counts]}
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls(OrderedDict((name, list(categories)) for name, categories in state["categories"]))
+        stats.counts = [np.array(counts, dtype=np.int64) for counts in state["counts"]]
+        return stats
+
+
+class CompactStats(object):
+    """StreamStats of the columns that are not one-hot and the prediction, and CategoryStats of the
+    one-hot groups. Has the same update, merge and save methods as StreamStats."""
+
+    def __init__(self, alpha=0.01):
+        self.numeric = StreamStats(NUMERIC_COLUMNS, alpha)
+        self.categories = CategoryStats()
+
+    def update(self, matrix):
+        """Add an (n_rows, len(COLUMNS)) array, which is encoded first."""
+        X = np.asarray(matrix, dtype=np.float64)
+        numeric, codes = encode_categories(X[:, :len(FEATURE_NAMES)])
+        self.numeric.update(np.column_stack([numeric, X[:, len(FEATURE_NAMES)]]))
+        self.categories.update(codes)
+        return self
+
+    def update_records(self, records):
+        numeric, codes, predictions = preprocess_batch(records, compact=True)
+        self.numeric.update(np.column_stack([numeric, predictions]))
+        self.categories.update(codes)
+        return self
+
+    def merge(self, other):
+        if not isinstance(other, CompactStats):
+            raise ValueError("Cannot merge compact statistics with full ones")
+        self.numeric.merge(other.numeric)
+        self.categories.merge(other.categories)
+        return self
+
+    def summary(self):
+        summary = self.numeric.summary()
+        summary.update(self.categories.frequencies())
+        return summary
+
+    def to_dict(self):
+        return {"compact": True, "numeric": self.numeric.to_dict(), "categories": self.categories.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls()
+        stats.numeric = StreamStats.from_dict(state["numeric"])
+        stats.categories = CategoryStats.from_dict(state["categories"])
+        return stats
+
+    def save(self, path):
+        with open(path, "w") as out:
+            json.dump(self.to_dict(), out)
+
+
+def stats_from_dict(state):
+    """StreamStats or CompactStats, whichever state was saved from."""
+    return CompactStats.from_dict(state) if state.get("compact") else StreamStats.from_dict(state)
+
+
+def load_stats(path):
+    with open(path) as inp:
+        return stats_from_dict(json.load(inp))
+
+
+def _or_none(value):
+    return None if value is None or not math.isfinite(value) else value
+
+
+def psi(baseline, current, n_bins=10, epsilon=1e-4):
+    """The population stability index of current against baseline, two QuantileSketches, over bins
+    cut at the baseline's quantiles. Columns with few distinct values get fewer bins."""
+    edges = sorted(set(baseline.quantile(q) for q in np.linspace(0, 1, n_bins + 1)[1:-1]))
+    expected = np.diff([0.0] + [baseline.cdf(edge) for edge in edges] + [1.0])
+    actual = np.diff([0.0] + [current.cdf(edge) for edge in edges] + [1.0])
+    expected = np.maximum(expected, epsilon)
+    actual = np.maximum(actual, epsilon)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def frequency_psi(baseline, current, epsilon=1e-4):
+    """The population stability index of two arrays of category counts."""
+    expected = np.maximum(baseline / float(max(baseline.sum(), 1)), epsilon)
+    actual = np.maximum(current / float(max(current.sum(), 1)), epsilon)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def drift_report(baseline, current, threshold=PSI_THRESHOLD):
+    """Compare the columns of two StreamStats, or two CompactStats.
+
+    Returns:
+        A dict with each column's psi, mean_shift (in baseline standard deviations) and
+        missing_rate_change, or for the one-hot groups of CompactStats the psi of the category
+        frequencies and invalid_rate_change, and the list of columns whose PSI is over threshold.
+        Columns with no values on either side are left out.
+    """
+    if isinstance(baseline, CompactStats) != isinstance(current, CompactStats):
+        raise ValueError("Cannot compare compact statistics with full ones")
+    if isinstance(current, CompactStats):
+        report = drift_report(baseline.numeric, current.numeric, threshold)
+        for (name, _), expected, actual in zip(current.categories.categories.items(), baseline.categories.counts,
+                                               current.categories.counts):
+            if expected.sum() == 0 or actual.sum() == 0:
+                continue
+            report["features"][name] = {
+                "psi": frequency_psi(expected, actual),
+                "invalid_rate_change": float(actual[-1] / float(actual.sum()) - expected[-1] / float(expected.sum())),
+            }
+        report["drifted"] = _drifted(report["features"], threshold)
+        return report
+    if baseline.names != current.names:
+        raise ValueError("The baseline and current statistics have different columns")
+    baseline_std = np.sqrt(baseline.variance)
+    features = {}
+    for j, name in enumerate(current.names):
+        if baseline.count[j] == 0 or current.count[j] == 0:
+            continue
+        shift = (current.mean[j] - baseline.mean[j]) / baseline_std[j] if baseline_std[j] > 0 else 0.0
+        features[name] = {
+            "psi": psi(baseline.sketches[j], current.sketches[j]),
+            "mean_shift": float(shift),
+            "missing_rate_change": float(
+                current.missing[j] / float(current.count[j] + current.missing[j])
+                - baseline.missing[j] / float(baseline.count[j] + baseline.missing[j])),
+        }
+    return {"threshold": threshold, "records": int(current.count.max()), "drifted": _drifted(features, threshold),
+            "features": features}
+
+
+def _drifted(features, threshold):
+    return sorted((name for name, scores in features.items() if scores["psi"] > threshold),
+                  key=lambda name: -features[name]["psi"])
+
+
+def stats_from_capture_files(paths, batch_size=10000, compact=False):
+    """StreamStats, or CompactStats, of the records in data capture JSONL files, reading batch_size
+    records at a time."""
+    stats = CompactStats() if compact else StreamStats()
+    for path in paths:
+        with open(path) as inp:
+            lines = (line for line in inp if line.strip())
+            while True:
+                batch = [json.loads(line) for line in itertools.islice(lines, batch_size)]
+                if not batch:
+                    break
+                stats.update_records(batch)
+    return stats
+
+
+def stats_from_csv(path, header=True, batch_size=10000, compact=False):
+    """StreamStats, or CompactStats, of a CSV of feature rows, such as the training data. With a header, the columns are
+    matched by name and others, such as the label, are ignored; without one, the columns are taken to
+    be FEATURE_NAMES in order."""
+    import pandas as pd
+
+    stats = CompactStats() if compact else StreamStats()
+    for chunk in pd.read_csv(path, header=0 if header else None, chunksize=batch_size):
+        if not header:
+            chunk.columns = FEATURE_NAMES[:chunk.shape[1]]
+        stats.update(chunk.reindex(columns=COLUMNS).to_numpy(np.float64))
+    return stats
+
+
+def _stats_of_files(paths, batch_size, compact):
+    return stats_from_capture_files(paths, batch_size, compact).to_dict()
+
+
+def gather(paths, state=None, workers=1, batch_size=10000, compact=False):
+    """Statistics of capture files, read in parallel and merged into the saved state, if any. Compact
+    unless the saved state is full."""
+    if state and os.path.exists(state):
+        stats = load_stats(state)
+        compact = isinstance(stats, CompactStats)
+    else:
+        stats = CompactStats() if compact else StreamStats()
+    if workers > 1 and len(paths) > 1:
+        shares = [paths[i::workers] for i in range(workers)]
+        with ProcessPoolExecutor(workers) as pool:
+            for part in pool.map(_stats_of_files, shares, [batch_size] * len(shares), [compact] * len(shares)):
+                stats.merge(stats_from_dict(part))
+    elif paths:
+        stats.merge(stats_from_capture_files(paths, batch_size, compact))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming statistics and drift of captured traffic")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("baseline", help="statistics of a CSV of feature rows")
+    command.add_argument("--csv", required=True)
+    command.add_argument("--no-header", action="store_true")
+    command.add_argument("--compact", action="store_true", help="keep frequency tables of the one-hot groups")
+    command.add_argument("--out", required=True)
+    command = commands.add_parser("update", help="add capture files to saved statistics")
+    command.add_argument("--state", required=True, help="statistics file, created if missing")
+    command.add_argument("--compact", action="store_true", help="create the statistics file compact")
+    command.add_argument("--workers", type=int, default=1)
+    command.add_argument("paths", nargs="+", help="data capture JSONL files")
+    command = commands.add_parser("merge", help="merge saved statistics")
+    command.add_argument("--out", required=True)
+    command.add_argument("paths", nargs="+", help="statistics files")
+    command = commands.add_parser("check", help="drift of saved statistics and/or capture files from a baseline")
+    command.add_argument("--baseline", required=True)
+    command.add_argument("--state", help="statistics file to add the capture files to")
+    command.add_argument("--threshold", type=float, default=PSI_THRESHOLD)
+    command.add_argument("--workers", type=int, default=1)
+    command.add_argument("--out", help="write the report to this file")
+    command.add_argument("paths", nargs="*", help="data capture JSONL files")
+    args = parser.parse_args()
+
+    if args.command == "baseline":
+        stats_from_csv(args.csv, header=not args.no_header, compact=args.compact).save(args.out)
+    elif args.command == "update":
+        gather(args.paths, args.state, args.workers, compact=args.compact).save(args.state)
+    elif args.command == "merge":
+        stats = load_stats(args.paths[0])
+        for path in args.paths[1:]:
+            stats.merge(load_stats(path))
+        stats.save(args.out)
+    elif args.command == "check":
+        baseline = load_stats(args.baseline)
+        current = gather(args.paths, args.state, args.workers, compact=isinstance(baseline, CompactStats))
+        if args.state:
+            current.save(args.state)
+        report = drift_report(baseline, current, args.threshold)
+        print("{} records, {} of {} columns drifted (PSI > {})".format(
+            report["records"], len(report["drifted"]), len(report["features"]), args.threshold))
+        for name in report["drifted"]:
+            scores = report["features"][name]
+            if "mean_shift" in scores:
+                print("  {:<16} PSI {:.3f}, mean shift {:+.2f} sd".format(name, scores["psi"], scores["mean_shift"]))
+            else:
+                print("  {:<16} PSI {:.3f}, invalid rate change {:+.4f}".format(name, scores["psi"], scores["invalid_rate_change"]))
+        if args.out:
+            with open(args.out, "w") as out:
+                json.dump(report, out, indent=2)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
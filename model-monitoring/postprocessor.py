@@ -1,2 +1,202 @@
+import base64
+import glob
+import io
+import itertools
+import json
+import os
+
+import numpy as np
+
+# Model Monitor runs this script on its own, without preprocessor.py next to it, so the feature names
+# and the parsing of data capture records are repeated here. They must match preprocessor.py's
+# FEATURE_NAMES and preprocess_batch; benchmarks/constraint_throughput.py checks that they do.
+
+# Column names from training-dataset-with-header.csv (excluding the label "Churn")
+FEATURE_NAMES = [
+    "Account Length", "VMail Message", "Day Mins", "Day Calls", "Eve Mins",
+    "Eve Calls", "Night Mins", "Night Calls", "Intl Mins", "Intl Calls",
+    "CustServ Calls", "State_AK", "State_AL", "State_AR", "State_AZ",
+    "State_CA", "State_CO", "State_CT", "State_DC", "State_DE", "State_FL",
+    "State_GA", "State_HI", "State_IA", "State_ID", "State_IL", "State_IN",
+    "State_KS", "State_KY", "State_LA", "State_MA", "State_MD", "State_ME",
+    "State_MI", "State_MN", "State_MO", "State_MS", "State_MT", "State_NC",
+    "State_ND", "State_NE", "State_NH", "State_NJ", "State_NM", "State_NV",
+    "State_NY", "State_OH", "State_OK", "State_OR", "State_PA", "State_RI",
+    "State_SC", "State_SD", "State_TN", "State_TX", "State_UT", "State_VA",
+    "State_VT", "State_WA", "State_WI", "State_WV", "State_WY",
+    "Area Code_408", "Area Code_415", "Area Code_510",
+    "Int'l Plan_no", "Int'l Plan_yes", "VMail Plan_no", "VMail Plan_yes",
+]
+
+COLUMNS = FEATURE_NAMES + ["prediction"]
+
+# Used when the baseline, suggested from the training data, has no constraint for the prediction: the
+# model outputs a churn probability.
+PREDICTION_CONSTRAINT = {
+    "name": "prediction",
+    "inferred_type": "Fractional",
+    "completeness": 1.0,
+    "num_constraints": {"is_non_negative": True, "min": 0.0, "max": 1.0},
+}
+
+# Records decoded and checked at a time.
+BATCH_SIZE = 100000
+
+_constraints = {}  # path -> ConstraintChecker arguments, so each file is read once
+
+
+def _decode(data, encoding):
+    if encoding == "BASE64":
+        return base64.b64decode(data).decode("utf-8")
+    return data
+
+
+def _parse_rows(lines, n_columns):
+    """Parse CSV lines into an (n_lines, n_columns) float64 matrix, padding short rows with NaN."""
+    try:
+        matrix = np.loadtxt(io.StringIO("\n".join(lines)), delimiter=",", dtype=np.float64, ndmin=2,
+                            comments=None)
+        if matrix.shape == (len(lines), n_columns):
+            return matrix
+    except ValueError:
+        pass
+    matrix = np.full((len(lines), n_columns), np.nan)
+    for i, line in enumerate(lines):
+        values = line.split(",")[:n_columns]
+        matrix[i, :len(values)] = [float(value) for value in values]
+    return matrix
+
+
+def parse_records(records):
+    """The (features, predictions) of data capture records, parsed lines of a capture file, as
+    preprocessor.preprocess_batch returns them."""
+    if not records:
+        return np.empty((0, len(FEATURE_NAMES))), np.empty(0)
+    inputs, outputs = [], []
+    for record in records:
+        capture = record["captureData"]
+        endpoint_input, endpoint_output = capture["endpointInput"], capture["endpointOutput"]
+        inputs.append(_decode(endpoint_input["data"], endpoint_input.get("encoding")).strip().partition("\n")[0])
+        outputs.append(_decode(endpoint_output["data"], endpoint_output.get("encoding")).strip())
+    return _parse_rows(inputs, len(FEATURE_NAMES)), np.array(outputs, dtype=np.float64)
+
+
+class ConstraintChecker(object):
+    """Counts the violations of Model Monitor baseline constraints over batches of records.
+
+    Supports the completeness and data type (Integral or Fractional) constraints of every column and
+    the is_non_negative numerical constraint, plus "min" and "max" bounds in num_constraints. Each
+    batch is checked with a few array operations across all the columns at once.
+
+    Args:
+        constraints (dict): The contents of a constraints.json file.
+    """
+
+    def __init__(self, constraints):
+        by_name = {feature["name"]: feature for feature in constraints.get("features", [])}
+        by_name.setdefault("prediction", PREDICTION_CONSTRAINT)
+        config = constraints.get("monitoring_config", {})
+        self.datatype_threshold = float(config.get("datatype_check_threshold", 1.0))
+        self.checked = np.array([name in by_name for name in COLUMNS])
+        features = [by_name.get(name, {}) for name in COLUMNS]
+        num = [feature.get("num_constraints", {}) for feature in features]
+        self.completeness = np.array([float(feature.get("completeness", 0.0)) for feature in features])
+        self.integral = np.array([feature.get("inferred_type") == "Integral" for feature in features])
+        self.lower = np.array([max(0.0 if n.get("is_non_negative") else -np.inf, float(n.get("min", -np.inf))) for n in num])
+        self.upper = np.array([float(n.get("max", np.inf)) for n in num])
+        self.records = 0
+        self.missing = np.zeros(len(COLUMNS), dtype=np.int64)
+        self.type_mismatches = np.zeros(len(COLUMNS), dtype=np.int64)
+        self.out_of_range = np.zeros(len(COLUMNS), dtype=np.int64)
+
+    @classmethod
+    def from_file(cls, path):
+        """A checker for the constraints in path. The file is only read the first time."""
+        if path not in _constraints:
+            with open(path) as inp:
+                _constraints[path] = json.load(inp)
+        return cls(_constraints[path])
+
+    def update(self, matrix):
+        """Check an (n_records, len(COLUMNS)) array of values, with NaN for missing ones."""
+        X = np.asarray(matrix, dtype=np.float64)
+        self.records += X.shape[0]
+        self.missing += np.isnan(X).sum(axis=0)
+        # Comparisons with NaN are false, so missing values count as neither wrong type nor out of range.
+        self.out_of_range += ((X < self.lower) | (X > self.upper)).sum(axis=0)
+        integral = X[:, self.integral]
+        self.type_mismatches[self.integral] += (integral != np.round(integral)).sum(axis=0) - np.isnan(integral).sum(axis=0)
+        return self
+
+    def update_records(self, records):
+        """Check data capture records, parsed lines of a capture file."""
+        features, predictions = parse_records(records)
+        return self.update(np.column_stack([features, predictions]))
+
+    def violations(self):
+        """The violations found so far, in the form of Model Monitor's constraint_violations.json."""
+        if self.records == 0:
+            return []
+        present = self.records - self.missing
+        completeness = present / float(self.records)
+        conforming = 1.0 - self.type_mismatches / np.maximum(present, 1).astype(np.float64)
+        violations = []
+        for j, name in enumerate(COLUMNS):
+            if not self.checked[j]:
+                continue
+            if completeness[j] < self.completeness[j]:
+                violations.append({
+                    "feature_name": name,
+                    "constraint_check_type": "completeness_check",
+                    "description": "Data completeness is {:.4f}, below the baseline's {:.4f}".format(completeness[j], self.completeness[j]),
+                })
+            if self.integral[j] and conforming[j] < self.datatype_threshold:
+                violations.append({
+                    "feature_name": name,
+                    "constraint_check_type": "data_type_check",
+                    "description": "{} of {} values are not Integral ({:.4f} conform, threshold {})".format(
+                        self.type_mismatches[j], present[j], conforming[j], self.datatype_threshold),
+                })
+            if self.out_of_range[j]:
+                violations.append({
+                    "feature_name": name,
+                    "constraint_check_type": "range_check",
+                    "description": "{} of {} values are outside [{}, {}]".format(
+                        self.out_of_range[j], present[j], self.lower[j], self.upper[j]),
+                })
+        return violations
+
+    def report(self):
+        return {"records": self.records, "violations": self.violations()}
+
+
+def check_capture_files(checker, paths, batch_size=BATCH_SIZE):
+    """Feed the records of data capture JSONL files to checker, batch_size records at a time."""
+    for path in paths:
+        with open(path) as inp:
+            lines = (line for line in inp if line.strip())
+            while True:
+                batch = [json.loads(line) for line in itertools.islice(lines, batch_size)]
+                if not batch:
+                    break
+                checker.update_records(batch)
+    return checker
+
+
 def postprocess_handler():
-    print("Hello from post-proc script!")
\ No newline at end of file
+    # Model Monitor passes its inputs and outputs in the environment.
+    constraints_path = os.environ.get("baseline_constraints")
+    dataset_source = os.environ.get("dataset_source", "/opt/ml/processing/input/endpoint")
+    output_path = os.environ.get("output_path", "/opt/ml/processing/resultdata")
+    if not constraints_path or not os.path.exists(constraints_path):
+        print("No baseline constraints to check against")
+        return
+
+    checker = ConstraintChecker.from_file(constraints_path)
+    paths = sorted(glob.glob(os.path.join(dataset_source, "**", "*.jsonl"), recursive=True))
+    report = check_capture_files(checker, paths).report()
+
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, "postprocess_violations.json"), "w") as out:
+        json.dump(report, out, indent=2)
+    print("Checked {} records from {} files: {} violations".format(report["records"], len(paths), len(report["violations"])))